@@ -0,0 +1,199 @@
+"""End-to-end load benchmark.
+
+Runs the Flask app against local stand-ins for Twilio and OpenAI and replays /sms webhooks from many phone
+numbers. Each number waits for its reply before texting again. Reports throughput, end-to-end latency from
+webhook to the reply reaching Twilio, and where the time went.
+
+    python benchmarks/bench_e2e.py --numbers 50 --messages 1000 --output e2e.json
+"""
+import argparse
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from itertools import count
+from time import perf_counter
+
+from common import StageTimer, make_results, summarize, write_results
+from fakes import FakeOpenAI, FakeTwilio, LocalTwilioHttpClient
+
+# Limits would throttle the synthetic traffic. Set before textgpt reads its config at import
+for key, value in {'TEXTGPT_MESSAGES_PER_MINUTE': '0', 'TEXTGPT_DAILY_PROMPT_TOKENS': '0',
+                   'TEXTGPT_DAILY_COMPLETION_TOKENS': '0', 'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+                   'TWILIO_AUTH_TOKEN': 'bench', 'OPENAI_API_KEY': 'bench'}.items():
+    os.environ.setdefault(key, value)
+
+import openai  # noqa: E402
+import requests  # noqa: E402
+from twilio.rest import Client  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+import textgpt  # noqa: E402
+
+BOT_NUMBER = '+15550000000'
+COMMANDS = ['#help', '#get settings', '#models', '#limits', '#get model']
+# MessageDB methods the handlers call directly
+DB_METHODS = ['add_message', 'add_settings', 'get_settings_for_phone_number', 'get_messages_for_phone_number',
+              'get_summary_for_phone_number', 'get_model_context_window', 'update_message_token_counts',
+              'get_token_count_for_phone_number', 'update_settings_for_phone_number', 'get_cached_completion',
+              'put_cached_completion', 'get_history_for_phone_number']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--numbers', type=int, default=50, help='phone numbers texting at once')
+    parser.add_argument('--messages', type=int, default=1000, help='total webhooks to send')
+    parser.add_argument('--history', type=int, default=100, help='messages already stored per number')
+    parser.add_argument('--workers', type=int, default=8, help='TEXTGPT_WORKERS. 0 handles webhooks in Flask threads')
+    parser.add_argument('--chat', type=float, default=0.8, help='fraction of plain texts')
+    parser.add_argument('--commands', type=float, default=0.15, help='fraction of #commands')
+    parser.add_argument('--images', type=float, default=0.05, help='fraction of #image create')
+    parser.add_argument('--openai-latency', type=float, default=0.05)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--twilio-latency', type=float, default=0.02)
+    parser.add_argument('--reply-timeout', type=float, default=30.0)
+    parser.add_argument('--stream', action='store_true', help='stream completions like TEXTGPT_STREAM=1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='database file. Defaults to a temporary file')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help="show textGPT's own logging")
+    return parser.parse_args(argv)
+
+
+def make_traffic(args):
+    # number -> list of (kind, body) it texts in order
+    rng = random.Random(args.seed)
+    numbers = [f'+1555{i:07d}' for i in range(1, args.numbers + 1)]
+    traffic = {number: [] for number in numbers}
+    kinds = ['chat', 'command', 'image']
+    weights = [args.chat, args.commands, args.images]
+    for i in range(args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'chat':
+            body = f'Question {i}: can you explain topic {rng.randrange(1000)} in a couple of sentences?'
+        elif kind == 'command':
+            body = rng.choice(COMMANDS)
+        else:
+            body = f'#image create a watercolor of a lighthouse number {i}'
+        traffic[numbers[i % len(numbers)]].append((kind, body))
+    return traffic
+
+
+def seed_history(tg, numbers, history):
+    # DEFAULT_SETTINGS refers to a system prompt id of a full db so name the prompt instead
+    settings = {**textgpt.DEFAULT_SETTINGS,
+                'system_prompt': 'You are a helpful assistant answering by SMS.'}
+    for number in numbers:
+        tg.mdb.add_phone_number(number)
+        tg.mdb.add_settings(number, **settings)
+        for i in range(history):
+            if i % 2:
+                tg.mdb.add_message(f'SMseed{number}{i}', BOT_NUMBER, number, f'Earlier answer {i} ' * 8)
+            else:
+                tg.mdb.add_message(f'SMseed{number}{i}', number, BOT_NUMBER, f'Earlier question {i} ' * 4)
+    tg.mdb.flush()
+
+
+def run(args):
+    fake_openai = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate).start()
+    replies = {}
+    fake_twilio = FakeTwilio(latency=args.twilio_latency,
+                             on_message=lambda values: replies[values['To']].put(perf_counter())).start()
+    openai.api_base = f'{fake_openai.url}/v1'
+    openai.api_key = 'bench'
+
+    traffic = make_traffic(args)
+    for number in traffic:
+        replies[number] = queue.Queue()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    db_name = args.db or os.path.join(tmpdir.name, 'bench.db')
+    tg = textgpt.textGPT(db_name, number=BOT_NUMBER, num_workers=args.workers, stream=args.stream)
+    tg.client = Client(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'],
+                       http_client=LocalTwilioHttpClient(fake_twilio.url))
+    tg.models_refreshed.wait(10)
+    seed_history(tg, traffic, args.history)
+
+    timer = StageTimer()
+    timer.instrument(tg.mdb, 'db', DB_METHODS)
+    timer.instrument(tg.openai_client, 'llm', ['call'])
+    timer.instrument(tg, 'send', ['send_segment'])
+
+    textgpt.textgpt = tg
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, textgpt.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    sms_url = f'http://127.0.0.1:{server.server_port}/sms'
+
+    latencies = {'end_to_end': [], 'webhook_ack': []}
+    latencies_by_kind = {'chat': [], 'command': [], 'image': []}
+    lock = threading.Lock()
+    timeouts = 0
+    sids = count()
+
+    def converse(number):
+        # One user texting and waiting for each reply before the next
+        nonlocal timeouts
+        session = requests.Session()
+        for kind, body in traffic[number]:
+            sent_at = perf_counter()
+            response = session.post(sms_url, data={'MessageSid': f'SM{next(sids):032d}', 'From': number,
+                                                   'To': BOT_NUMBER, 'Body': body})
+            acked_at = perf_counter()
+            response.raise_for_status()
+            try:
+                replied_at = replies[number].get(timeout=args.reply_timeout)
+            except queue.Empty:
+                with lock:
+                    timeouts += 1
+                continue
+            with lock:
+                latencies['webhook_ack'].append(acked_at - sent_at)
+                latencies['end_to_end'].append(replied_at - sent_at)
+                latencies_by_kind[kind].append(replied_at - sent_at)
+
+    started_at = perf_counter()
+    with ThreadPoolExecutor(max_workers=len(traffic)) as executor:
+        list(executor.map(converse, traffic))
+    elapsed = perf_counter() - started_at
+
+    results = {
+        'elapsed_s': elapsed,
+        'messages': sum(map(len, traffic.values())),
+        'throughput_msgs_per_s': len(latencies['end_to_end']) / elapsed,
+        'timeouts': timeouts,
+        'latency': {name: summarize(values) for name, values in latencies.items()},
+        'latency_by_kind': {kind: summarize(values) for kind, values in latencies_by_kind.items() if values},
+        'stages': timer.summary(),
+        'worker_pool': tg.worker_pool.stats() if tg.worker_pool else None,
+        'shed': tg.shed,
+        'openai_client': tg.openai_client.stats(),
+    }
+
+    server.shutdown()
+    tg.close()
+    fake_openai.stop()
+    fake_twilio.stop()
+    tmpdir.cleanup()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'verbose', 'db')}
+    with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        results = run(args)
+    print(f"[BENCH]: {results['throughput_msgs_per_s']:.1f} msgs/s, "
+          f"p50 {results['latency']['end_to_end']['p50_ms']:.1f}ms, "
+          f"p95 {results['latency']['end_to_end']['p95_ms']:.1f}ms, "
+          f"p99 {results['latency']['end_to_end']['p99_ms']:.1f}ms", file=sys.stderr)
+    return write_results(make_results('e2e', config, results), args.output)
+
+
+if __name__ == '__main__':
+    main()
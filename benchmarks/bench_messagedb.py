@@ -0,0 +1,134 @@
+"""MessageDB microbenchmarks.
+
+Times the MessageDB methods the webhook handlers call against databases holding 10k, 100k and 1M messages
+spread over many conversations.
+
+    python benchmarks/bench_messagedb.py --sizes 10000,100000,1000000 --output messagedb.json
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter, time
+
+from common import make_results, summarize, write_results
+from messagedb import MessageDB
+
+BOT_NUMBER = '+15550000000'
+SEED_BATCH_SIZE = 50000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated message counts')
+    parser.add_argument('--numbers', type=int, default=1000, help='conversations the messages are spread over')
+    parser.add_argument('--iterations', type=int, default=200, help='calls timed per method and size')
+    parser.add_argument('--write-behind', action='store_true', help='use the write-behind journal')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def get_numbers(count):
+    return [f'+1555{i:07d}' for i in range(1, count + 1)]
+
+
+def seed(mdb, size, numbers):
+    # Bulk loads size messages alternating between each number and the bot, bypassing add_message for speed
+    mdb.add_phone_number(BOT_NUMBER)
+    bot_id = mdb.get_phone_id(BOT_NUMBER)
+    phone_ids = []
+    for number in numbers:
+        mdb.add_phone_number(number)
+        mdb.add_settings(number, model='gpt-3.5-turbo', system_prompt='You are a helpful assistant.',
+                         temperature=1.0, top_p=1.0, frequency_penalty=0.0, presence_penalty=0.0)
+        phone_ids.append(mdb.get_phone_id(number))
+
+    created_at = int(time())
+    body = 'A typical text message of a dozen or so words sent back and forth.'
+    for start in range(0, size, SEED_BATCH_SIZE):
+        rows = []
+        for i in range(start, min(size, start + SEED_BATCH_SIZE)):
+            phone_id = phone_ids[i % len(phone_ids)]
+            from_id, to_id = (phone_id, bot_id) if (i // len(phone_ids)) % 2 == 0 else (bot_id, phone_id)
+            rows.append((f'SMseed{i}', from_id, to_id, body, created_at, 16))
+        mdb.cursor.executemany('''
+            INSERT INTO messages (message_sid, from_phone_id, to_phone_id, body, created_at, token_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        mdb.conn.commit()
+    mdb.cursor.execute('ANALYZE')
+
+
+def time_calls(fn, args_list):
+    latencies = []
+    for args in args_list:
+        started_at = perf_counter()
+        fn(*args)
+        latencies.append(perf_counter() - started_at)
+    result = summarize(latencies)
+    result['ops_per_s'] = len(latencies) / sum(latencies) if latencies else 0.0
+    return result
+
+
+def bench_size(size, args):
+    rng = random.Random(args.seed)
+    numbers = get_numbers(min(args.numbers, size))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mdb = MessageDB(os.path.join(tmpdir, 'bench.db'), write_behind=args.write_behind)
+        seed_started_at = perf_counter()
+        seed(mdb, size, numbers)
+        seed_seconds = perf_counter() - seed_started_at
+
+        def sample():
+            return [(rng.choice(numbers),) for _ in range(args.iterations)]
+
+        last_message_id = mdb.cursor.execute('SELECT MAX(message_id) FROM messages').fetchone()[0]
+        recent_message_id = max(0, last_message_id - len(numbers) * 10)
+
+        def uncached(fn):
+            def call(*call_args):
+                mdb.clear_caches()
+                return fn(*call_args)
+            return call
+
+        results = {
+            'seed_s': seed_seconds,
+            'add_message': time_calls(
+                mdb.add_message, [(f'SMbench{i}', number, BOT_NUMBER, 'Hello there, how are you today?')
+                                  for i, (number,) in enumerate(sample())]),
+            'get_messages_for_phone_number': time_calls(mdb.get_messages_for_phone_number, sample()),
+            'get_messages_for_phone_number_recent': time_calls(
+                mdb.get_messages_for_phone_number, [(number, recent_message_id) for number, in sample()]),
+            'iter_messages_for_phone_number_newest_20': time_calls(
+                lambda number: list(mdb.iter_messages_for_phone_number(number, newest_first=True, limit=20)),
+                sample()),
+            'get_token_count_for_phone_number': time_calls(mdb.get_token_count_for_phone_number, sample()),
+            'get_settings_for_phone_number': time_calls(mdb.get_settings_for_phone_number, sample()),
+            'get_settings_for_phone_number_uncached': time_calls(
+                uncached(mdb.get_settings_for_phone_number), sample()),
+            'get_phone_id_uncached': time_calls(uncached(mdb.get_phone_id), sample()),
+        }
+        mdb.close()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {}
+    for size in sizes:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            results[str(size)] = bench_size(size, args)
+        print(f"[BENCH]: {size} messages: get_messages_for_phone_number "
+              f"p50 {results[str(size)]['get_messages_for_phone_number']['p50_ms']:.2f}ms, "
+              f"add_message p50 {results[str(size)]['add_message']['p50_ms']:.2f}ms", file=sys.stderr)
+
+    config = {key: value for key, value in vars(args).items() if key != 'output'}
+    return write_results(make_results('messagedb', config, results), args.output)
+
+
+if __name__ == '__main__':
+    main()
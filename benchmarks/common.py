@@ -0,0 +1,98 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from time import perf_counter
+
+# Benchmarks run as scripts from the repo root or this directory so make the textGPT modules importable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+# Bump when the result format changes so compare.py can refuse to compare apples and oranges
+RESULTS_FORMAT_VERSION = 1
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def summarize(latencies):
+    # Seconds in, milliseconds out
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': values[-1] * 1000 if values else 0.0,
+    }
+
+
+class StageTimer:
+    # Collects how long each call to wrapped functions takes, grouped by stage
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.latencies[stage].append(seconds)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            started_at = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, perf_counter() - started_at)
+        return timed
+
+    def instrument(self, obj, stage, names):
+        # Replaces obj.<name> for each name with a timed version on the instance
+        for name in names:
+            setattr(obj, name, self.wrap(stage, getattr(obj, name)))
+
+    def summary(self):
+        with self.lock:
+            return {stage: {**summarize(latencies), 'total_s': sum(latencies)}
+                    for stage, latencies in sorted(self.latencies.items())}
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_results(benchmark, config, results):
+    return {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'benchmark': benchmark,
+        'revision': get_git_revision(),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results,
+    }
+
+
+def write_results(results, path=None):
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+        print(f'[BENCH]: Wrote results to {path}')
+    else:
+        print(text)
+    return results
@@ -0,0 +1,71 @@
+"""Compare two benchmark result files.
+
+Every latency (*_ms) that got more than --threshold slower and every throughput (*_per_s) that dropped by
+more than --threshold is reported as a regression, and the exit status is 1 if there are any.
+
+    python benchmarks/compare.py baseline.json current.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+from common import RESULTS_FORMAT_VERSION
+
+
+def flatten(results, prefix=''):
+    # {'a': {'b': 1}} -> {'a.b': 1} for the numeric leaves
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{path}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline, current, threshold=0.1):
+    # Returns [(metric, baseline value, current value, relative change)] of the regressions
+    for results in (baseline, current):
+        if results.get('format_version') != RESULTS_FORMAT_VERSION:
+            raise ValueError(f"Unsupported results format {results.get('format_version')}")
+    if baseline['benchmark'] != current['benchmark']:
+        raise ValueError(f"Cannot compare {baseline['benchmark']} with {current['benchmark']} results")
+
+    baseline_values = flatten(baseline['results'])
+    current_values = flatten(current['results'])
+    regressions = []
+    for metric, old in sorted(baseline_values.items()):
+        if (new := current_values.get(metric)) is None or not old:
+            continue
+        change = (new - old) / old
+        if metric.endswith('_ms') and change > threshold:
+            regressions.append((metric, old, new, change))
+        elif metric.endswith('_per_s') and -change > threshold:
+            regressions.append((metric, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change allowed, 0.1 is 10%%')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = compare(baseline, current, args.threshold)
+    print(f"[BENCH]: {baseline['benchmark']} {baseline.get('revision')} -> {current.get('revision')}")
+    for metric, old, new, change in regressions:
+        print(f'[BENCH]: REGRESSION {metric}: {old:.3f} -> {new:.3f} ({change:+.1%})')
+    if not regressions:
+        print(f'[BENCH]: No regressions over {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
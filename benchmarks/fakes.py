@@ -0,0 +1,139 @@
+import json
+import random
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from time import sleep
+from urllib.parse import parse_qs
+from uuid import uuid4
+from twilio.http.http_client import TwilioHttpClient
+
+TWILIO_API_URL = 'https://api.twilio.com'
+
+
+class FakeServer:
+    # Serves handler_class on a free local port from a daemon thread
+    def __init__(self, handler_class):
+        handler_class.server_owner = self
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately so Nagle would add a delayed ACK to every keep-alive response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAIHandler(QuietHandler):
+
+    def do_GET(self):
+        if self.path.endswith('/models'):
+            return self.send_json(200, {'object': 'list', 'data': [{'id': 'gpt-3.5-turbo'}, {'id': 'gpt-4'}]})
+        self.send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        fake = self.server_owner
+        request = json.loads(self.read_body() or b'{}')
+        sleep(fake.get_latency())
+        if fake.error_rate and random.random() < fake.error_rate:
+            return self.send_json(500, {'error': {'message': 'Injected error', 'type': 'server_error'}})
+
+        if self.path.endswith('/images/generations'):
+            return self.send_json(200, {'created': 0, 'data': [{'url': f'{fake.url}/images/{next(fake.ids)}.png'}]})
+
+        if request.get('stream'):
+            return self.send_stream(fake.reply)
+        self.send_json(200, {
+            'id': f'chatcmpl-{next(fake.ids)}', 'object': 'chat.completion', 'model': request.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': fake.reply}}],
+        })
+
+    def send_stream(self, reply):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for word in reply.split(' '):
+            chunk = {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+
+class FakeOpenAI(FakeServer):
+    # latency is the mean seconds per request, jitter the +/- fraction of it
+    def __init__(self, latency=0.05, jitter=0.5, error_rate=0.0, reply='Sure, happy to help with that.'):
+        super().__init__(FakeOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply = reply
+        self.ids = count()
+
+    def get_latency(self):
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+class FakeTwilioHandler(QuietHandler):
+
+    def do_POST(self):
+        fake = self.server_owner
+        values = {key: value[0] for key, value in parse_qs(self.read_body().decode()).items()}
+        sleep(fake.latency)
+        # Random like real SIDs so they never collide with the MessageSids of the incoming webhooks
+        sid = f'SM{uuid4().hex}'
+        fake.on_message(values)
+        self.send_json(201, {'sid': sid, 'to': values.get('To'), 'from': values.get('From'),
+                             'body': values.get('Body'), 'status': 'queued'})
+
+
+class FakeTwilio(FakeServer):
+    # on_message is called with the form values of every message sent
+    def __init__(self, latency=0.02, on_message=None):
+        super().__init__(FakeTwilioHandler)
+        self.latency = latency
+        self.on_message = on_message or (lambda values: None)
+        self.ids = count()
+
+
+class LocalTwilioHttpClient(TwilioHttpClient):
+    # Sends every Twilio REST request to base_url instead of api.twilio.com
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, url.replace(TWILIO_API_URL, self.base_url), *args, **kwargs)
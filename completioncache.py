@@ -0,0 +1,61 @@
+import json
+import threading
+from collections import Counter
+from time import time
+from diskcache import sha256_hex
+
+
+class CompletionCache:
+    # Chat completions for deterministic requests stored in the completion_cache table for ttl seconds.
+    # The least recently used entries are dropped once there are more than max_entries
+    def __init__(self, mdb, ttl=24 * 60 * 60, max_entries=10000):
+        self.mdb = mdb
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # Stats per model
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def is_deterministic(n=1, **params):
+        # Only greedy single completions are the same every time. A temperature that is not a number is left to OpenAI
+        try:
+            temperature = float(params.get('temperature'))
+        except (TypeError, ValueError):
+            return False
+        return n == 1 and not params.get('stream') and temperature == 0
+
+    @staticmethod
+    def make_key(messages, **params):
+        # Same model, messages and sampling parameters hash the same regardless of dict order or 0 vs 0.0
+        params = {key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+                  for key, value in params.items() if value is not None}
+        return sha256_hex(json.dumps([messages, params], sort_keys=True, separators=(',', ':')))
+
+    def get(self, cache_key, model):
+        response = self.mdb.get_cached_completion(cache_key, time() - self.ttl)
+        with self.lock:
+            if response is None:
+                self.misses[model] += 1
+            else:
+                self.hits[model] += 1
+        return response
+
+    def put(self, cache_key, model, response):
+        self.mdb.put_cached_completion(
+            cache_key, model, response, self.max_entries, time() - self.ttl)
+        return response
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for model in self.hits.keys() | self.misses.keys():
+                total = self.hits[model] + self.misses[model]
+                stats[model] = {
+                    'hits': self.hits[model],
+                    'misses': self.misses[model],
+                    'hit_rate': self.hits[model] / total if total else 0.0,
+                }
+            return stats
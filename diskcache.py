@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class DiskCache:
+    # Bytes stored one file per key under directory, evicting the least recently used files once
+    # the total is over max_bytes. Recency is tracked in memory and starts from file mtimes
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # file name -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, key, max_age=None):
+        # max_age is in seconds since the entry was written
+        name = sha256_hex(key)
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+        try:
+            if max_age is not None and time() - os.path.getmtime(self.path(name)) > max_age:
+                self.delete(key)
+                with self.lock:
+                    self.misses += 1
+                return None
+            with open(self.path(name), 'rb') as f:
+                value = f.read()
+        except FileNotFoundError:
+            self._forget(name)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return value
+        name = sha256_hex(key)
+        # Write then rename so readers never see a partial file
+        tmp_path = f'{self.path(name)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, self.path(name))
+
+        with self.lock:
+            self.total_bytes += len(value) - self.entries.pop(name, 0)
+            self.entries[name] = len(value)
+            self._evict()
+        return value
+
+    def delete(self, key):
+        name = sha256_hex(key)
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        self._forget(name)
+
+    def _forget(self, name):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(name, 0)
+
+    def _evict(self):
+        # Caller holds self.lock
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
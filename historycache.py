@@ -0,0 +1,162 @@
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from tokencounter import TOKENS_PER_MESSAGE
+
+# About the size of the message dict, its list slots and token total around each cached content string
+ENTRY_OVERHEAD_BYTES = 280
+
+
+class ConversationHistory:
+    # Ready to send {'role', 'content'} messages of one conversation after after_message_id, oldest first
+    __slots__ = ('after_message_id', 'last_message_id', 'message_ids', 'messages', 'token_totals', 'nbytes')
+
+    def __init__(self, after_message_id=0):
+        self.after_message_id = after_message_id
+        self.last_message_id = after_message_id
+        self.message_ids = []
+        self.messages = []
+        # token_totals[i] is the prompt tokens of messages[:i]
+        self.token_totals = [0]
+        self.nbytes = 0
+
+    def append(self, message_id, role, content, token_count):
+        # messages last so a concurrent fit never sees a message without its token total
+        self.token_totals.append(self.token_totals[-1] + token_count + TOKENS_PER_MESSAGE)
+        self.message_ids.append(message_id)
+        self.messages.append({'role': role, 'content': content})
+        nbytes = ENTRY_OVERHEAD_BYTES + sys.getsizeof(content)
+        self.nbytes += nbytes
+        return nbytes
+
+    def trim(self, after_message_id):
+        # Drops the messages folded into a newer summary. Returns the bytes freed
+        start = bisect_right(self.message_ids, after_message_id)
+        freed = sum(ENTRY_OVERHEAD_BYTES + sys.getsizeof(message['content']) for message in self.messages[:start])
+        dropped_tokens = self.token_totals[start]
+        del self.message_ids[:start], self.messages[:start]
+        self.token_totals = [total - dropped_tokens for total in self.token_totals[start:]]
+        self.after_message_id = after_message_id
+        self.last_message_id = max(self.last_message_id, after_message_id)
+        self.nbytes -= freed
+        return freed
+
+    def content_tokens(self):
+        # Tokens of the messages without the overhead of each message
+        return self.token_totals[len(self.messages)] - TOKENS_PER_MESSAGE * len(self.messages)
+
+    def fit(self, budget):
+        # The newest messages that fit in budget tokens, always including the newest one, and their tokens
+        end = len(self.messages)
+        if not end:
+            return [], 0
+        total = self.token_totals[end]
+        first = bisect_left(self.token_totals, total - budget, 0, end - 1)
+        return self.messages[first:end], total - self.token_totals[first]
+
+
+class HistoryCache:
+    # ConversationHistory per phone number, evicting the least recently used once the cached content is over max_bytes.
+    # role_fn(message, phone_number) names the role of a message in that conversation or None to leave it out
+    def __init__(self, max_bytes, role_fn):
+        self.max_bytes = max_bytes
+        self.role_fn = role_fn
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # phone_number -> token of the load in progress. Appends and invalidations remove it so a stale load is not cached
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+        self.evictions = 0
+
+    def get(self, phone_number, after_message_id=0):
+        with self.lock:
+            history = self.data.get(phone_number)
+            # A history starting after after_message_id is missing older messages
+            if history is None or history.after_message_id > after_message_id:
+                self.misses += 1
+                return None
+            if after_message_id > history.after_message_id:
+                self.nbytes -= history.trim(after_message_id)
+            self.data.move_to_end(phone_number)
+            self.hits += 1
+            return history
+
+    def load(self, phone_number, after_message_id, messages):
+        # Builds the history from messages, oldest first, and caches it unless the conversation changed meanwhile
+        with self.lock:
+            self.loading[phone_number] = token = object()
+        history = ConversationHistory(after_message_id)
+        for message in messages:
+            self._append(history, phone_number, message)
+
+        with self.lock:
+            if self.loading.get(phone_number) is token:
+                del self.loading[phone_number]
+                if history.nbytes <= self.max_bytes:
+                    self._remove(phone_number)
+                    self.data[phone_number] = history
+                    self.nbytes += history.nbytes
+                    self._evict()
+        return history
+
+    def append(self, message):
+        # Called for every stored message. Only conversations already in the cache are updated
+        with self.lock:
+            for phone_number in (message.from_phone_number, message.to_phone_number):
+                self.loading.pop(phone_number, None)
+                if (history := self.data.get(phone_number)) is None:
+                    continue
+                if message.message_id <= history.last_message_id:
+                    # Written out of order so the cached order would be wrong
+                    self._remove(phone_number)
+                    continue
+                self.nbytes += self._append(history, phone_number, message)
+                self.appends += 1
+            self._evict()
+
+    def invalidate(self, phone_number):
+        with self.lock:
+            self.loading.pop(phone_number, None)
+            self._remove(phone_number)
+
+    def clear(self):
+        with self.lock:
+            self.loading.clear()
+            self.data.clear()
+            self.nbytes = 0
+
+    def _append(self, history, phone_number, message):
+        history.last_message_id = message.message_id
+        if (role := self.role_fn(message, phone_number)) is None:
+            return 0
+        return history.append(message.message_id, role, message.body, message.token_count)
+
+    def _remove(self, phone_number):
+        # Caller holds self.lock
+        if (history := self.data.pop(phone_number, None)) is not None:
+            self.nbytes -= history.nbytes
+
+    def _evict(self):
+        # Caller holds self.lock
+        while self.nbytes > self.max_bytes and self.data:
+            _, history = self.data.popitem(last=False)
+            self.nbytes -= history.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'conversations': len(self.data),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'appends': self.appends,
+                'evictions': self.evictions,
+            }
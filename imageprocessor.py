@@ -1,15 +1,102 @@
+import logging
+import threading
 from io import BytesIO
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+from diskcache import sha256_hex
+import metrics
+
+logger = logging.getLogger(__name__)
 
 MAX_IMAGE_BYTES = 1024 * 1024 * 4  # 4MB
 VALID_SIZES = [256, 512, 1024]
 
-
-def download_image(url):
-    response = requests.Session().get(url)
-    response.raise_for_status()
-    return response.content
+# Twilio MMS media is at most 5MB so anything bigger is rejected while downloading
+MAX_DOWNLOAD_BYTES = 1024 * 1024 * 5
+# Checked from the header before decoding. 4096x4096 RGBA is 64MB decoded
+MAX_IMAGE_PIXELS = 4096 * 4096
+VALID_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP', 'BMP'}
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# (connect, read) seconds
+DOWNLOAD_TIMEOUT = (5, 30)
+DOWNLOAD_POOL_SIZE = 8
+
+session = None
+session_lock = threading.Lock()
+
+# Stats
+stats_lock = threading.Lock()
+download_stats = {
+    'downloads': 0,
+    'bytes_downloaded': 0,
+    'max_download_bytes': 0,
+    'max_decoded_bytes': 0,
+    'rejected_too_large': 0,
+    'rejected_header': 0,
+}
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def get_session():
+    # One pooled session shared by every download so connections to the media host are reused
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE,
+                                  pool_maxsize=DOWNLOAD_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+
+def record_stat(key, value=1, maximum=False):
+    with stats_lock:
+        if maximum:
+            download_stats[key] = max(download_stats[key], value)
+        else:
+            download_stats[key] += value
+
+
+def get_download_stats():
+    with stats_lock:
+        return dict(download_stats)
+
+
+def download_image(url, max_bytes=MAX_DOWNLOAD_BYTES, timeout=DOWNLOAD_TIMEOUT):
+    # Streams the body and gives up as soon as it is known to be over max_bytes
+    with get_session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        if (content_length := int(response.headers.get('Content-Length') or 0)) > max_bytes:
+            record_stat('rejected_too_large')
+            raise ImageTooLargeError(
+                f'Image is too large ({content_length} bytes). Max download size is {max_bytes} bytes.')
+
+        image_bytes = bytearray()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            image_bytes += chunk
+            if len(image_bytes) > max_bytes:
+                record_stat('rejected_too_large')
+                raise ImageTooLargeError(
+                    f'Image is too large (over {max_bytes} bytes). Max download size is {max_bytes} bytes.')
+
+    record_stat('downloads')
+    record_stat('bytes_downloaded', len(image_bytes))
+    record_stat('max_download_bytes', len(image_bytes), maximum=True)
+    return bytes(image_bytes)
+
+
+def check_image_header(img_obj):
+    # Image.open only reads the header so this runs before any pixels are decoded
+    if img_obj.format not in VALID_FORMATS:
+        raise ValueError(f'Unsupported image format {img_obj.format}')
+    if img_obj.width * img_obj.height > MAX_IMAGE_PIXELS:
+        raise ValueError(
+            f'Image is too large ({img_obj.width}x{img_obj.height}). Max is {MAX_IMAGE_PIXELS} pixels.')
 
 
 def make_image_object(image_bytes):
@@ -17,91 +104,144 @@ def make_image_object(image_bytes):
     return img_obj
 
 
-def convert_to_PNG_in_RGBA_mode(img_obj):
-    if img_obj.mode not in ['RGBA', 'LA', 'L']:
-        img_obj = img_obj.convert('RGBA')
-
+def encode_PNG(img_obj):
     with BytesIO() as png_buffer:
         img_obj.save(png_buffer, format="PNG")
-        png_image_bytes = png_buffer.getvalue()
-        png_img_obj = make_image_object(png_image_bytes)
+        return png_buffer.getvalue()
 
-    return png_image_bytes, png_img_obj
 
+def make_transparent_mask(size):
+    return encode_PNG(Image.new('RGBA', (size, size), color=(0, 0, 0, 0)))
 
-def resize_to_closest_smaller_square(img_obj):
-    original_width, original_height = img_obj.size
 
-    # Find the closest smaller square size
-    closest_size = min(size for size in VALID_SIZES if size < original_width)
+# Every mask is the same fully transparent square so each size is only ever encoded once
+TRANSPARENT_MASKS = {size: make_transparent_mask(size) for size in VALID_SIZES}
+
+
+def get_mask_bytes(size):
+    if (mask_bytes := TRANSPARENT_MASKS.get(size)) is None:
+        mask_bytes = make_transparent_mask(size)
+    return mask_bytes
+
+
+def get_target_size(width, height):
+    # Largest valid size that is not bigger than the image, or the smallest valid size for tiny images
+    return max((size for size in VALID_SIZES if size <= max(width, height)), default=VALID_SIZES[0])
+
 
-    # Calculate the new dimensions to maintain the aspect ratio and fit inside the square
-    new_width = new_height = closest_size
+def resize_to_square(img_obj, size):
+    # Fit inside the square keeping the aspect ratio and pad the rest with transparency
+    original_width, original_height = img_obj.size
+    new_width = new_height = size
     if original_width > original_height:
-        new_height = int(closest_size * original_height / original_width)
+        new_height = max(1, int(size * original_height / original_width))
     else:
-        new_width = int(closest_size * original_width / original_height)
+        new_width = max(1, int(size * original_width / original_height))
 
-    # Resize the image to the closest smaller square
     resized_img_obj = img_obj.resize((new_width, new_height))
-    return resized_img_obj
+    if resized_img_obj.size == (size, size):
+        return resized_img_obj
+    square_img_obj = Image.new('RGBA', (size, size), color=(0, 0, 0, 0))
+    square_img_obj.paste(
+        resized_img_obj, ((size - new_width) // 2, (size - new_height) // 2))
+    return square_img_obj
+
+
+def normalize_image(image_bytes):
+    # Decodes once, resizes and converts in memory and encodes to PNG at most once.
+    # Only takes and returns bytes so it can run in a process pool. Returns (png_bytes, size)
+    img_obj = make_image_object(image_bytes)
+    check_image_header(img_obj)
+    size = get_target_size(img_obj.width, img_obj.height)
+    if img_obj.format == 'PNG' and img_obj.size == (size, size) and img_obj.mode in ('RGBA', 'LA', 'L'):
+        # Already valid so send the original bytes
+        return image_bytes, size
+
+    # JPEGs can be decoded at a reduced scale when they are much larger than the target
+    img_obj.draft('RGB', (size, size))
+    if img_obj.mode != 'RGBA':
+        img_obj = img_obj.convert('RGBA')
+    if img_obj.size != (size, size):
+        img_obj = resize_to_square(img_obj, size)
+    return encode_PNG(img_obj), size
 
 
-def get_mask_bytes(img_obj):
-    mask_img_obj = Image.new('RGBA', img_obj.size, color=(0, 0, 0, 0))
-    # mask_img_obj.putalpha(img_obj.split()[3])
-    mask_bytes, mask_img_obj = convert_to_PNG_in_RGBA_mode(
-        mask_img_obj)  # Convert to PNG in RGBA mode
-    return mask_bytes
+def get_cached_image(cache, digest):
+    # Normalized PNG for the raw image with this SHA-256 and the mask for its size
+    if (image_bytes := cache.get(f'png:{digest}')) is None:
+        return None
+    return image_bytes, get_mask_bytes(make_image_object(image_bytes).width)
 
 
-def get_image_bytes_if_valid(url):
-    # Only return bytes if the image at url is valid otherwise return error_string
+@metrics.timed('image')
+def get_image_bytes_if_valid(url, executor=None, cache=None):
+    # Returns (image_bytes, mask_bytes) if the image at url is valid otherwise (error_string, None).
+    # Normalizing runs in executor when given, ie a ProcessPoolExecutor so decoding does not hold the GIL.
+    # cache is a DiskCache mapping media urls to SHA-256s of the raw bytes and those to normalized PNGs
+    if cache is not None and (digest := cache.get(f'url:{url}')) is not None:
+        if (cached := get_cached_image(cache, digest.decode())) is not None:
+            logger.debug("Using cached image for %s.", url)
+            return cached
+
     try:
-        image_bytes = download_image(url)
-        print(f"Downloaded {len(image_bytes)} bytes of image data.")
+        with metrics.span('image', 'download'):
+            image_bytes = download_image(url)
+        logger.debug("Downloaded %d bytes of image data.", len(image_bytes))
+    except ImageTooLargeError as e:
+        error_string = str(e)
+        logger.warning(error_string)
+        return error_string, None
     except requests.exceptions.RequestException as e:
         error_string = 'Error downloading image:'
-        print(error_string, e)
-        return error_string
+        logger.warning('%s %r', error_string, e)
+        return error_string, None
+
+    if cache is not None:
+        # The same attachment can arrive under another url
+        digest = sha256_hex(image_bytes)
+        cache.put(f'url:{url}', digest.encode())
+        if (cached := get_cached_image(cache, digest)) is not None:
+            logger.debug("Using cached image for %s.", digest)
+            return cached
 
     try:
         img_obj = make_image_object(image_bytes)
-        print(
-            f"Image is {img_obj.width}x{img_obj.height} and {img_obj.format}.")
+        logger.debug("Image is %dx%d and %s.", img_obj.width, img_obj.height, img_obj.format)
     except Exception as e:
         error_string = 'Error processing image with Pillow'
-        print(error_string, e)
-        return error_string
-
-    if img_obj.width != img_obj.height or img_obj.width not in VALID_SIZES or img_obj.height not in VALID_SIZES:
-        print(f"Invalid image dimensions: {img_obj.width}x{img_obj.height}")
-        try:
-            img_obj = resize_to_closest_smaller_square(img_obj)
-            print(f"Resized image to {img_obj.width}x{img_obj.height}.")
-        except Exception as e:
-            error_string = 'Error resizing image'
-            print(error_string, e)
-            return error_string
-
-    if img_obj.format != 'PNG':
-        print(f"Invalid image format: {img_obj.format}")
-        try:
-            image_bytes, img_obj = convert_to_PNG_in_RGBA_mode(img_obj)
-            print(f"Converted image to {img_obj.format}.")
-        except Exception as e:
-            error_string = 'Error converting image to PNG'
-            print(error_string, e)
-            return error_string
+        logger.warning('%s %r', error_string, e)
+        return error_string, None
+
+    try:
+        check_image_header(img_obj)
+    except ValueError as e:
+        record_stat('rejected_header')
+        error_string = f'Invalid image: {e}'
+        logger.warning(error_string)
+        return error_string, None
+    # Decoded size is bounded by MAX_IMAGE_PIXELS
+    record_stat('max_decoded_bytes', img_obj.width * img_obj.height * 4, maximum=True)
+
+    try:
+        with metrics.span('image', 'normalize'):
+            if executor is not None:
+                image_bytes, size = executor.submit(
+                    normalize_image, image_bytes).result()
+            else:
+                image_bytes, size = normalize_image(image_bytes)
+        logger.debug("Normalized image to a %dx%d PNG.", size, size)
+    except Exception as e:
+        error_string = 'Error converting image to PNG'
+        logger.warning('%s %r', error_string, e)
+        return error_string, None
 
     num_bytes = len(image_bytes)
     # Check that the image is valid
     if num_bytes > MAX_IMAGE_BYTES:
         error_string = f"Image is too large ({num_bytes} bytes). Max size is 4MB ({MAX_IMAGE_BYTES} bytes)."
-        print(error_string, e)
-        return error_string
-
-    # Get the mask bytes but only if the image is valid to save time
-    mask_bytes = get_mask_bytes(img_obj)
+        logger.warning(error_string)
+        return error_string, None
 
-    return image_bytes, mask_bytes
+    if cache is not None:
+        cache.put(f'png:{digest}', image_bytes)
+    return image_bytes, get_mask_bytes(size)
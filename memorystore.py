@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+import openai
+from diskcache import sha256_hex
+from lrucache import LRUCache
+
+WORD_RE = re.compile(r'\w+')
+
+
+class HashingEmbedder:
+    # Deterministic local embedding. Words and word pairs are hashed into dim signed buckets so texts sharing
+    # words point the same way. Needs no network or model, which keeps tests and offline runs working
+    name = 'hashing'
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def features(self, text):
+        words = WORD_RE.findall(text.lower())
+        return words + [f'{first} {second}' for first, second in zip(words, words[1:])]
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            if not (features := self.features(text)):
+                continue
+            hashes = np.array([int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+                               for feature in features], dtype=np.uint64)
+            signs = np.where(hashes >> np.uint64(63), 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], (hashes % np.uint64(self.dim)).astype(np.intp), signs)
+        return vectors
+
+
+class OpenAIEmbedder:
+    # Embeddings from the OpenAI API through an OpenAIClient so they get its timeouts, retries and circuit breaker
+    name = 'openai'
+
+    def __init__(self, client, model='text-embedding-ada-002', dim=1536):
+        self.client = client
+        self.model = model
+        self.dim = dim
+
+    def __call__(self, texts):
+        response = self.client.call(openai.Embedding.create, model=self.model, input=list(texts))
+        data = sorted(response['data'], key=lambda item: item['index'])
+        return np.array([item['embedding'] for item in data], dtype=np.float32)
+
+
+class MemoryStore:
+    # Unit length float32 embeddings of each conversation's messages. Every phone number has a vectors file of
+    # dim float32 per row, memory-mapped for search, and an ids file of the int64 message_id of each row
+    def __init__(self, directory, embedder, max_open=256):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        # Vectors from another embedder or size are not comparable so each gets its own directory
+        self.directory = os.path.join(directory, f'{embedder.name}-{embedder.dim}')
+        self.lock = threading.Lock()
+        # phone_number -> (rows, vectors, ids) of the files as last opened
+        self.open_files = LRUCache(max_open)
+
+        # Stats
+        self.added = 0
+        self.searches = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_paths(self, phone_number):
+        name = sha256_hex(phone_number)[:32]
+        return os.path.join(self.directory, f'{name}.f32'), os.path.join(self.directory, f'{name}.ids')
+
+    def embed(self, texts):
+        vectors = np.asarray(self.embedder(texts), dtype=np.float32).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    def add(self, phone_number, message_ids, texts):
+        vectors = self.embed(texts)
+        vectors_path, ids_path = self.get_paths(phone_number)
+        with self.lock:
+            # Vectors are written first so a crash in between leaves a row without an id, which is ignored
+            with open(vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(ids_path, 'ab') as f:
+                f.write(np.asarray(message_ids, dtype=np.int64).tobytes())
+            self.added += len(message_ids)
+
+    def load(self, phone_number):
+        # (vectors, ids) of every complete row, reopening the memmap only when rows were added since
+        vectors_path, ids_path = self.get_paths(phone_number)
+        try:
+            rows = min(os.path.getsize(vectors_path) // (self.dim * 4), os.path.getsize(ids_path) // 8)
+        except FileNotFoundError:
+            return None, None
+        if not rows:
+            return None, None
+        if (cached := self.open_files.get(phone_number)) is not None and cached[0] == rows:
+            return cached[1], cached[2]
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        ids = np.fromfile(ids_path, dtype=np.int64, count=rows)
+        self.open_files.put(phone_number, (rows, vectors, ids))
+        return vectors, ids
+
+    def search(self, phone_number, text, k, after_message_id=0, before_message_id=None, message_id=None):
+        # [(message_id, similarity)] of the k stored messages between the ids most similar to text, best first.
+        # message_id names the stored message text came from so its vector is reused instead of embedding it again
+        vectors, ids = self.load(phone_number)
+        if vectors is None or k <= 0:
+            return []
+        self.searches += 1
+
+        query = None
+        if message_id is not None and len(query_rows := np.flatnonzero(ids == message_id)):
+            query = vectors[query_rows[-1]]
+        if query is None:
+            query = self.embed([text])[0]
+
+        mask = ids > after_message_id
+        if before_message_id is not None:
+            mask &= ids < before_message_id
+        if not (candidates := np.flatnonzero(mask)).size:
+            return []
+        # Rows are unit length so the dot product is the cosine similarity. Rows are appended in message order
+        # so the candidates are usually one slice of the memmap, which avoids copying them
+        first, last = candidates[0], candidates[-1]
+        rows = vectors[first:last + 1] if last - first + 1 == candidates.size else vectors[candidates]
+        scores = np.asarray(rows @ query)
+        if candidates.size > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(candidates.size)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(ids[candidates[i]]), float(scores[i])) for i in top if scores[i] > 0]
+
+    def delete(self, phone_number):
+        with self.lock:
+            for path in self.get_paths(phone_number):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.open_files.pop(phone_number)
+
+    def stats(self):
+        return {
+            'added': self.added,
+            'searches': self.searches,
+            'open_files': len(self.open_files),
+        }
@@ -1,12 +1,390 @@
+import atexit
+import heapq
+import logging
 import sqlite3
+import threading
+from collections import Counter
 from datetime import datetime
+from itertools import islice
+from operator import attrgetter
+from time import monotonic, time
+from tokencounter import count_tokens, get_context_window
+from lrucache import LRUCache
+from metrics import instrument_methods
 
+logger = logging.getLogger(__name__)
 
+# Rows fetched at a time when streaming a conversation
+MESSAGE_BATCH_SIZE = 64
+
+
+def dedupe_statements(table, id_column, value_column, references):
+    # Point every reference to a duplicate row at the first row with the same value then drop the duplicates
+    canonical_id = f'''(
+        SELECT MIN(canonical.{id_column}) FROM {table} AS canonical
+        JOIN {table} AS duplicate ON canonical.{value_column} = duplicate.{value_column}
+        WHERE duplicate.{id_column} = {{ref_table}}.{{ref_column}}
+    )'''
+    duplicate_ids = f'''(
+        SELECT {id_column} FROM {table}
+        WHERE {id_column} NOT IN (SELECT MIN({id_column}) FROM {table} GROUP BY {value_column})
+    )'''
+
+    statements = []
+    for ref_table, ref_column in references:
+        statements.append(
+            f'UPDATE OR IGNORE {ref_table} SET {ref_column} = {canonical_id.format(ref_table=ref_table, ref_column=ref_column)} '
+            f'WHERE {ref_column} IN {duplicate_ids}')
+    statements.append(f'DELETE FROM {table} WHERE {id_column} IN {duplicate_ids}')
+    return statements
+
+
+# Ordered (version, description, statements) applied by MessageDB.migrate. Never edit an applied migration, add a new one.
+MIGRATIONS = [
+    (1, 'Unique phone numbers, models and system prompts', [
+        *dedupe_statements('phone_numbers', 'phone_id', 'phone_number',
+                           [('messages', 'from_phone_id'), ('messages', 'to_phone_id'), ('settings', 'phone_id')]),
+        # Settings of a duplicate number are dropped when the first number already has settings
+        'DELETE FROM settings WHERE phone_id NOT IN (SELECT phone_id FROM phone_numbers)',
+        *dedupe_statements('models', 'model_id', 'model_name',
+                           [('settings', 'model_id')]),
+        *dedupe_statements('system_prompts', 'system_prompt_id', 'system_prompt',
+                           [('settings', 'system_prompt_id')]),
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_phone_numbers_phone_number ON phone_numbers (phone_number)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_models_model_name ON models (model_name)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_system_prompts_system_prompt ON system_prompts (system_prompt)',
+    ]),
+    (2, 'Conversation indexes on messages', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_from_phone_id ON messages (from_phone_id, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_to_phone_id ON messages (to_phone_id, message_id)',
+    ]),
+    (3, 'Message token counts and model context windows', [
+        'ALTER TABLE messages ADD COLUMN token_count INTEGER',
+        'ALTER TABLE models ADD COLUMN context_window INTEGER',
+    ]),
+    (4, 'Rolling conversation summaries', [
+        '''CREATE TABLE IF NOT EXISTS summaries (
+            phone_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_message_id INTEGER,
+            token_count INTEGER,
+            updated_at TEXT,
+            FOREIGN KEY (phone_id) REFERENCES phone_numbers (phone_id)
+        )''',
+    ]),
+    (5, 'Outgoing message segments', [
+        '''CREATE TABLE IF NOT EXISTS message_segments (
+            message_id INTEGER,
+            sequence INTEGER,
+            segment_sid TEXT,
+            body TEXT,
+            PRIMARY KEY (message_id, sequence),
+            FOREIGN KEY (message_id) REFERENCES messages (message_id)
+        )''',
+    ]),
+    (6, 'Model catalog fetch times', [
+        'ALTER TABLE models ADD COLUMN fetched_at REAL',
+    ]),
+    (7, 'Daily token usage per phone number and model', [
+        '''CREATE TABLE IF NOT EXISTS usage (
+            phone_id INTEGER,
+            model_name TEXT,
+            day TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            PRIMARY KEY (phone_id, model_name, day),
+            FOREIGN KEY (phone_id) REFERENCES phone_numbers (phone_id)
+        )''',
+    ]),
+    (8, 'Cache of deterministic chat completions', [
+        '''CREATE TABLE IF NOT EXISTS completion_cache (
+            cache_key TEXT PRIMARY KEY,
+            model_name TEXT,
+            response TEXT,
+            created_at REAL,
+            last_used_at REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_completion_cache_last_used_at ON completion_cache (last_used_at)',
+    ]),
+    # Twilio redelivers a webhook with the same MessageSid when it is slow or fails. Keep the first copy
+    (9, 'Unique message SIDs', [
+        '''DELETE FROM message_segments WHERE message_id IN (
+            SELECT message_id FROM messages WHERE message_sid IS NOT NULL AND message_id NOT IN (
+                SELECT MIN(message_id) FROM messages WHERE message_sid IS NOT NULL GROUP BY message_sid))''',
+        '''DELETE FROM messages WHERE message_sid IS NOT NULL AND message_id NOT IN (
+            SELECT MIN(message_id) FROM messages WHERE message_sid IS NOT NULL GROUP BY message_sid)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_message_sid ON messages (message_sid)',
+    ]),
+    # Text timestamps were written in local time. Reading them back no longer needs strptime
+    (10, 'Message times as unix epochs', [
+        'ALTER TABLE messages ADD COLUMN created_at INTEGER',
+        "UPDATE messages SET created_at = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE timestamp IS NOT NULL",
+    ]),
+]
+
+
+class WriteBehindJournal:
+    # Queues writes in memory and commits them in batches every flush_interval seconds or flush_max_rows statements
+    def __init__(self, mdb, flush_interval=0.05, flush_max_rows=100):
+        self.mdb = mdb
+        self.flush_interval = flush_interval
+        self.flush_max_rows = flush_max_rows
+        # Each entry is (statements, keys, message). keys like ('settings', phone_number) say what a read has to wait for
+        self.entries = []
+        self.inflight = []
+        self.pending_keys = Counter()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        # Message ids are handed out before the row is written so the journal assumes a single writer process
+        self.mdb.cursor.execute('SELECT COALESCE(MAX(message_id), 0) FROM messages')
+        self.last_message_id = self.mdb.cursor.fetchone()[0]
+
+        # Stats
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.dropped_entries = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.total_flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self.thread = threading.Thread(
+            target=self._run, name='messagedb-journal', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def next_message_id(self):
+        with self.lock:
+            self.last_message_id += 1
+            return self.last_message_id
+
+    def append(self, statements, keys=(), message=None):
+        with self.lock:
+            self.entries.append((statements, keys, message))
+            self.pending_keys.update(keys)
+            num_rows = sum(len(statements) for statements, _, _ in self.entries)
+        if num_rows >= self.flush_max_rows:
+            self.wakeup.set()
+
+    def has_pending(self, key=None):
+        with self.lock:
+            if key is None:
+                return bool(self.entries or self.inflight)
+            return self.pending_keys[key] > 0
+
+    def pending_messages(self, phone_number, after_message_id=0):
+        # Messages not committed yet, including a batch being flushed
+        with self.lock:
+            return [message for _, _, message in self.inflight + self.entries
+                    if message is not None and message.message_id > after_message_id
+                    and phone_number in (message.from_phone_number, message.to_phone_number)]
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Error flushing journal: %r", e)
+
+    def _finish(self, batch):
+        # Caller holds self.lock
+        self.inflight = []
+        for _, keys, _ in batch:
+            self.pending_keys.subtract(keys)
+
+    def _drop(self, entry, error):
+        # Callers were already handed what the entry writes, so forget anything cached from it
+        statements, keys, message = entry
+        logger.error("Dropped journal entry of %d statements for %s: %r", len(statements), list(keys), error)
+        for kind, value in keys:
+            if kind == 'settings':
+                self.mdb.caches['settings'].pop(value)
+        if message is not None and self.mdb.history_cache is not None:
+            self.mdb.history_cache.invalidate(message.from_phone_number)
+            self.mdb.history_cache.invalidate(message.to_phone_number)
+
+    def flush(self):
+        # Holding flush_lock until the commit makes readers wait for an in flight batch too
+        with self.flush_lock:
+            with self.lock:
+                batch, self.entries = self.entries, []
+                self.inflight = batch
+            if not batch:
+                return 0
+
+            start = monotonic()
+            conn, cursor = self.mdb.conn, self.mdb.cursor
+            dropped = []
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                for entry in batch:
+                    # One bad entry is rolled back on its own instead of taking the rest of the batch with it
+                    cursor.execute('SAVEPOINT journal_entry')
+                    try:
+                        for sql, params in entry[0]:
+                            cursor.execute(sql, params)
+                    except sqlite3.OperationalError:
+                        raise
+                    except sqlite3.Error as e:
+                        cursor.execute('ROLLBACK TO journal_entry')
+                        dropped.append((entry, e))
+                    cursor.execute('RELEASE journal_entry')
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Transient errors like a locked db keep the batch for the next flush
+                conn.rollback()
+                with self.lock:
+                    self.inflight = []
+                    self.entries[:0] = batch
+                raise
+            except Exception:
+                conn.rollback()
+                with self.lock:
+                    self._finish(batch)
+                raise
+
+            flush_seconds = monotonic() - start
+            batch_size = sum(len(statements) for statements, _, _ in batch)
+            for entry, e in dropped:
+                self._drop(entry, e)
+            with self.lock:
+                self._finish(batch)
+                self.dropped_entries += len(dropped)
+                self.flushes += 1
+                self.rows_flushed += batch_size
+                self.last_batch_size = batch_size
+                self.max_batch_size = max(self.max_batch_size, batch_size)
+                self.total_flush_seconds += flush_seconds
+                self.last_flush_seconds = flush_seconds
+                self.max_flush_seconds = max(self.max_flush_seconds, flush_seconds)
+            return batch_size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending_rows': sum(len(statements) for statements, _, _ in self.entries),
+                'flushes': self.flushes,
+                'rows_flushed': self.rows_flushed,
+                'dropped_entries': self.dropped_entries,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'avg_batch_size': self.rows_flushed / self.flushes if self.flushes else 0.0,
+                'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+            }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+
+# Generators are left out since their time is spent by whoever consumes them
+@instrument_methods('db', exclude=('connect', 'close', 'cache_stats', 'clear_caches', 'create_tables', 'migrate',
+                                   'get_schema_version', 'iter_messages_for_phone_number'))
 class MessageDB:
-    def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_name, timeout=30.0, write_behind=False, flush_interval=0.05, flush_max_rows=100,
+                 cache_size=1024, cache_enabled=True, history_cache=None):
+        self.db_name = db_name
+        self.timeout = timeout
+        self.local = threading.local()
+        # Maps each open connection to the thread currently using it
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        # An in-memory db only exists inside the connection that created it so every thread shares it
+        self.shared_conn = self.connect() if db_name == ':memory:' else None
+        # Lookups that almost never change. Writes invalidate the affected entries
+        self.caches = {name: LRUCache(cache_size, cache_enabled) for name in (
+            'phone_ids', 'model_ids', 'model_names', 'system_prompt_ids', 'system_prompts', 'context_windows', 'settings')}
+        # Makes checking for a pending or stored SID and queueing the insert one step in write-behind mode
+        self.message_sid_lock = threading.RLock()
+        # Optional HistoryCache of hot conversations that add_message appends to
+        self.history_cache = history_cache
+        self.duplicate_messages = 0
         self.create_tables()
+        self.migrate()
+        self.journal = WriteBehindJournal(
+            self, flush_interval, flush_max_rows) if write_behind else None
+
+    def _write(self, statements, keys=(), message=None):
+        # statements is a list of (sql, params) written in one transaction now or later by the journal
+        if self.journal is not None:
+            return self.journal.append(statements, keys, message)
+        try:
+            for sql, params in statements:
+                self.cursor.execute(sql, params)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _read_your_writes(self, key=None):
+        # Flush before reading anything the journal still holds for key, or anything at all when None
+        if self.journal is not None and self.journal.has_pending(key):
+            self.journal.flush()
+
+    def flush(self):
+        if self.journal is not None:
+            return self.journal.flush()
+        return 0
+
+#### CACHES ####
+    def cache_stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def clear_caches(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+#### CONNECTIONS ####
+    def connect(self):
+        conn = sqlite3.connect(
+            self.db_name, timeout=self.timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.timeout * 1000)}')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        logger.info("Opened connection to '%s'.", self.db_name)
+        return conn
+
+    def _checkout_connection(self):
+        current_thread = threading.current_thread()
+        if self.shared_conn is not None:
+            return self.shared_conn
+
+        with self.connections_lock:
+            # Reuse a connection left behind by a thread that has exited before opening a new one
+            for conn, owner in self.connections.items():
+                if not owner.is_alive():
+                    self.connections[conn] = current_thread
+                    return conn
+
+        conn = self.connect()
+        with self.connections_lock:
+            self.connections[conn] = current_thread
+        return conn
+
+    @property
+    def conn(self):
+        if (conn := getattr(self.local, 'conn', None)) is None:
+            conn = self.local.conn = self._checkout_connection()
+            self.local.cursor = conn.cursor()
+        return conn
+
+    @property
+    def cursor(self):
+        self.conn
+        return self.local.cursor
 
     def create_tables(self):
         self.cursor.execute('''
@@ -62,86 +440,289 @@ class MessageDB:
 
         self.conn.commit()
 
+    def get_schema_version(self):
+        self.cursor.execute('SELECT MAX(version) FROM schema_version')
+        return self.cursor.fetchone()[0] or 0
+
+    def migrate(self, migrations=MIGRATIONS):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT
+            )
+        ''')
+        self.conn.commit()
+
+        for version, description, statements in migrations:
+            if version <= self.get_schema_version():
+                continue
+
+            # Take the write lock first so concurrent processes cannot apply the same migration twice
+            self.cursor.execute('BEGIN IMMEDIATE')
+            try:
+                if version <= self.get_schema_version():
+                    self.conn.rollback()
+                    continue
+                for statement in statements:
+                    self.cursor.execute(statement)
+                self.cursor.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                                    (version, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            logger.info("Applied migration %s: %s", version, description)
+
+        return self.get_schema_version()
+
 #### GETTING IDs FROM VALUES####
     def get_phone_id(self, phone_number):
+        if (phone_id := self.caches['phone_ids'].get(phone_number)) is not None:
+            return phone_id
+        self._read_your_writes(('phone_numbers', phone_number))
         self.cursor.execute(
             'SELECT phone_id FROM phone_numbers WHERE phone_number = ?', (phone_number,))
         if result := self.cursor.fetchone():
-            return result[0]
+            return self.caches['phone_ids'].put(phone_number, result[0])
         else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+            logger.debug("Phone number '%s' not found.", phone_number)
             return None
 
     def get_system_prompt_id(self, system_prompt):
+        if (system_prompt_id := self.caches['system_prompt_ids'].get(system_prompt)) is not None:
+            return system_prompt_id
         self.cursor.execute(
             'SELECT system_prompt_id FROM system_prompts WHERE system_prompt = ?', (system_prompt,))
         if result := self.cursor.fetchone():
-            return result[0]
+            return self.caches['system_prompt_ids'].put(system_prompt, result[0])
         else:
-            print(f"[DB]: System prompt '{system_prompt}' not found.")
+            logger.debug("System prompt '%s' not found.", system_prompt)
             return None
 
     def get_model_id(self, model_name):
+        if (model_id := self.caches['model_ids'].get(model_name)) is not None:
+            return model_id
         self.cursor.execute(
             'SELECT model_id FROM models WHERE model_name = ?', (model_name,))
         if result := self.cursor.fetchone():
-            return result[0]
+            return self.caches['model_ids'].put(model_name, result[0])
         else:
-            print(f"[DB]: Model '{model_name}' not found.")
+            logger.debug("Model '%s' not found.", model_name)
             return None
 
 #### ADDING TO DB ####
-    def add_phone_number(self, phone_number):
-        if (phone_id := self.get_phone_id(phone_number)) is not None:
-            print(
-                f"[DB]: Phone number '{phone_number}' already exists in the database.")
+    def add_phone_number(self, phone_number, commit=True):
+        if (phone_id := self.caches['phone_ids'].get(phone_number)) is not None:
             return phone_id
-        self.cursor.execute(
-            'INSERT INTO phone_numbers (phone_number) VALUES (?)', (phone_number,))
-        self.conn.commit()
-        phone_id = self.cursor.lastrowid
-        print(
-            f"[DB]: Phone number '{phone_number}' added successfully. Phone ID: {phone_id}")
-        return phone_id
-
-    def add_message(self, message_sid, from_phone_number, to_phone_number, body):
-        from_phone_id = self.add_phone_number(from_phone_number)
-        to_phone_id = self.add_phone_number(to_phone_number)
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # The no-op update makes RETURNING give the existing id on conflict
         self.cursor.execute('''
-            INSERT INTO messages (message_sid, from_phone_id, to_phone_id, body, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (message_sid, from_phone_id, to_phone_id, body, timestamp))
-        self.conn.commit()
-        message_id = self.cursor.lastrowid
-        print(f"[DB]: Message added successfully. Message ID: {message_id}")
-        return Message(message_id, message_id, from_phone_number, to_phone_number, body, timestamp)
+            INSERT INTO phone_numbers (phone_number) VALUES (?)
+            ON CONFLICT (phone_number) DO UPDATE SET phone_number = excluded.phone_number
+            RETURNING phone_id
+        ''', (phone_number,))
+        phone_id = self.cursor.fetchone()[0]
+        if commit:
+            self.conn.commit()
+        logger.debug(
+            "Phone number '%s' added successfully. Phone ID: %s", phone_number, phone_id)
+        return self.caches['phone_ids'].put(phone_number, phone_id)
+
+    def add_message(self, message_sid, from_phone_number, to_phone_number, body, segments=None, ignore_duplicate=False):
+        # segments is an optional list of (segment_sid, segment_body) the message was sent as, in order.
+        # Everything is written in one transaction. With ignore_duplicate a message_sid that is already stored
+        # returns None instead of raising sqlite3.IntegrityError
+        created_at = int(time())
+        token_count = count_tokens(body)
+        if self.journal is not None:
+            with self.message_sid_lock:
+                if ignore_duplicate and self._is_duplicate_message_sid(message_sid):
+                    return self._duplicate_message(message_sid)
+                message_id = self.journal.next_message_id()
+                message = Message(message_id, message_sid, from_phone_number,
+                                  to_phone_number, body, created_at, token_count)
+                self._write(self._add_message_statements(
+                    message_id, message_sid, from_phone_number, to_phone_number, body, created_at, token_count, segments),
+                    keys=(('phone_numbers', from_phone_number), ('phone_numbers', to_phone_number),
+                          ('messages', from_phone_number), ('messages', to_phone_number),
+                          ('message_sid', message_sid)),
+                    message=message)
+                # Appended under the lock so cached conversations stay in message_id order
+                if self.history_cache is not None:
+                    self.history_cache.append(message)
+            return message
+
+        try:
+            from_phone_id = self.add_phone_number(
+                from_phone_number, commit=False)
+            to_phone_id = self.add_phone_number(to_phone_number, commit=False)
+            # The unique index makes the insert and the duplicate check one atomic step
+            self.cursor.execute(f'''
+                INSERT INTO messages (message_sid, from_phone_id, to_phone_id, body, created_at, token_count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                {'ON CONFLICT (message_sid) DO NOTHING' if ignore_duplicate else ''}
+            ''', (message_sid, from_phone_id, to_phone_id, body, created_at, token_count))
+            if self.cursor.rowcount == 0:
+                self.conn.commit()
+                return self._duplicate_message(message_sid)
+            message_id = self.cursor.lastrowid
+            if segments:
+                self.cursor.executemany('''
+                    INSERT INTO message_segments (message_id, sequence, segment_sid, body)
+                    VALUES (?, ?, ?, ?)
+                ''', [(message_id, sequence, segment_sid, segment_body)
+                      for sequence, (segment_sid, segment_body) in enumerate(segments)])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            # A phone number inserted by the rolled back transaction does not exist
+            self.caches['phone_ids'].pop(from_phone_number)
+            self.caches['phone_ids'].pop(to_phone_number)
+            raise
+        logger.debug("Message added successfully. Message ID: %s", message_id)
+        message = Message(message_id, message_sid, from_phone_number, to_phone_number, body, created_at, token_count)
+        if self.history_cache is not None:
+            self.history_cache.append(message)
+        return message
+
+    def has_message_sid(self, message_sid):
+        # Whether a message with message_sid is stored or queued to be
+        if self.journal is not None:
+            with self.message_sid_lock:
+                return self._is_duplicate_message_sid(message_sid)
+        self.cursor.execute('SELECT 1 FROM messages WHERE message_sid = ?', (message_sid,))
+        return self.cursor.fetchone() is not None
+
+    def _is_duplicate_message_sid(self, message_sid):
+        # Caller holds self.message_sid_lock. The journal assumes a single writer so nothing else can insert it
+        if message_sid is None:
+            return False
+        if self.journal.has_pending(('message_sid', message_sid)):
+            return True
+        self.cursor.execute('SELECT 1 FROM messages WHERE message_sid = ?', (message_sid,))
+        return self.cursor.fetchone() is not None
+
+    def _duplicate_message(self, message_sid):
+        with self.message_sid_lock:
+            self.duplicate_messages += 1
+        logger.info("Message '%s' was already added. Ignoring the duplicate.", message_sid)
+        return None
+
+    def _add_message_statements(self, message_id, message_sid, from_phone_number, to_phone_number, body, created_at, token_count, segments=None):
+        # Phone ids are resolved when the journal is flushed
+        statements = [
+            ('INSERT INTO phone_numbers (phone_number) VALUES (?) ON CONFLICT DO NOTHING', (from_phone_number,)),
+            ('INSERT INTO phone_numbers (phone_number) VALUES (?) ON CONFLICT DO NOTHING', (to_phone_number,)),
+            ('''INSERT INTO messages (message_id, message_sid, from_phone_id, to_phone_id, body, created_at, token_count)
+                VALUES (?, ?, (SELECT phone_id FROM phone_numbers WHERE phone_number = ?),
+                        (SELECT phone_id FROM phone_numbers WHERE phone_number = ?), ?, ?, ?)''',
+             (message_id, message_sid, from_phone_number, to_phone_number, body, created_at, token_count)),
+        ]
+        for sequence, (segment_sid, segment_body) in enumerate(segments or ()):
+            statements.append(('INSERT INTO message_segments (message_id, sequence, segment_sid, body) VALUES (?, ?, ?, ?)',
+                               (message_id, sequence, segment_sid, segment_body)))
+        return statements
 
     def add_system_prompt(self, system_prompt):
-        if (system_prompt_id := self.get_system_prompt_id(system_prompt)) is not None:
-            print(
-                f"[DB]: System prompt '{system_prompt}' already exists in the database.")
+        if (system_prompt_id := self.caches['system_prompt_ids'].get(system_prompt)) is not None:
             return system_prompt_id
-        self.cursor.execute(
-            'INSERT INTO system_prompts (system_prompt) VALUES (?)', (system_prompt,))
+        self.cursor.execute('''
+            INSERT INTO system_prompts (system_prompt) VALUES (?)
+            ON CONFLICT (system_prompt) DO UPDATE SET system_prompt = excluded.system_prompt
+            RETURNING system_prompt_id
+        ''', (system_prompt,))
+        system_prompt_id = self.cursor.fetchone()[0]
         self.conn.commit()
-        system_prompt_id = self.cursor.lastrowid
-        print(
-            f"[DB]: System prompt '{system_prompt}' added successfully. System Prompt ID: {system_prompt_id}")
-        return system_prompt_id
-
-    def add_model(self, model_name):
-        if (model_id := self.get_model_id(model_name)) is not None:
-            print(
-                f"[DB]: Model '{model_name}' already exists in the database.")
+        logger.debug(
+            "System prompt '%s' added successfully. System Prompt ID: %s", system_prompt, system_prompt_id)
+        self.caches['system_prompts'].put(system_prompt_id, system_prompt)
+        return self.caches['system_prompt_ids'].put(system_prompt, system_prompt_id)
+
+    def add_model(self, model_name, context_window=None):
+        if context_window is None and (model_id := self.caches['model_ids'].get(model_name)) is not None:
             return model_id
-        self.cursor.execute(
-            'INSERT INTO models (model_name) VALUES (?)', (model_name,))
+        # An explicit context_window overwrites the stored one, otherwise only fill it in if missing
+        self.cursor.execute('''
+            INSERT INTO models (model_name, context_window) VALUES (?, ?)
+            ON CONFLICT (model_name) DO UPDATE SET
+                context_window = COALESCE(?, models.context_window, excluded.context_window)
+            RETURNING model_id
+        ''', (model_name, context_window or get_context_window(model_name), context_window))
+        model_id = self.cursor.fetchone()[0]
         self.conn.commit()
-        model_id = self.cursor.lastrowid
-        print(
-            f"[DB]: Model '{model_name}' added successfully. Model ID: {model_id}")
-        return model_id
+        self.caches['context_windows'].pop(model_name)
+        logger.debug(
+            "Model '%s' added successfully. Model ID: %s", model_name, model_id)
+        self.caches['model_names'].put(model_id, model_name)
+        return self.caches['model_ids'].put(model_name, model_id)
+
+    def upsert_models(self, model_names, fetched_at):
+        # The whole catalog in one transaction. fetched_at is a unix timestamp
+        try:
+            self.cursor.executemany('''
+                INSERT INTO models (model_name, context_window, fetched_at) VALUES (?, ?, ?)
+                ON CONFLICT (model_name) DO UPDATE SET
+                    fetched_at = excluded.fetched_at,
+                    context_window = COALESCE(models.context_window, excluded.context_window)
+            ''', [(model_name, get_context_window(model_name), fetched_at) for model_name in model_names])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        logger.info("Model catalog of %d models saved.", len(model_names))
+
+    def upsert_usage(self, rows):
+        # rows of (phone_number, model_name, day, prompt_tokens, completion_tokens) with the totals for the day
+        self._read_your_writes()
+        try:
+            self.cursor.executemany('''
+                INSERT INTO usage (phone_id, model_name, day, prompt_tokens, completion_tokens)
+                VALUES ((SELECT phone_id FROM phone_numbers WHERE phone_number = ?), COALESCE(?, ''), ?, ?, ?)
+                ON CONFLICT (phone_id, model_name, day) DO UPDATE SET
+                    prompt_tokens = excluded.prompt_tokens,
+                    completion_tokens = excluded.completion_tokens
+            ''', rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def get_cached_completion(self, cache_key, min_created_at=0):
+        # Marks the entry as used in the same statement that reads it
+        try:
+            row = self.cursor.execute('''
+                UPDATE completion_cache SET last_used_at = ?
+                WHERE cache_key = ? AND created_at >= ?
+                RETURNING response
+            ''', (time(), cache_key, min_created_at)).fetchone()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return row[0] if row else None
+
+    def put_cached_completion(self, cache_key, model_name, response, max_entries=10000, min_created_at=0):
+        # Drops expired entries and then the least recently used ones over max_entries
+        now = time()
+        try:
+            self.cursor.execute('''
+                INSERT INTO completion_cache (cache_key, model_name, response, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    response = excluded.response,
+                    created_at = excluded.created_at,
+                    last_used_at = excluded.last_used_at
+            ''', (cache_key, model_name, response, now, now))
+            self.cursor.execute(
+                'DELETE FROM completion_cache WHERE created_at < ?', (min_created_at,))
+            self.cursor.execute('''
+                DELETE FROM completion_cache WHERE cache_key IN (
+                    SELECT cache_key FROM completion_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)
+            ''', (max_entries,))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
     def _handle_settings_kwargs(self, **kwargs):
         if system_prompt := kwargs.pop('system_prompt', None):
@@ -162,134 +743,328 @@ class MessageDB:
             sql_question_marks = ', '.join(
                 ['?' for _ in range(len(values) + 1)])
             query = f'INSERT INTO settings (phone_id, {set_keys}) VALUES ({sql_question_marks})'
-            self.cursor.execute(query, (phone_id, *values))
-            self.conn.commit()
-            settings_id = self.cursor.lastrowid
-            print(
-                f"[DB]: Settings for phone number '{phone_number}' added successfully.")
+            self._write([(query, (phone_id, *values))], (('settings', phone_number),))
+            self.caches['settings'].pop(phone_number)
+            # phone_id is the rowid of settings
+            settings_id = phone_id
+            logger.debug(
+                "Settings for phone number '%s' added successfully.", phone_number)
             return settings_id
         else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+            logger.warning("Phone number '%s' not found.", phone_number)
 
 #### UPDATING DB ####
+    def update_summary_for_phone_number(self, phone_number, summary, last_message_id):
+        self._write([
+            ('INSERT INTO phone_numbers (phone_number) VALUES (?) ON CONFLICT DO NOTHING', (phone_number,)),
+            ('''INSERT INTO summaries (phone_id, summary, last_message_id, token_count, updated_at)
+                VALUES ((SELECT phone_id FROM phone_numbers WHERE phone_number = ?), ?, ?, ?, ?)
+                ON CONFLICT (phone_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    last_message_id = excluded.last_message_id,
+                    token_count = excluded.token_count,
+                    updated_at = excluded.updated_at''',
+             (phone_number, summary, last_message_id, count_tokens(summary), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))),
+        ], (('phone_numbers', phone_number), ('summaries', phone_number)))
+        logger.debug(
+            "Summary for phone number '%s' updated through Message ID: %s", phone_number, last_message_id)
+
+    def update_message_token_counts(self, token_counts):
+        # token_counts is an iterable of (message_id, token_count) for rows stored before counts existed
+        self._write([('UPDATE messages SET token_count = ? WHERE message_id = ?', (token_count, message_id))
+                     for message_id, token_count in token_counts])
+
     def update_settings_for_phone_number(self, phone_number, **kwargs):
         if (phone_id := self.get_phone_id(phone_number)) is not None:
             kwargs = self._handle_settings_kwargs(**kwargs)
             values = tuple(kwargs.values())
             set_values = ', '.join([f'{key} = ?' for key in kwargs])
             query = f'UPDATE settings SET {set_values} WHERE phone_id = ?'
-            self.cursor.execute(query, (*values, phone_id))
-            self.conn.commit()
-            print(
-                f"[DB]: Settings for phone number '{phone_number}' updated successfully.")
+            self._write([(query, (*values, phone_id))], (('settings', phone_number),))
+            self.caches['settings'].pop(phone_number)
+            logger.debug(
+                "Settings for phone number '%s' updated successfully.", phone_number)
         else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+            logger.warning("Phone number '%s' not found.", phone_number)
 
 
 #### GETTING FROM DB ####
 
     def get_phone_number(self, phone_id):
+        self._read_your_writes()
         self.cursor.execute(
             'SELECT phone_number FROM phone_numbers WHERE phone_id = ?', (phone_id,))
         if result := self.cursor.fetchone():
             return result[0]
         else:
-            print(f"[DB]: Phone number with ID '{phone_id}' not found.")
+            logger.debug("Phone number with ID '%s' not found.", phone_id)
             return None
 
-    def get_messages_for_phone_number(self, phone_number):
-        if (phone_id := self.get_phone_id(phone_number)) is not None:
-            self.cursor.execute(
-                'SELECT * FROM messages WHERE from_phone_id = ? OR to_phone_id = ?', (phone_id, phone_id))
-            results = self.cursor.fetchall()
-            messages = []
-            for row in results:
-                message_id, message_sid, from_phone_id, to_phone_id, body, timestamp = row
-                from_phone_number = self.get_phone_number(from_phone_id)
-                to_phone_number = self.get_phone_number(to_phone_id)
-                # timestamp  = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                message = Message(
-                    message_id, message_sid, from_phone_number, to_phone_number, body, timestamp)
-                messages.append(message)
-            return messages
-        else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+    def get_messages_for_phone_number(self, phone_number, after_message_id=0):
+        return list(self.iter_messages_for_phone_number(phone_number, after_message_id))
+
+    def iter_messages_for_phone_number(self, phone_number, after_message_id=0, newest_first=False, limit=None,
+                                       batch_size=MESSAGE_BATCH_SIZE):
+        # Streams the conversation in message_id order so callers that stop early never load the rest of it.
+        # Unflushed messages are merged in instead of flushing. Snapshot them first so none can be missed
+        pending_messages = self.journal.pending_messages(
+            phone_number, after_message_id) if self.journal is not None else []
+        pending_messages.sort(key=attrgetter('message_id'), reverse=newest_first)
+        pending_message_ids = {message.message_id for message in pending_messages}
+
+        # A cursor of its own since the thread's cursor is reused by any query made between two batches.
+        # One query resolves the phone id and both phone numbers of every message
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            WITH conversation AS (SELECT phone_id FROM phone_numbers WHERE phone_number = ?)
+            SELECT m.message_id, m.message_sid, f.phone_number, t.phone_number, m.body, m.created_at, m.token_count
+            FROM messages AS m
+            JOIN phone_numbers AS f ON f.phone_id = m.from_phone_id
+            JOIN phone_numbers AS t ON t.phone_id = m.to_phone_id
+            WHERE (m.from_phone_id = (SELECT phone_id FROM conversation)
+                   OR m.to_phone_id = (SELECT phone_id FROM conversation))
+              AND m.message_id > ?
+            ORDER BY m.message_id {'DESC' if newest_first else 'ASC'}
+            LIMIT ?
+        ''', (phone_number, after_message_id, -1 if limit is None else limit + len(pending_messages)))
+
+        def stored_messages():
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    # A batch being flushed can already be stored
+                    if row[0] not in pending_message_ids:
+                        yield Message(*row)
+
+        messages = heapq.merge(stored_messages(), pending_messages,
+                               key=attrgetter('message_id'), reverse=newest_first)
+        try:
+            yield from messages if limit is None else islice(messages, limit)
+        finally:
+            cursor.close()
+
+    def get_messages_by_id(self, message_ids):
+        # Stored messages with the given ids in message_id order. Ids still in the journal are not returned
+        if not message_ids:
             return []
+        self.cursor.execute(f'''
+            SELECT m.message_id, m.message_sid, f.phone_number, t.phone_number, m.body, m.created_at, m.token_count
+            FROM messages AS m
+            JOIN phone_numbers AS f ON f.phone_id = m.from_phone_id
+            JOIN phone_numbers AS t ON t.phone_id = m.to_phone_id
+            WHERE m.message_id IN ({', '.join('?' * len(message_ids))})
+            ORDER BY m.message_id
+        ''', tuple(message_ids))
+        return [Message(*row) for row in self.cursor.fetchall()]
+
+    def get_history_for_phone_number(self, phone_number, after_message_id=0):
+        # The conversation as ready to send messages, read from the db only when it is not in the history cache
+        if (history := self.history_cache.get(phone_number, after_message_id)) is not None:
+            return history
+
+        new_token_counts = []
+
+        def messages():
+            for message in self.iter_messages_for_phone_number(phone_number, after_message_id):
+                if message.token_count is None:
+                    message.token_count = count_tokens(message.body)
+                    new_token_counts.append((message.message_id, message.token_count))
+                yield message
+
+        history = self.history_cache.load(phone_number, after_message_id, messages())
+        if new_token_counts:
+            self.update_message_token_counts(new_token_counts)
+        return history
+
+    def get_token_count_for_phone_number(self, phone_number, after_message_id=0):
+        self._read_your_writes(('messages', phone_number))
+        # Tokens in the conversation excluding commands, which are never sent to the model
+        self.cursor.execute('''
+            WITH conversation AS (SELECT phone_id FROM phone_numbers WHERE phone_number = ?)
+            SELECT COALESCE(SUM(token_count), 0) FROM messages
+            WHERE (from_phone_id = (SELECT phone_id FROM conversation)
+                   OR to_phone_id = (SELECT phone_id FROM conversation))
+              AND message_id > ? AND body NOT LIKE '#%'
+        ''', (phone_number, after_message_id))
+        return self.cursor.fetchone()[0]
+
+    def get_summary_for_phone_number(self, phone_number):
+        self._read_your_writes(('summaries', phone_number))
+        self.cursor.execute('''
+            SELECT s.summary, s.last_message_id, s.token_count
+            FROM summaries AS s
+            JOIN phone_numbers AS p ON p.phone_id = s.phone_id
+            WHERE p.phone_number = ?
+        ''', (phone_number,))
+        if result := self.cursor.fetchone():
+            summary, last_message_id, token_count = result
+            return {
+                'summary': summary,
+                'last_message_id': last_message_id,
+                'token_count': token_count
+            }
+        return None
+
+    def get_message_segments(self, message_id):
+        self._read_your_writes()
+        self.cursor.execute(
+            'SELECT sequence, segment_sid, body FROM message_segments WHERE message_id = ? ORDER BY sequence', (message_id,))
+        return self.cursor.fetchall()
 
     def get_system_prompt(self, system_prompt_id):
+        if (system_prompt := self.caches['system_prompts'].get(system_prompt_id)) is not None:
+            return system_prompt
         self.cursor.execute(
             'SELECT system_prompt FROM system_prompts WHERE system_prompt_id = ?', (system_prompt_id,))
         if result := self.cursor.fetchone():
-            return result[0]
+            return self.caches['system_prompts'].put(system_prompt_id, result[0])
         else:
-            print(
-                f"[DB]: System prompt with ID '{system_prompt_id}' not found.")
+            logger.debug(
+                "System prompt with ID '%s' not found.", system_prompt_id)
             return None
 
     def get_model(self, model_id):
+        if (model_name := self.caches['model_names'].get(model_id)) is not None:
+            return model_name
         self.cursor.execute(
             'SELECT model_name FROM models WHERE model_id = ?', (model_id,))
         if result := self.cursor.fetchone():
-            return result[0]
+            return self.caches['model_names'].put(model_id, result[0])
         else:
-            print(f"[DB]: Model with ID '{model_id}' not found.")
+            logger.debug("Model with ID '%s' not found.", model_id)
             return None
 
+    def get_usage_for_day(self, day):
+        self.cursor.execute('''
+            SELECT p.phone_number, NULLIF(u.model_name, ''), u.prompt_tokens, u.completion_tokens
+            FROM usage AS u
+            JOIN phone_numbers AS p ON p.phone_id = u.phone_id
+            WHERE u.day = ?
+        ''', (day,))
+        return self.cursor.fetchall()
+
+    def get_model_catalog(self):
+        # Models from the last fetch of the catalog and when it was fetched, or ([], None) if it never was
+        self.cursor.execute('''
+            SELECT model_name, fetched_at FROM models
+            WHERE fetched_at = (SELECT MAX(fetched_at) FROM models)
+            ORDER BY model_name
+        ''')
+        rows = self.cursor.fetchall()
+        if not rows:
+            return [], None
+        return [model_name for model_name, _ in rows], rows[0][1]
+
+    def get_model_context_window(self, model_name):
+        cache = self.caches['context_windows']
+        if (context_window := cache.get(model_name)) is not None:
+            return context_window
+        generation = cache.generation
+        self.cursor.execute(
+            'SELECT context_window FROM models WHERE model_name = ?', (model_name,))
+        if (result := self.cursor.fetchone()) and result[0]:
+            return cache.put(model_name, result[0], generation)
+        return get_context_window(model_name)
+
     def get_settings_for_phone_number(self, phone_number):
-        if (phone_id := self.get_phone_id(phone_number)) is not None:
-            self.cursor.execute(
-                'SELECT * FROM settings WHERE phone_id = ?', (phone_id,))
-            if result := self.cursor.fetchone():
-                phone_id, system_prompt_id, model_id, stop_sequence, max_tokens, temperature, top_p, frequency_penalty, presence_penalty = result
-                system_prompt = self.get_system_prompt(system_prompt_id)
-                model = self.get_model(model_id)
-                # return Settings(system_prompt, stop_sequence, max_tokens, temperature, top_p, frequency_penalty, presence_penalty)
-                return {
-                    'model': model,
-                    'system_prompt': system_prompt,
-                    'stop_sequence': stop_sequence,
-                    'max_tokens': max_tokens,
-                    'temperature': temperature,
-                    'top_p': top_p,
-                    'frequency_penalty': frequency_penalty,
-                    'presence_penalty': presence_penalty
-                }
-            else:
-                print(
-                    f"[DB]: Settings for phone number '{phone_number}' not found.")
-                return None
+        cache = self.caches['settings']
+        # Callers pop keys from the settings so they always get a copy
+        if (settings := cache.get(phone_number)) is not None:
+            return dict(settings)
+        generation = cache.generation
+        self._read_your_writes(('settings', phone_number))
+        self.cursor.execute('''
+            SELECT m.model_name, sp.system_prompt, s.stop_sequence, s.max_tokens, s.temperature,
+                   s.top_p, s.frequency_penalty, s.presence_penalty
+            FROM settings AS s
+            JOIN phone_numbers AS p ON p.phone_id = s.phone_id
+            LEFT JOIN system_prompts AS sp ON sp.system_prompt_id = s.system_prompt_id
+            LEFT JOIN models AS m ON m.model_id = s.model_id
+            WHERE p.phone_number = ?
+        ''', (phone_number,))
+        if result := self.cursor.fetchone():
+            model, system_prompt, stop_sequence, max_tokens, temperature, top_p, frequency_penalty, presence_penalty = result
+            # return Settings(system_prompt, stop_sequence, max_tokens, temperature, top_p, frequency_penalty, presence_penalty)
+            settings = {
+                'model': model,
+                'system_prompt': system_prompt,
+                'stop_sequence': stop_sequence,
+                'max_tokens': max_tokens,
+                'temperature': temperature,
+                'top_p': top_p,
+                'frequency_penalty': frequency_penalty,
+                'presence_penalty': presence_penalty
+            }
+            return dict(cache.put(phone_number, settings, generation))
         else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+            logger.debug(
+                "Settings for phone number '%s' not found.", phone_number)
             return None
 
     def delete_messages_for_phone_number(self, phone_number):
+        # Deletes run directly so everything queued before them has to be written first
+        self._read_your_writes()
         if (phone_id := self.get_phone_id(phone_number)) is not None:
+            self.cursor.execute('''
+                DELETE FROM message_segments WHERE message_id IN (
+                    SELECT message_id FROM messages WHERE from_phone_id = ? OR to_phone_id = ?)
+            ''', (phone_id, phone_id))
             self.cursor.execute(
                 'DELETE FROM messages WHERE from_phone_id = ? OR to_phone_id = ?', (phone_id, phone_id))
+            self.cursor.execute(
+                'DELETE FROM summaries WHERE phone_id = ?', (phone_id,))
             self.conn.commit()
-            print(
-                f"[DB]: Messages for phone number '{phone_number}' removed successfully.")
+            if self.history_cache is not None:
+                self.history_cache.invalidate(phone_number)
+            logger.info(
+                "Messages for phone number '%s' removed successfully.", phone_number)
         else:
-            print(f"[DB]: Phone number '{phone_number}' not found.")
+            logger.warning("Phone number '%s' not found.", phone_number)
 
     def close(self):
-        self.conn.close()
+        if self.journal is not None:
+            self.journal.close()
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        if self.shared_conn is not None:
+            self.shared_conn.close()
+        self.local = threading.local()
 
 
 class Message:
-    def __init__(self, message_id, message_sid, from_phone_number, to_phone_number, body, timestamp):
+    # Conversations are read a row at a time so keep instances small and parse the time only when asked
+    __slots__ = ('message_id', 'message_sid', 'from_phone_number', 'to_phone_number', 'body', 'created_at',
+                 'token_count', '_timestamp')
+
+    def __init__(self, message_id, message_sid, from_phone_number, to_phone_number, body, created_at, token_count=None):
         self.message_id = message_id
         self.message_sid = message_sid
         self.from_phone_number = from_phone_number
         self.to_phone_number = to_phone_number
         self.body = body
-        self.timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        # Unix epoch, or a '%Y-%m-%d %H:%M:%S' string from before migration 10
+        self.created_at = created_at
+        self.token_count = token_count
+        self._timestamp = None
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self.created_at is not None:
+            if isinstance(self.created_at, str):
+                self._timestamp = datetime.strptime(self.created_at, '%Y-%m-%d %H:%M:%S')
+            else:
+                self._timestamp = datetime.fromtimestamp(self.created_at)
+        return self._timestamp
 
     def __repr__(self):
         return f"Message(from_phone_number={self.from_phone_number}\nto_phone_number={self.to_phone_number}\nbody={self.body}\ntimestamp={self.timestamp}))"
 
 
 class Settings:
+    __slots__ = ('system_prompt', 'stop_sequence', 'max_tokens', 'temperature', 'top_p', 'frequency_penalty',
+                 'presence_penalty')
+
     def __init__(self, system_prompt, stop_sequence, max_tokens, temperature, top_p, frequency_penalty, presence_penalty):
         self.system_prompt = system_prompt
         self.stop_sequence = stop_sequence
@@ -300,4 +1075,4 @@ class Settings:
         self.presence_penalty = presence_penalty
 
     def __repr__(self):
-        return f'{type(self)}(' + ','.join(f'{key}={value}' for key, value in self.__dict__.items()) + ')'
+        return f'{type(self)}(' + ','.join(f'{key}={getattr(self, key)}' for key in self.__slots__) + ')'
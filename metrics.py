@@ -0,0 +1,186 @@
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+# Seconds. Covers cache hits through slow completions
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+enabled = True
+
+
+def set_enabled(value):
+    # Spans check this when they start so disabling costs one global lookup per instrumented call
+    global enabled
+    enabled = bool(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        # label values tuple -> value
+        self.values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type_name}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self.render_value(dict(zip(self.label_names, label_values)), value))
+        return lines
+
+    def render_value(self, labels, value):
+        return [f'{self.name}{format_labels(labels)} {value}']
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, *label_values):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            if (value := self.values.get(label_values)) is None:
+                # [count per bucket plus +Inf, sum]
+                value = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            value[0][index] += 1
+            value[1] += seconds
+
+    def render_value(self, labels, value):
+        bucket_counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, '+Inf'), bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, metric_class, name, help_text, label_names=(), **kwargs):
+        with self.lock:
+            if (metric := self.metrics.get(name)) is None:
+                metric = self.metrics[name] = metric_class(name, help_text, label_names, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.get_or_create(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.get_or_create(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.get_or_create(Histogram, name, help_text, label_names, buckets=buckets)
+
+    def render(self):
+        # Prometheus text exposition format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+    'textgpt_stage_seconds', 'Time spent in each stage of handling a message', ('stage', 'operation'))
+stage_errors = registry.counter(
+    'textgpt_stage_errors_total', 'Exceptions raised by each stage', ('stage', 'operation'))
+
+
+class Span:
+    __slots__ = ('stage', 'operation', 'started_at')
+
+    def __init__(self, stage, operation):
+        self.stage = stage
+        self.operation = operation
+
+    def __enter__(self):
+        self.started_at = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(perf_counter() - self.started_at, self.stage, self.operation)
+        if exc_type is not None:
+            stage_errors.inc(self.stage, self.operation)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, operation):
+    return Span(stage, operation) if enabled else NULL_SPAN
+
+
+def timed(stage, operation=None):
+    # Decorator recording every call of the function as a span
+    def decorator(fn):
+        name = operation or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(stage, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_methods(stage, exclude=()):
+    # Class decorator timing every public method
+    def decorator(cls):
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not callable(attribute) \
+                    or isinstance(attribute, (staticmethod, classmethod, type)):
+                continue
+            setattr(cls, name, timed(stage, name)(attribute))
+        return cls
+    return decorator
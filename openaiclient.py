@@ -0,0 +1,259 @@
+import logging
+import random
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from openai.error import (OpenAIError, APIError, APIConnectionError, RateLimitError,
+                          ServiceUnavailableError, Timeout, TryAgain)
+from openai.api_resources.abstract.engine_api_resource import EngineAPIResource
+
+logger = logging.getLogger(__name__)
+
+# Errors that may succeed if the same request is sent again
+RETRIABLE_ERRORS = (APIConnectionError, RateLimitError,
+                    ServiceUnavailableError, Timeout, TryAgain)
+
+
+class CircuitOpenError(OpenAIError):
+    pass
+
+
+def is_retriable(error):
+    if isinstance(error, RETRIABLE_ERRORS):
+        return True
+    # APIError is also raised for unexpected 4xx responses
+    return isinstance(error, APIError) and (error.http_status is None or error.http_status >= 500)
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold retriable failures in a row and lets one trial request through after reset_seconds
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+
+class LatencyTracker:
+    # Latencies of the last window successful requests
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, percent, min_samples=20):
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class SharedSession(requests.Session):
+    # openai closes the session of a thread after a few minutes, which would drop the keep-alive connections of
+    # every thread. Only the client that owns it closes it
+    def __init__(self):
+        super().__init__()
+        self.owned = True
+
+    def close(self):
+        if not self.owned:
+            super().close()
+
+
+class OpenAIClient:
+    # Calls OpenAI with a per call deadline, retries retriable errors with exponential backoff and full jitter,
+    # a circuit breaker per model and optionally a hedged duplicate once a request is slower than the p95
+    def __init__(self, timeout=30, deadline=60, max_retries=3, backoff_base=0.5, backoff_max=8,
+                 failure_threshold=5, reset_seconds=30, hedge=False, hedge_percentile=95, hedge_min_samples=20,
+                 pool_size=16, workers=None):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        # One keep-alive pool shared by every thread instead of a session per thread
+        self.session = SharedSession()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        openai.requestssession = self.session
+        # Attempts run here so a caller is never held past its deadline, even by calls without a request_timeout.
+        # A thread per calling worker, and one more for its hedge
+        self.executor = ThreadPoolExecutor(
+            max_workers=(workers or pool_size) * (2 if hedge else 1), thread_name_prefix='textgpt-openai')
+
+        self.breakers = defaultdict(lambda: CircuitBreaker(
+            self.failure_threshold, self.reset_seconds))
+        self.latencies = defaultdict(LatencyTracker)
+
+        # Stats
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.rejected = 0
+
+    @staticmethod
+    def get_key(getter_fn, kwargs):
+        return kwargs.get('model') or getattr(getter_fn, '__qualname__', repr(getter_fn))
+
+    def count(self, stat, n=1):
+        with self.lock:
+            setattr(self, stat, getattr(self, stat) + n)
+
+    def get_backoff(self, attempt, error):
+        # Honor Retry-After on rate limits, otherwise full jitter over an exponentially growing window
+        headers = getattr(error, 'headers', None) or {}
+        if retry_after := headers.get('retry-after'):
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, getter_fn, **kwargs):
+        key = self.get_key(getter_fn, kwargs)
+        breaker = self.breakers[key]
+        if not breaker.allow():
+            self.count('rejected')
+            raise CircuitOpenError(
+                f'{key} is temporarily unavailable. Try again in a minute.')
+
+        self.count('calls')
+        deadline = monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline - monotonic()
+            try:
+                if remaining <= 0:
+                    raise Timeout(f'Request to {key} did not finish in {self.deadline}s')
+                response = self._attempt(getter_fn, key, kwargs, min(self.timeout, remaining))
+                breaker.record_success()
+                return response
+            except OpenAIError as e:
+                if not is_retriable(e):
+                    # OpenAI answered so the model is up even if the request was bad
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                backoff = self.get_backoff(attempt, e)
+                if attempt >= self.max_retries or monotonic() + backoff >= deadline or not breaker.allow():
+                    self.count('failures')
+                    raise
+                logger.warning('Retrying %s in %.2fs after %r', key, backoff, e)
+                self.count('retries')
+                attempt += 1
+                sleep(backoff)
+
+    def _attempt(self, getter_fn, key, kwargs, timeout):
+        if getattr(getter_fn, '__self__', None) is not None and isinstance(getter_fn.__self__, type) \
+                and issubclass(getter_fn.__self__, EngineAPIResource):
+            # Only the engine endpoints take request_timeout. Image endpoints would send it in the body
+            kwargs = {**kwargs, 'request_timeout': timeout}
+
+        started_at = monotonic()
+        futures = {self.executor.submit(getter_fn, **kwargs): 'primary'}
+        # Streams are consumed by the caller so only their first response could be hedged. Never hedge them
+        hedge_after = None
+        if self.hedge and not kwargs.get('stream'):
+            hedge_after = self.latencies[key].percentile(
+                self.hedge_percentile, self.hedge_min_samples)
+
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                self.count('hedged')
+                futures[self.executor.submit(getter_fn, **kwargs)] = 'hedge'
+
+        error = None
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=max(0, started_at + timeout - monotonic()),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    if future.exception() is None:
+                        self.latencies[key].record(monotonic() - started_at)
+                        if futures[future] == 'hedge':
+                            self.count('hedge_wins')
+                        return future.result()
+                    error = future.exception()
+        finally:
+            # Nobody waits for these anymore. Queued ones are never sent, running ones finish in the background
+            for future in pending:
+                future.cancel()
+
+        if error is not None and not pending:
+            raise error
+        raise Timeout(f'Request to {key} timed out after {timeout:.1f}s')
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+            }
+        stats['circuits'] = {key: breaker.state for key, breaker in list(self.breakers.items())}
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if openai.requestssession is self.session:
+            openai.requestssession = None
+        self.session.owned = False
+        self.session.close()
@@ -0,0 +1,165 @@
+import atexit
+import logging
+import threading
+from datetime import date
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def take(self, n=1):
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def remaining(self):
+        self.refill()
+        return int(self.tokens)
+
+    def seconds_until_available(self, n=1):
+        self.refill()
+        return max(0.0, (n - self.tokens) / self.rate_per_second)
+
+
+class QuotaEngine:
+    # Per phone number message rate limits and daily prompt/completion token budgets per phone number and model.
+    # Counters live in memory and are checkpointed to the usage table, so admit() never touches the db
+    def __init__(self, mdb, messages_per_minute=10, daily_prompt_tokens=100000, daily_completion_tokens=20000,
+                 model_limits=None, checkpoint_interval=60):
+        self.mdb = mdb
+        self.messages_per_minute = messages_per_minute
+        self.daily_prompt_tokens = daily_prompt_tokens
+        self.daily_completion_tokens = daily_completion_tokens
+        # model_name -> (daily_prompt_tokens, daily_completion_tokens) overriding the defaults
+        self.model_limits = model_limits or {}
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+        # (phone_number, model, day) -> [prompt_tokens, completion_tokens]
+        self.usage = {}
+        self.dirty = set()
+        self.day = date.today().isoformat()
+        for phone_number, model, prompt_tokens, completion_tokens in self.mdb.get_usage_for_day(self.day):
+            self.usage[(phone_number, model, self.day)] = [
+                prompt_tokens, completion_tokens]
+
+        # Stats
+        self.admitted = 0
+        self.rate_limited = 0
+        self.over_budget = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='textgpt-quotas', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def get_limits(self, model):
+        return self.model_limits.get(model, (self.daily_prompt_tokens, self.daily_completion_tokens))
+
+    def _get_usage(self, phone_number, model):
+        # Caller holds self.lock. Counters for a new day start from zero
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.usage = {key: value for key, value in self.usage.items()
+                          if key in self.dirty}
+        return self.usage.setdefault((phone_number, model, today), [0, 0])
+
+    def admit(self, phone_number, model):
+        # Returns None if the request may call OpenAI, otherwise the reason it may not
+        with self.lock:
+            prompt_limit, completion_limit = self.get_limits(model)
+            prompt_tokens, completion_tokens = self._get_usage(
+                phone_number, model)
+            if (prompt_limit and prompt_tokens >= prompt_limit) or (completion_limit and completion_tokens >= completion_limit):
+                self.over_budget += 1
+                return f'You have used your daily token limit for {model}. Try again tomorrow or #set model to another model.'
+
+            if self.messages_per_minute:
+                if (bucket := self.buckets.get(phone_number)) is None:
+                    bucket = self.buckets[phone_number] = TokenBucket(
+                        self.messages_per_minute)
+                if not bucket.take():
+                    self.rate_limited += 1
+                    return f'You are sending messages too fast. Try again in {bucket.seconds_until_available():.0f} seconds.'
+
+            self.admitted += 1
+            return None
+
+    def record(self, phone_number, model, prompt_tokens=0, completion_tokens=0):
+        with self.lock:
+            usage = self._get_usage(phone_number, model)
+            usage[0] += prompt_tokens
+            usage[1] += completion_tokens
+            self.dirty.add((phone_number, model, self.day))
+
+    def get_limits_report(self, phone_number, model):
+        with self.lock:
+            prompt_limit, completion_limit = self.get_limits(model)
+            prompt_tokens, completion_tokens = self._get_usage(
+                phone_number, model)
+            bucket = self.buckets.get(phone_number)
+            messages_left = bucket.remaining() if bucket else self.messages_per_minute
+
+        def remaining(used, limit):
+            return f'{max(0, limit - used)} of {limit}' if limit else 'unlimited'
+
+        return (f'Your limits for {model} today:\n'
+                f'Messages left this minute: {messages_left if self.messages_per_minute else "unlimited"}\n'
+                f'Prompt tokens left: {remaining(prompt_tokens, prompt_limit)}\n'
+                f'Completion tokens left: {remaining(completion_tokens, completion_limit)}')
+
+    def checkpoint(self):
+        with self.lock:
+            rows = [(phone_number, model, day, *self.usage.get((phone_number, model, day), (0, 0)))
+                    for phone_number, model, day in self.dirty]
+            self.dirty = set()
+        if rows:
+            try:
+                self.mdb.upsert_usage(rows)
+            except Exception:
+                with self.lock:
+                    self.dirty.update(row[:3] for row in rows)
+                raise
+        return len(rows)
+
+    def _run(self):
+        while not self.stopped.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logger.exception('Error checkpointing usage: %r', e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'admitted': self.admitted,
+                'rate_limited': self.rate_limited,
+                'over_budget': self.over_budget,
+                'dirty_counters': len(self.dirty),
+            }
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.checkpoint()
+        atexit.unregister(self.close)
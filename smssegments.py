@@ -0,0 +1,52 @@
+import re
+
+# Twilio rejects bodies over 1600 characters
+MAX_SEGMENT_SIZE = 1600
+
+SENTENCE_END_RE = re.compile(r'[.!?]+["\')\]]*\s+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def find_break(text, segment_size=MAX_SEGMENT_SIZE):
+    # Index to cut text at so the first segment is at most segment_size characters
+    if len(text) <= segment_size:
+        return len(text)
+
+    window = text[:segment_size + 1]
+    # Prefer the last sentence end unless it would leave a tiny segment, then the last whitespace
+    sentence_ends = [match.end() for match in SENTENCE_END_RE.finditer(window)
+                     if len(window[:match.end()].rstrip()) <= segment_size]
+    if sentence_ends and sentence_ends[-1] > segment_size // 2:
+        return sentence_ends[-1]
+
+    whitespace_ends = [match.end() for match in WHITESPACE_RE.finditer(window)
+                       if 0 < match.start() <= segment_size]
+    if whitespace_ends:
+        return whitespace_ends[-1]
+
+    return segment_size
+
+
+def split_segments(text, segment_size=MAX_SEGMENT_SIZE):
+    text = text.strip()
+    segments = []
+    while len(text) > segment_size:
+        cut = find_break(text, segment_size)
+        segments.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not segments:
+        segments.append(text)
+    return segments
+
+
+def stream_segments(text_chunks, segment_size=MAX_SEGMENT_SIZE):
+    # Yields each segment as soon as enough text has arrived to know where it ends
+    buffer = ''
+    for text_chunk in text_chunks:
+        buffer += text_chunk
+        while len(buffer) > segment_size:
+            cut = find_break(buffer, segment_size)
+            yield buffer[:cut].rstrip()
+            buffer = buffer[cut:].lstrip()
+    if buffer.strip():
+        yield buffer.strip()
@@ -1,8 +1,75 @@
+import os
+import sys
+import sqlite3
+import tempfile
 import unittest
-from messagedb import Message, MessageDB
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from itertools import count
+import json
+from time import monotonic, sleep, time
+from unittest import mock
+from messagedb import Message, MessageDB, MIGRATIONS
+from workerpool import WorkerPool
+from lrucache import LRUCache
+from quotas import QuotaEngine
+from diskcache import DiskCache
+from historycache import HistoryCache
+from memorystore import HashingEmbedder, MemoryStore
+from openaiclient import OpenAIClient, CircuitOpenError
+import logging
+import metrics
+import imageprocessor
+from PIL import Image
+import numpy as np
+import openai
+import textgpt
+from tokencounter import count_tokens, get_context_window, TOKENS_PER_MESSAGE
+from smssegments import MAX_SEGMENT_SIZE, split_segments, stream_segments
 
 
-class TestMessageDBClass(unittest.TestCase):
+def make_textgpt(**kwargs):
+    # textGPT with the OpenAI model list and Twilio client stubbed out
+    with mock.patch('openai.Model.list', return_value={'data': [{'id': 'gpt-3.5-turbo'}]}):
+        tg = textgpt.textGPT(':memory:', number='+15550000000', **kwargs)
+        tg.models_refreshed.wait(5)
+    tg.client = mock.Mock()
+    return tg
+
+
+def fake_create_message(**kwargs):
+    # Twilio gives every sent message its own SID
+    return mock.Mock(sid=f'SM{next(sent_message_sids)}')
+
+
+sent_message_sids = count()
+
+
+@contextmanager
+def count_queries(db):
+    # Counts every statement the calling thread's connection runs
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        db.conn.set_trace_callback(None)
+
+
+class QueryCountMixin:
+
+    @contextmanager
+    def assertNumQueries(self, db, expected):
+        with count_queries(db) as statements:
+            yield statements
+        self.assertEqual(len(statements), expected,
+                         f'Expected {expected} queries, got {len(statements)}:\n' + '\n'.join(statements))
+
+
+class TestMessageDBClass(QueryCountMixin, unittest.TestCase):
 
     def setUp(self):
         # Initialize the database with a test database
@@ -68,7 +135,1807 @@ class TestMessageDBClass(unittest.TestCase):
         self.assertEqual(settings["stop_sequence"], "!end!")
         self.assertEqual(settings["max_tokens"], 200)
         self.assertEqual(settings["temperature"], 0.8)
-        
+
+    def test_get_messages_for_phone_number_is_one_query(self):
+        for i in range(50):
+            self.db.add_message(f"SID{i}", "+1111111111", "+2222222222", f"Message {i}")
+            self.db.add_message(f"SID{i}R", "+2222222222", "+1111111111", f"Reply {i}")
+
+        with self.assertNumQueries(self.db, 1):
+            messages = self.db.get_messages_for_phone_number("+1111111111")
+        self.assertEqual(len(messages), 100)
+        self.assertEqual(messages[1].from_phone_number, "+2222222222")
+        self.assertEqual(messages[1].to_phone_number, "+1111111111")
+
+        with self.assertNumQueries(self.db, 1):
+            self.assertEqual(self.db.get_messages_for_phone_number("+9999999999"), [])
+
+    def test_iter_messages_newest_first_stops_early(self):
+        for i in range(10):
+            self.db.add_message(f"SID{i}", "+1111111111", "+2222222222", f"Message {i}")
+
+        messages = self.db.iter_messages_for_phone_number("+1111111111", newest_first=True, batch_size=3)
+        self.assertEqual([next(messages).body for _ in range(2)], ["Message 9", "Message 8"])
+        messages.close()
+        limited = self.db.iter_messages_for_phone_number("+1111111111", after_message_id=5, limit=3)
+        self.assertEqual([message.body for message in limited], ["Message 5", "Message 6", "Message 7"])
+
+    def test_message_timestamp_is_parsed_lazily(self):
+        message = self.db.add_message("SID1", "+1111111111", "+2222222222", "Hello")
+        self.assertIsInstance(message.created_at, int)
+        stored, = self.db.get_messages_for_phone_number("+1111111111")
+        self.assertIsNone(stored._timestamp)
+        self.assertEqual(stored.timestamp, datetime.fromtimestamp(message.created_at))
+        self.assertFalse(hasattr(stored, '__dict__'))
+        self.assertEqual(Message(1, 'SID1', '+1', '+2', 'Hi', '2023-01-01 00:00:00').timestamp,
+                         datetime(2023, 1, 1))
+
+    def test_get_settings_for_phone_number_is_one_query(self):
+        self.db.add_phone_number("+1234567890")
+        self.db.add_settings("+1234567890", model="gpt-4", system_prompt="Be nice.", temperature=0.5)
+
+        with self.assertNumQueries(self.db, 1):
+            settings = self.db.get_settings_for_phone_number("+1234567890")
+        self.assertEqual(settings["model"], "gpt-4")
+        self.assertEqual(settings["system_prompt"], "Be nice.")
+        self.assertEqual(settings["temperature"], 0.5)
+
+
+class TestMessageDBConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = MessageDB(os.path.join(self.tmpdir.name, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_connection_is_tuned_and_reused(self):
+        conn = self.db.conn
+        self.assertIs(self.db.conn, conn)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+        self.assertGreater(conn.execute('PRAGMA busy_timeout').fetchone()[0], 0)
+
+    def test_concurrent_writes_from_threads(self):
+        errors = []
+        self.db.add_phone_number('+15550000000')
+
+        def write(n):
+            try:
+                for i in range(20):
+                    self.db.add_message(f'SID{n}-{i}', f'+1{n:010d}', '+15550000000', 'hi')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.db.get_messages_for_phone_number('+15550000000')), 160)
+
+    def test_connections_of_exited_threads_are_reused(self):
+        num_connections = len(self.db.connections)
+        for _ in range(3):
+            thread = threading.Thread(target=self.db.add_phone_number, args=('+1234567890',))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(self.db.connections), num_connections + 1)
+
+
+class TestMessageDBMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'legacy.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_legacy_db(self):
+        # Unversioned schema with the duplicate rows the old check-then-insert could race into
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE phone_numbers (phone_id INTEGER PRIMARY KEY, phone_number TEXT);
+            CREATE TABLE messages (message_id INTEGER PRIMARY KEY, message_sid TEXT, from_phone_id INTEGER,
+                to_phone_id INTEGER, body TEXT, timestamp TEXT);
+            CREATE TABLE system_prompts (system_prompt_id INTEGER PRIMARY KEY, system_prompt TEXT);
+            CREATE TABLE models (model_id INTEGER PRIMARY KEY, model_name TEXT);
+            CREATE TABLE settings (phone_id INTEGER PRIMARY KEY, system_prompt_id INTEGER, model_id INTEGER,
+                stop_sequence TEXT, max_tokens INTEGER, temperature FLOAT, top_p FLOAT,
+                frequency_penalty FLOAT, presence_penalty FLOAT);
+            INSERT INTO phone_numbers VALUES (1, '+1111111111'), (2, '+2222222222'), (3, '+1111111111');
+            INSERT INTO models VALUES (1, 'gpt-4'), (2, 'gpt-4');
+            INSERT INTO system_prompts VALUES (1, 'Be nice.');
+            INSERT INTO messages VALUES (1, 'SID1', 1, 2, 'Hello', '2023-01-01 00:00:00');
+            INSERT INTO messages VALUES (2, 'SID2', 2, 3, 'Hi', '2023-01-01 00:00:01');
+            INSERT INTO settings VALUES (3, 1, 2, NULL, NULL, 1.0, 1.0, 0.0, 0.0);
+        ''')
+        conn.commit()
+        conn.close()
+
+    def test_migrations_upgrade_legacy_db_in_place(self):
+        self.make_legacy_db()
+        db = MessageDB(self.db_path)
+        self.assertEqual(db.get_schema_version(), MIGRATIONS[-1][0])
+
+        messages = db.get_messages_for_phone_number('+1111111111')
+        self.assertEqual([message.body for message in messages], ['Hello', 'Hi'])
+        settings = db.get_settings_for_phone_number('+1111111111')
+        self.assertEqual(settings['model'], 'gpt-4')
+        self.assertEqual(settings['system_prompt'], 'Be nice.')
+        self.assertEqual(db.add_model('gpt-4'), 1)
+        db.close()
+
+    def test_duplicate_message_sids_are_removed(self):
+        self.make_legacy_db()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO messages VALUES (3, 'SID1', 1, 2, 'Hello', '2023-01-01 00:00:02')")
+        conn.commit()
+        conn.close()
+
+        db = MessageDB(self.db_path)
+        messages = db.get_messages_for_phone_number('+1111111111')
+        self.assertEqual([(message.message_id, message.body) for message in messages], [(1, 'Hello'), (2, 'Hi')])
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.add_message('SID1', '+1111111111', '+2222222222', 'Hello')
+        db.close()
+
+    def test_message_timestamps_become_epochs(self):
+        self.make_legacy_db()
+        db = MessageDB(self.db_path)
+        message = db.get_messages_for_phone_number('+1111111111')[0]
+        self.assertEqual(message.created_at, int(datetime(2023, 1, 1).timestamp()))
+        self.assertEqual(message.timestamp, datetime(2023, 1, 1))
+        db.close()
+
+    def test_migrations_are_applied_once(self):
+        db = MessageDB(self.db_path)
+        version = db.get_schema_version()
+        db.close()
+
+        db = MessageDB(self.db_path)
+        self.assertEqual(db.get_schema_version(), version)
+        db.cursor.execute('SELECT COUNT(*) FROM schema_version')
+        self.assertEqual(db.cursor.fetchone()[0], len(MIGRATIONS))
+        db.close()
+
+    def test_add_methods_upsert(self):
+        db = MessageDB(self.db_path)
+        self.assertEqual(db.add_phone_number('+1234567890'), db.add_phone_number('+1234567890'))
+        self.assertEqual(db.add_system_prompt('Be nice.'), db.add_system_prompt('Be nice.'))
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.cursor.execute("INSERT INTO phone_numbers (phone_number) VALUES ('+1234567890')")
+        db.close()
+
+    def test_lookups_use_indexes(self):
+        db = MessageDB(self.db_path)
+        db.cursor.execute('EXPLAIN QUERY PLAN SELECT phone_id FROM phone_numbers WHERE phone_number = ?', ('+1',))
+        self.assertIn('idx_phone_numbers_phone_number', str(db.cursor.fetchall()))
+        db.cursor.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM messages WHERE from_phone_id = ? OR to_phone_id = ?', (1, 1))
+        plan = str(db.cursor.fetchall())
+        self.assertIn('idx_messages_from_phone_id', plan)
+        self.assertIn('idx_messages_to_phone_id', plan)
+        db.close()
+
+
+class TestTokenBudgetedContext(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.user = '+1111111111'
+
+    def tearDown(self):
+        self.tg.close()
+
+    def add_turns(self, n):
+        for i in range(n):
+            self.tg.mdb.add_message(f'SID{i}', self.user, self.tg.number, f'Question number {i} please')
+            self.tg.mdb.add_message(f'SID{i}R', self.tg.number, self.user, f'Answer number {i} for you')
+
+    def test_token_count_stored_at_insert(self):
+        message = self.tg.mdb.add_message('SID1', self.user, self.tg.number, 'Hello there, how are you?')
+        self.assertEqual(message.token_count, count_tokens('Hello there, how are you?'))
+        stored = self.tg.mdb.get_messages_for_phone_number(self.user)[0]
+        self.assertEqual(stored.token_count, message.token_count)
+
+    def test_model_context_windows(self):
+        self.assertEqual(self.tg.mdb.get_model_context_window('gpt-3.5-turbo'), get_context_window('gpt-3.5-turbo'))
+        self.tg.mdb.add_model('tiny-model', context_window=100)
+        self.assertEqual(self.tg.mdb.get_model_context_window('tiny-model'), 100)
+        # Re-adding without a context window keeps the stored one
+        self.tg.mdb.add_model('tiny-model')
+        self.assertEqual(self.tg.mdb.get_model_context_window('tiny-model'), 100)
+
+    def test_context_fits_budget_newest_first(self):
+        self.add_turns(20)
+        self.tg.mdb.add_model('tiny-model', context_window=150)
+        system_prompt = 'Be brief.'
+        budget = self.tg.get_token_budget(system_prompt, 'tiny-model', max_tokens=50)
+
+        messages = self.tg.get_context_messages(self.user, system_prompt, 'tiny-model', max_tokens=50)
+        self.assertEqual(messages[0], {'role': 'system', 'content': system_prompt})
+        self.assertEqual(messages[-1], {'role': 'assistant', 'content': 'Answer number 19 for you'})
+        self.assertLess(len(messages) - 1, 40)
+        used = sum(count_tokens(m['content']) + TOKENS_PER_MESSAGE for m in messages[1:])
+        self.assertLessEqual(used, budget)
+
+    def test_whole_history_sent_when_it_fits(self):
+        self.add_turns(3)
+        self.tg.mdb.add_message('SID#', self.user, self.tg.number, '#get settings')
+        messages = self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertEqual([m['role'] for m in messages], ['system'] + ['user', 'assistant'] * 3)
+
+    def test_missing_token_counts_are_backfilled(self):
+        self.add_turns(2)
+        self.tg.mdb.cursor.execute('UPDATE messages SET token_count = NULL')
+        self.tg.mdb.conn.commit()
+
+        self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertTrue(all(m.token_count is not None
+                            for m in self.tg.mdb.get_messages_for_phone_number(self.user)))
+
+    def test_non_numeric_settings_are_rejected(self):
+        self.tg.client.messages.create.side_effect = fake_create_message
+        self.tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        message = {'MessageSid': 'SID1', 'From': self.user, 'To': self.tg.number, 'Body': '#set max_tokens lots'}
+        self.tg.handle_incoming_message(message)
+        self.assertIn('must be a number', self.tg.client.messages.create.call_args.kwargs['body'])
+        self.assertIsNone(self.tg.mdb.get_settings_for_phone_number(self.user)['max_tokens'])
+
+        self.tg.handle_incoming_message({**message, 'MessageSid': 'SID2', 'Body': '#set max_tokens 50'})
+        self.assertEqual(self.tg.mdb.get_settings_for_phone_number(self.user)['max_tokens'], 50)
+        self.tg.handle_incoming_message({**message, 'MessageSid': 'SID3', 'Body': 'Hi'})
+        self.assertEqual(self.tg.client.messages.create.call_args.kwargs['body'], 'Hello!')
+
+        # Values stored before #set validated them fall back to the default completion size
+        self.assertEqual(self.tg.get_token_budget('Be brief.', 'gpt-4', max_tokens='lots'),
+                         self.tg.get_token_budget('Be brief.', 'gpt-4'))
+
+
+class TestHistoryCache(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.user = '+1111111111'
+
+    def tearDown(self):
+        self.tg.close()
+
+    def add_turns(self, start, stop, tg=None):
+        tg = tg or self.tg
+        for i in range(start, stop):
+            tg.mdb.add_message(f'SID{i}', self.user, tg.number, f'Question number {i} please')
+            tg.mdb.add_message(f'SID{i}R', tg.number, self.user, f'Answer number {i} for you')
+
+    def test_matches_context_built_from_the_db(self):
+        uncached = make_textgpt(history_cache_mb=0)
+        self.addCleanup(uncached.close)
+        for tg in (self.tg, uncached):
+            self.add_turns(0, 20, tg)
+            tg.mdb.add_message('SID#', self.user, tg.number, '#get settings')
+            tg.mdb.add_model('tiny-model', context_window=150)
+
+        for model, max_tokens in (('tiny-model', 50), ('gpt-4', None)):
+            self.assertEqual(self.tg.build_context(self.user, 'Be brief.', model, max_tokens),
+                             uncached.build_context(self.user, 'Be brief.', model, max_tokens))
+
+    def test_hot_conversation_is_not_read_again(self):
+        self.add_turns(0, 5)
+        self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.add_turns(5, 6)
+        with count_queries(self.tg.mdb) as statements:
+            messages = self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertFalse([statement for statement in statements if 'FROM messages' in statement])
+        self.assertEqual(messages[-1], {'role': 'assistant', 'content': 'Answer number 5 for you'})
+        self.assertEqual(self.tg.mdb.history_cache.stats()['appends'], 2)
+
+    def test_reset_messages_invalidates(self):
+        self.add_turns(0, 2)
+        self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.tg.mdb.delete_messages_for_phone_number(self.user)
+        self.add_turns(2, 3)
+        messages = self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertEqual([m['content'] for m in messages[1:]], ['Question number 2 please', 'Answer number 2 for you'])
+
+    def test_summary_trims_cached_history(self):
+        self.add_turns(0, 3)
+        self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        cache = self.tg.mdb.history_cache
+        bytes_before = cache.stats()['bytes']
+        last_message_id = self.tg.mdb.get_messages_for_phone_number(self.user)[3].message_id
+
+        history = self.tg.mdb.get_history_for_phone_number(self.user, last_message_id)
+        self.assertEqual([m['content'] for m in history.messages], ['Question number 2 please', 'Answer number 2 for you'])
+        self.assertLess(cache.stats()['bytes'], bytes_before)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = HistoryCache(4000, self.tg.get_role)
+        self.tg.mdb.history_cache = cache
+        for user in ('+1111111111', '+2222222222', '+3333333333'):
+            self.tg.mdb.add_message(f'SID{user}', user, self.tg.number, 'x' * 1000)
+            self.tg.mdb.get_history_for_phone_number(user)
+        self.tg.mdb.get_history_for_phone_number('+1111111111')
+        self.tg.mdb.add_message('SIDbig', '+1111111111', self.tg.number, 'x' * 1000)
+
+        self.assertEqual(list(cache.data), ['+3333333333', '+1111111111'])
+        self.assertLessEqual(cache.stats()['bytes'], 4000)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_load_racing_a_new_message_is_not_cached(self):
+        self.add_turns(0, 1)
+        cache = self.tg.mdb.history_cache
+
+        def messages():
+            yield from self.tg.mdb.get_messages_for_phone_number(self.user)
+            self.add_turns(1, 2)
+
+        cache.load(self.user, 0, messages())
+        self.assertNotIn(self.user, cache.data)
+        messages = self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertEqual(messages[-1], {'role': 'assistant', 'content': 'Answer number 1 for you'})
+
+
+class TestLongTermMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.user = '+1111111111'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hashing_embedder_is_deterministic(self):
+        embedder = HashingEmbedder(dim=64)
+        vectors = embedder(['my dog is called Rex', 'my dog is called Rex', 'the weather in Paris', ''])
+        self.assertEqual(vectors.shape, (4, 64))
+        self.assertEqual(vectors.dtype, np.float32)
+        np.testing.assert_array_equal(vectors[0], vectors[1])
+        self.assertFalse(vectors[3].any())
+
+    def test_search_ranks_by_similarity_within_bounds(self):
+        store = MemoryStore(self.tmpdir.name, HashingEmbedder())
+        store.add(self.user, [1, 2, 3, 4], ['my dog is called Rex', 'the weather in Paris is rainy',
+                                            'Rex the dog likes long walks', 'what is the dog called'])
+
+        matches = store.search(self.user, 'what is the dog called', 2, before_message_id=4, message_id=4)
+        self.assertEqual([message_id for message_id, _ in matches], [1, 3])
+        self.assertGreater(matches[0][1], matches[1][1])
+        self.assertEqual([message_id for message_id, _ in store.search(self.user, 'dog', 5, after_message_id=1,
+                                                                       before_message_id=3)], [])
+
+        # Another store reads the same files
+        reopened = MemoryStore(self.tmpdir.name, HashingEmbedder())
+        self.assertEqual(reopened.search(self.user, 'dog called Rex', 1), [(1, mock.ANY)])
+        reopened.delete(self.user)
+        self.assertEqual(store.search(self.user, 'dog called Rex', 1), [])
+
+    def test_prompt_is_recent_turns_plus_recalled_messages(self):
+        tg = make_textgpt(memory_dir=self.tmpdir.name, memory_recent_messages=2, memory_top_k=1)
+        self.addCleanup(tg.close)
+        turns = [('My sister lives in Lisbon', 'Lisbon is lovely'), ('I like chess', 'Chess is a great game'),
+                 ('Any film tips', 'Try a classic'), ('Where does my sister live', None)]
+        for question, answer in turns:
+            tg.remember_messages(self.user, [tg.mdb.add_message(f'SID{question}', self.user, tg.number, question)])
+            if answer:
+                tg.remember_messages(self.user, [tg.mdb.add_message(f'SID{answer}', tg.number, self.user, answer)])
+
+        messages = tg.get_context_messages(self.user, 'Be brief.', 'gpt-4')
+        self.assertEqual(messages[1], {'role': 'system', 'content': textgpt.MEMORY_PREFIX + 'user: My sister lives in Lisbon'})
+        self.assertEqual([m['content'] for m in messages[2:]], ['Try a classic', 'Where does my sister live'])
+        self.assertEqual(tg.memory.stats()['added'], 7)
+
+    def test_embedder_is_pluggable_and_replies_are_remembered(self):
+        embedder = mock.Mock(side_effect=lambda texts: np.ones((len(texts), 8)), dim=8)
+        embedder.name = 'fake'
+        tg = make_textgpt(memory_dir=self.tmpdir.name, embedder=embedder)
+        self.addCleanup(tg.close)
+        tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        tg.client.messages.create.side_effect = fake_create_message
+
+        tg.handle_incoming_message({'MessageSid': 'SID1', 'From': self.user, 'To': tg.number, 'Body': 'Hi'})
+        tg.handle_incoming_message({'MessageSid': 'SID2', 'From': self.user, 'To': tg.number, 'Body': '#get model'})
+        # Commands are never sent to the model so only their replies are
+        self.assertEqual([call.args[0] for call in embedder.call_args_list][:2], [['Hi'], ['Hello!']])
+        self.assertEqual(len(embedder.call_args_list), 3)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir.name, 'fake-8')))
+
+
+class TestConversationSummaries(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt(summarize_after_tokens=40)
+        self.user = '+1111111111'
+        self.prompts = []
+
+        def fake_chat(messages, **kwargs):
+            self.prompts.append(messages)
+            return f'summary {len(self.prompts)}'
+        self.tg.openai_get_chat = fake_chat
+
+    def tearDown(self):
+        self.tg.close()
+
+    def add_turns(self, start, stop):
+        for i in range(start, stop):
+            self.tg.mdb.add_message(f'SID{i}', self.user, self.tg.number, f'Question number {i} please')
+            self.tg.mdb.add_message(f'SID{i}R', self.tg.number, self.user, f'Answer number {i} for you')
+
+    def test_short_conversations_are_not_summarized(self):
+        self.add_turns(0, 1)
+        self.assertIsNone(self.tg.maybe_summarize_conversation(self.user))
+
+    def test_older_turns_are_folded_into_summary(self):
+        self.add_turns(0, 10)
+        self.tg.maybe_summarize_conversation(self.user).result()
+
+        summary = self.tg.mdb.get_summary_for_phone_number(self.user)
+        self.assertEqual(summary['summary'], 'summary 1')
+        self.assertIn('Question number 0 please', self.prompts[0][1]['content'])
+        self.assertNotIn('Answer number 9 for you', self.prompts[0][1]['content'])
+
+        messages = self.tg.get_context_messages(self.user, 'Be brief.', summary=summary)
+        self.assertEqual(messages[1]['content'], 'Summary of the earlier conversation:\nsummary 1')
+        self.assertNotIn('Question number 0 please', [m['content'] for m in messages])
+        self.assertEqual(messages[-1]['content'], 'Answer number 9 for you')
+
+    def test_summary_is_updated_incrementally(self):
+        self.add_turns(0, 10)
+        self.tg.maybe_summarize_conversation(self.user).result()
+        self.add_turns(10, 20)
+        summary = self.tg.mdb.get_summary_for_phone_number(self.user)
+        self.tg.maybe_summarize_conversation(self.user, summary=summary).result()
+
+        second_prompt = self.prompts[1][1]['content']
+        self.assertIn('Current summary:\nsummary 1', second_prompt)
+        self.assertNotIn('Question number 0 please', second_prompt)
+        self.assertEqual(self.tg.mdb.get_summary_for_phone_number(self.user)['summary'], 'summary 2')
+
+    def test_handling_a_message_counts_tokens_in_memory(self):
+        for history_cache_mb in (64, 0):
+            tg = make_textgpt(summarize_after_tokens=40, history_cache_mb=history_cache_mb)
+            self.addCleanup(tg.close)
+            tg.openai_get_chat = lambda messages, **kwargs: 'summary'
+            for i in range(10):
+                tg.mdb.add_message(f'SID{i}', self.user, tg.number, f'Question number {i} please')
+                tg.mdb.add_message(f'SID{i}R', tg.number, self.user, f'Answer number {i} for you')
+            incoming = tg.mdb.add_message('SID', self.user, tg.number, 'One more question')
+
+            with mock.patch.object(tg.mdb, 'get_token_count_for_phone_number') as get_token_count:
+                tg.get_message_response(incoming, {'system_prompt': 'Be brief.', 'model': 'gpt-4'})
+                tg.summary_executor.submit(lambda: None).result()
+            get_token_count.assert_not_called()
+            self.assertEqual(tg.mdb.get_summary_for_phone_number(self.user)['summary'], 'summary')
+
+    def test_reset_messages_deletes_summary(self):
+        self.add_turns(0, 10)
+        self.tg.maybe_summarize_conversation(self.user).result()
+        self.tg.mdb.delete_messages_for_phone_number(self.user)
+        self.assertIsNone(self.tg.mdb.get_summary_for_phone_number(self.user))
+
+
+def fake_chat_stream(pieces, events):
+    # Stands in for openai.ChatCompletion.create(stream=True) and logs when each piece is generated
+    def create(**kwargs):
+        assert kwargs['stream']
+        yield {'choices': [{'delta': {'role': 'assistant'}}]}
+        for piece in pieces:
+            events.append(('token', piece))
+            yield {'choices': [{'delta': {'content': piece}}]}
+    return create
+
+
+class TestSMSSegments(unittest.TestCase):
+
+    def test_short_text_is_one_segment(self):
+        self.assertEqual(split_segments('Hello there.'), ['Hello there.'])
+
+    def test_segments_break_at_sentences(self):
+        text = 'Hello world. This is a test! ' * 10
+        segments = split_segments(text, 50)
+        self.assertTrue(all(len(segment) <= 50 for segment in segments))
+        self.assertTrue(all(segment[-1] in '.!' for segment in segments))
+        self.assertEqual(' '.join(segments), text.strip())
+
+    def test_segments_fall_back_to_whitespace_then_hard_cut(self):
+        self.assertEqual(split_segments('aaaa bbbb cccc dddd', 10), ['aaaa bbbb', 'cccc dddd'])
+        self.assertEqual(split_segments('x' * 25, 10), ['x' * 10, 'x' * 10, 'x' * 5])
+
+    def test_stream_segments_match_split_segments(self):
+        text = 'The quick brown fox jumps over the lazy dog. ' * 20
+        pieces = [text[i:i + 3] for i in range(0, len(text), 3)]
+        self.assertEqual(list(stream_segments(pieces, 100)), split_segments(text, 100))
+
+
+class TestStreamedResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt(stream=True)
+        self.events = []
+
+        def create(**kwargs):
+            self.events.append(('send', kwargs['body']))
+            return mock.Mock(sid=f'SM{len(self.events)}')
+        self.tg.client.messages.create.side_effect = create
+
+    def tearDown(self):
+        self.tg.close()
+
+    def test_segments_are_sent_while_streaming(self):
+        text = ''.join(f'This is sentence number {i}. ' for i in range(120))
+        pieces = [word + ' ' for word in text.split()]
+
+        with mock.patch('openai.ChatCompletion.create', fake_chat_stream(pieces, self.events)):
+            outgoing = self.tg.handle_incoming_message({
+                'MessageSid': 'SID1', 'From': '+1111111111', 'To': self.tg.number, 'Body': 'Count for me'})
+
+        sends = [i for i, (kind, _) in enumerate(self.events) if kind == 'send']
+        tokens = [i for i, (kind, _) in enumerate(self.events) if kind == 'token']
+        self.assertGreater(len(sends), 1)
+        # The first SMS goes out before the last token is generated
+        self.assertLess(sends[0], tokens[-1])
+
+        bodies = [self.events[i][1] for i in sends]
+        self.assertTrue(all(len(body) <= MAX_SEGMENT_SIZE for body in bodies))
+        self.assertTrue(all(body.endswith('.') for body in bodies))
+        self.assertEqual(' '.join(bodies), text.strip())
+        self.assertEqual(len(outgoing), 1)
+        self.assertEqual(outgoing[0].body, text.strip())
+
+    def test_stored_turn_keeps_breaks_between_segments(self):
+        # Each paragraph nearly fills a segment so the segments break between them
+        paragraphs = [f'Paragraph {i}. ' + 'Some more words here. ' * 72 for i in range(3)]
+        text = '\n\n'.join(paragraph.strip() for paragraph in paragraphs)
+        pieces = [text[i:i + 20] for i in range(0, len(text), 20)]
+
+        with mock.patch('openai.ChatCompletion.create', fake_chat_stream(pieces, self.events)):
+            outgoing = self.tg.handle_incoming_message({
+                'MessageSid': 'SID1', 'From': '+1111111111', 'To': self.tg.number, 'Body': 'Write paragraphs'})
+
+        self.assertGreater(len([kind for kind, _ in self.events if kind == 'send']), 1)
+        self.assertEqual(outgoing[0].body, text)
+
+
+class TestSendMessage(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.user = '+1111111111'
+        self.sent = []
+
+        def create(**kwargs):
+            self.sent.append(kwargs['body'])
+            return mock.Mock(sid=f"SM{kwargs['body'][:3]}")
+        self.tg.client.messages.create.side_effect = create
+
+    def tearDown(self):
+        self.tg.close()
+
+    def test_multi_segment_reply_is_one_message(self):
+        body = ' '.join(f'{i:03d} is a number.' for i in range(300))
+        outgoing = self.tg.send_message(self.user, body)
+
+        self.assertEqual(len(outgoing), 1)
+        self.assertEqual(len(self.sent), len(split_segments(body)))
+        stored = self.tg.mdb.get_messages_for_phone_number(self.user)
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(stored[0].body, body)
+        self.assertEqual(stored[0].message_sid, 'SM000')
+
+        segments = self.tg.mdb.get_message_segments(outgoing[0].message_id)
+        self.assertEqual([sequence for sequence, _, _ in segments], list(range(len(segments))))
+        self.assertEqual([segment for _, _, segment in segments], split_segments(body))
+        self.assertEqual([sid for _, sid, _ in segments], [f'SM{segment[:3]}' for segment in split_segments(body)])
+
+    def test_single_segment_reply_skips_the_executor(self):
+        with mock.patch.object(self.tg.send_executor, 'map') as send_map:
+            outgoing = self.tg.send_message(self.user, 'Short reply.')
+        send_map.assert_not_called()
+        self.assertEqual(self.sent, ['Short reply.'])
+        self.assertEqual(outgoing[0].message_sid, 'SMSho')
+
+    def test_assistant_turn_is_not_duplicated_in_context(self):
+        self.tg.mdb.add_message('SID1', self.user, self.tg.number, 'Tell me a long story')
+        body = 'Once upon a time. ' * 200
+        self.tg.send_message(self.user, body)
+
+        messages = self.tg.get_context_messages(self.user, 'Be brief.', 'gpt-4-32k')
+        self.assertEqual([m['role'] for m in messages], ['system', 'user', 'assistant'])
+
+
+class TestMessageDBCaches(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.db = MessageDB(":memory:")
+        self.db.add_phone_number("+1234567890")
+        self.db.add_settings("+1234567890", model="gpt-4", system_prompt="Be nice.", temperature=0.5)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_cached_lookups_skip_the_db(self):
+        self.db.get_settings_for_phone_number("+1234567890")
+        with self.assertNumQueries(self.db, 0):
+            self.assertEqual(self.db.get_phone_id("+1234567890"), self.db.add_phone_number("+1234567890"))
+            self.assertEqual(self.db.get_settings_for_phone_number("+1234567890")["model"], "gpt-4")
+            self.assertEqual(self.db.get_model(self.db.get_model_id("gpt-4")), "gpt-4")
+            self.db.add_model("gpt-4")
+        self.assertGreater(self.db.cache_stats()["settings"]["hits"], 0)
+
+    def test_cached_settings_are_copies(self):
+        self.db.get_settings_for_phone_number("+1234567890").pop("model")
+        self.assertEqual(self.db.get_settings_for_phone_number("+1234567890")["model"], "gpt-4")
+
+    def test_settings_writes_invalidate(self):
+        self.db.get_settings_for_phone_number("+1234567890")
+        self.db.update_settings_for_phone_number("+1234567890", temperature=0.9, model="gpt-3.5-turbo")
+        settings = self.db.get_settings_for_phone_number("+1234567890")
+        self.assertEqual(settings["temperature"], 0.9)
+        self.assertEqual(settings["model"], "gpt-3.5-turbo")
+
+    def test_disabled_caches(self):
+        db = MessageDB(":memory:", cache_enabled=False)
+        db.add_phone_number("+1234567890")
+        with self.assertNumQueries(db, 1):
+            db.get_phone_id("+1234567890")
+        self.assertEqual(db.cache_stats()["phone_ids"]["size"], 0)
+        db.close()
+
+    def test_lru_eviction_and_stale_puts(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+
+        generation = cache.generation
+        cache.pop("a")
+        cache.put("a", "stale", generation)
+        self.assertNotIn("a", cache)
+
+
+class TestWriteBehindJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+        # A long interval so only the tests decide when to flush
+        self.db = MessageDB(self.db_path, write_behind=True, flush_interval=60, flush_max_rows=1000)
+        self.user = '+1111111111'
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def count_committed_messages(self):
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_failing_entry_is_dropped_alone(self):
+        self.db.history_cache = HistoryCache(1024 * 1024, lambda message, phone_number: 'user')
+        self.db.add_message('SMDUP', '+15550000000', '+2222222222', 'Stored reply')
+        self.db.flush()
+        self.db.get_history_for_phone_number('+2222222222')
+
+        self.db.add_message('SID1', self.user, '+15550000000', 'First')
+        self.db.add_message('SMDUP', '+15550000000', '+2222222222', 'Same SID again')
+        self.db.add_message('SID3', '+3333333333', '+15550000000', 'Third')
+        self.assertEqual(len(self.db.history_cache.get('+2222222222').messages), 2)
+        with self.assertLogs('messagedb', 'ERROR'):
+            self.db.flush()
+
+        self.assertEqual(self.count_committed_messages(), 3)
+        self.assertEqual(self.db.journal.stats()['dropped_entries'], 1)
+        self.assertIsNone(self.db.history_cache.get('+2222222222'))
+        # Reloaded from the db without the dropped message
+        self.assertEqual([m['content'] for m in self.db.get_history_for_phone_number('+2222222222').messages],
+                         ['Stored reply'])
+
+    def test_writes_are_batched_until_flush(self):
+        for i in range(10):
+            self.db.add_message(f'SID{i}', self.user, '+15550000000', f'Message {i}')
+        self.assertEqual(self.count_committed_messages(), 0)
+
+        self.assertEqual(self.db.flush(), 30)
+        self.assertEqual(self.count_committed_messages(), 10)
+        stats = self.db.journal.stats()
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['last_batch_size'], 30)
+        self.assertGreater(stats['last_flush_seconds'], 0)
+
+    def test_read_your_writes(self):
+        first = self.db.add_message('SID1', self.user, '+15550000000', 'Hello')
+        self.db.flush()
+        second = self.db.add_message('SID2', '+15550000000', self.user, 'Hi')
+        self.db.add_message('SID3', '+2222222222', '+15550000000', 'Someone else')
+
+        messages = self.db.get_messages_for_phone_number(self.user)
+        self.assertEqual([m.message_id for m in messages], [first.message_id, second.message_id])
+        self.assertEqual(self.count_committed_messages(), 1)
+
+        self.db.add_settings(self.user, temperature=0.5)
+        self.assertEqual(self.db.get_settings_for_phone_number(self.user)['temperature'], 0.5)
+
+    def test_iter_messages_merges_pending_messages(self):
+        for i in range(4):
+            self.db.add_message(f'SID{i}', self.user, '+15550000000', f'Message {i}')
+            if i == 1:
+                self.db.flush()
+
+        messages = self.db.iter_messages_for_phone_number(self.user, newest_first=True, limit=3)
+        self.assertEqual([m.body for m in messages], ['Message 3', 'Message 2', 'Message 1'])
+        self.assertEqual(self.count_committed_messages(), 2)
+
+    def test_flush_on_max_rows(self):
+        self.db.journal.flush_max_rows = 6
+        self.db.add_message('SID1', self.user, '+15550000000', 'Hello')
+        self.db.add_message('SID2', '+15550000000', self.user, 'Hi')
+        for _ in range(100):
+            if self.db.journal.stats()['flushes']:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.count_committed_messages(), 2)
+
+    def test_close_flushes(self):
+        self.db.add_message('SID1', self.user, '+15550000000', 'Hello')
+        self.db.close()
+        self.assertEqual(self.count_committed_messages(), 1)
+
+
+class TestModelCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.tmpdir.cleanup()
+
+    def make_textgpt(self, model_list, **kwargs):
+        with mock.patch('openai.Model.list', side_effect=model_list):
+            tg = textgpt.textGPT(self.db_path, number='+15550000000', **kwargs)
+            startup_seconds = tg.init_seconds
+            tg.models_refreshed.wait(5)
+        return tg, startup_seconds
+
+    def test_startup_does_not_wait_for_model_list(self):
+        def slow_model_list():
+            self.release.wait(5)
+            return {'data': [{'id': 'gpt-4'}, {'id': 'gpt-3.5-turbo'}]}
+
+        with mock.patch('openai.Model.list', side_effect=slow_model_list):
+            tg = textgpt.textGPT(self.db_path, number='+15550000000')
+            self.assertLess(tg.init_seconds, 1)
+            self.assertEqual(tg.handle_command(Message(1, 'SID1', '+1', tg.number, '#models', '2023-01-01 00:00:00')),
+                             'Models are still loading, try again soon.')
+            self.release.set()
+            tg.models_refreshed.wait(5)
+
+        self.assertEqual(tg.all_models, ['gpt-3.5-turbo', 'gpt-4'])
+        self.assertIn('gpt-4', tg.handle_command(Message(1, 'SID1', '+1', tg.number, '#models', '2023-01-01 00:00:00')))
+        tg.close()
+
+    def test_default_model_resolves_before_catalog_loads(self):
+        with mock.patch('openai.Model.list', side_effect=lambda: self.release.wait(5) and {'data': []}):
+            tg = textgpt.textGPT(self.db_path, number='+15550000000')
+            tg.client = mock.Mock()
+            tg.client.messages.create.side_effect = fake_create_message
+            tg.openai_get_chat = mock.Mock(return_value='Hello!')
+            tg.handle_incoming_message({'MessageSid': 'SID1', 'From': '+1111111111', 'To': tg.number, 'Body': 'Hi'})
+            self.release.set()
+            tg.models_refreshed.wait(5)
+
+        self.assertEqual(tg.openai_get_chat.call_args.kwargs['model'], 'gpt-3.5-turbo')
+        tg.close()
+
+    def test_catalog_is_loaded_from_db_on_restart(self):
+        tg, _ = self.make_textgpt(lambda: {'data': [{'id': 'gpt-4'}]})
+        tg.close()
+
+        def unreachable():
+            raise textgpt.openai.error.APIConnectionError('unreachable')
+
+        tg, _ = self.make_textgpt(unreachable, models_ttl=0)
+        self.assertEqual(tg.all_models, ['gpt-4'])
+        tg.close()
+
+    def test_fresh_catalog_is_not_refetched(self):
+        tg, _ = self.make_textgpt(lambda: {'data': [{'id': 'gpt-4'}]})
+        tg.close()
+
+        model_list = mock.Mock()
+        tg, _ = self.make_textgpt(model_list)
+        model_list.assert_not_called()
+        self.assertEqual(tg.all_models, ['gpt-4'])
+        tg.close()
+
+    def test_catalog_is_saved_in_one_transaction(self):
+        db = MessageDB(self.db_path)
+        with count_queries(db) as statements:
+            db.upsert_models([f'model-{i}' for i in range(50)], 1000.0)
+        self.assertEqual(len([s for s in statements if s.startswith('COMMIT')]), 1)
+        self.assertEqual(db.get_model_catalog(), (sorted(f'model-{i}' for i in range(50)), 1000.0))
+        db.close()
+
+
+class TestQuotaEngine(QueryCountMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.db = MessageDB(":memory:")
+        self.db.add_phone_number("+1111111111")
+        self.quotas = QuotaEngine(self.db, messages_per_minute=2, daily_prompt_tokens=100,
+                                  daily_completion_tokens=50, model_limits={'gpt-4': (10, 10)}, checkpoint_interval=60)
+
+    def tearDown(self):
+        self.quotas.close()
+        self.db.close()
+
+    def test_messages_per_minute(self):
+        with self.assertNumQueries(self.db, 0):
+            self.assertIsNone(self.quotas.admit("+1111111111", "gpt-3.5-turbo"))
+            self.assertIsNone(self.quotas.admit("+1111111111", "gpt-3.5-turbo"))
+            self.assertIn("too fast", self.quotas.admit("+1111111111", "gpt-3.5-turbo"))
+        self.assertIsNone(self.quotas.admit("+2222222222", "gpt-3.5-turbo"))
+        self.assertEqual(self.quotas.stats()["rate_limited"], 1)
+
+    def test_daily_token_budgets_per_model(self):
+        self.quotas.record("+1111111111", "gpt-4", prompt_tokens=10, completion_tokens=5)
+        self.assertIn("daily token limit", self.quotas.admit("+1111111111", "gpt-4"))
+        self.assertIsNone(self.quotas.admit("+1111111111", "gpt-3.5-turbo"))
+
+        report = self.quotas.get_limits_report("+1111111111", "gpt-4")
+        self.assertIn("Prompt tokens left: 0 of 10", report)
+        self.assertIn("Completion tokens left: 5 of 10", report)
+
+    def test_usage_is_checkpointed_and_reloaded(self):
+        self.quotas.record("+1111111111", "gpt-3.5-turbo", prompt_tokens=60, completion_tokens=20)
+        with count_queries(self.db) as statements:
+            self.quotas.record("+1111111111", "gpt-3.5-turbo", prompt_tokens=40)
+        self.assertEqual(statements, [])
+
+        self.assertEqual(self.quotas.checkpoint(), 1)
+        self.assertEqual(self.quotas.checkpoint(), 0)
+        reloaded = QuotaEngine(self.db, daily_prompt_tokens=100)
+        self.assertIn("daily token limit", reloaded.admit("+1111111111", "gpt-3.5-turbo"))
+        reloaded.close()
+
+
+class TestLimitsInTextGPT(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.tg.quotas.close()
+        self.tg.quotas = QuotaEngine(self.tg.mdb, messages_per_minute=1)
+        self.tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        self.tg.client.messages.create.side_effect = fake_create_message
+
+    def tearDown(self):
+        self.tg.close()
+
+    def message(self, sid, body):
+        return {'MessageSid': sid, 'From': '+1111111111', 'To': self.tg.number, 'Body': body}
+
+    def test_over_limit_messages_skip_openai(self):
+        self.tg.handle_incoming_message(self.message('SID1', 'Hi'))
+        self.tg.handle_incoming_message(self.message('SID2', 'Hi again'))
+        self.assertEqual(self.tg.openai_get_chat.call_count, 1)
+        last_body = self.tg.client.messages.create.call_args.kwargs['body']
+        self.assertIn('too fast', last_body)
+
+        # Local commands are never limited
+        self.tg.handle_incoming_message(self.message('SID3', '#limits'))
+        last_body = self.tg.client.messages.create.call_args.kwargs['body']
+        self.assertIn('Messages left this minute: 0', last_body)
+        self.assertIn('Prompt tokens left', last_body)
+
+    def test_over_limit_texts_are_not_conversation_turns(self):
+        self.tg.handle_incoming_message(self.message('SID1', 'Hi'))
+        self.tg.handle_incoming_message(self.message('SID2', 'Hi again'))
+        self.assertIn('too fast', self.tg.client.messages.create.call_args.kwargs['body'])
+        self.assertEqual([m.body for m in self.tg.mdb.get_messages_for_phone_number('+1111111111')], ['Hi', 'Hello!'])
+
+        # A redelivery of an answered text is neither counted nor answered
+        sends = self.tg.client.messages.create.call_count
+        self.tg.quotas.close()
+        self.tg.quotas = QuotaEngine(self.tg.mdb, messages_per_minute=1)
+        self.tg.handle_incoming_message(self.message('SID1', 'Hi'))
+        self.assertEqual(self.tg.client.messages.create.call_count, sends)
+        self.tg.handle_incoming_message(self.message('SID3', 'Still there?'))
+        self.assertEqual([m['content'] for m in self.tg.openai_get_chat.call_args.args[0][1:]],
+                         ['Hi', 'Hello!', 'Still there?'])
+
+
+def make_png(width, height):
+    with BytesIO() as buffer:
+        Image.new('RGBA', (width, height)).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+
+def make_jpeg(width, height):
+    with BytesIO() as buffer:
+        Image.new('RGB', (width, height), color=(255, 0, 0)).save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    # path -> (body, send Content-Length)
+    images = {}
+
+    def do_GET(self):
+        body, send_length = self.images[self.path.split('?')[0]]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        if send_length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client stops reading once it knows the image is too large
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageDownloads(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ImageRequestHandler.images = {
+            '/small.png': (make_png(256, 256), True),
+            '/huge.png': (b'0' * (imageprocessor.MAX_DOWNLOAD_BYTES + 1), True),
+            '/huge-no-length.png': (b'0' * (imageprocessor.MAX_DOWNLOAD_BYTES + 1), False),
+            '/too-many-pixels.png': (make_png(5000, 5000), True),
+            '/not-an-image.png': (b'<html></html>', True),
+            '/wide.jpg': (make_jpeg(1200, 600), True),
+        }
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_valid_image(self):
+        image_bytes, mask_bytes = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/small.png')
+        self.assertEqual(image_bytes, ImageRequestHandler.images['/small.png'][0])
+        self.assertIsInstance(mask_bytes, bytes)
+        self.assertIs(imageprocessor.get_session(), imageprocessor.get_session())
+
+    def test_oversized_downloads_are_aborted(self):
+        for path in ('/huge.png', '/huge-no-length.png'):
+            with self.assertRaises(imageprocessor.ImageTooLargeError):
+                imageprocessor.download_image(f'{self.base_url}{path}')
+
+        error, mask_bytes = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/huge.png')
+        self.assertIn('too large', error)
+        self.assertIsNone(mask_bytes)
+        self.assertLessEqual(imageprocessor.get_download_stats()['max_download_bytes'],
+                             imageprocessor.MAX_DOWNLOAD_BYTES)
+
+    def test_header_is_checked_before_decoding(self):
+        with mock.patch('PIL.Image.Image.load') as load:
+            error, _ = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/too-many-pixels.png')
+        self.assertIn('Invalid image', error)
+        load.assert_not_called()
+
+        error, _ = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/not-an-image.png')
+        self.assertEqual(error, 'Error processing image with Pillow')
+
+    def test_images_are_normalized_with_one_encode(self):
+        with mock.patch('imageprocessor.encode_PNG', wraps=imageprocessor.encode_PNG) as encode_PNG:
+            image_bytes, mask_bytes = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/wide.jpg')
+        encode_PNG.assert_called_once()
+
+        img_obj = Image.open(BytesIO(image_bytes))
+        self.assertEqual((img_obj.format, img_obj.mode, img_obj.size), ('PNG', 'RGBA', (1024, 1024)))
+        # The padding is transparent and the image is centered
+        self.assertEqual(img_obj.getpixel((0, 0))[3], 0)
+        self.assertEqual(img_obj.getpixel((512, 512))[3], 255)
+        self.assertIs(mask_bytes, imageprocessor.TRANSPARENT_MASKS[1024])
+
+    def test_valid_pngs_are_not_reencoded(self):
+        with mock.patch('imageprocessor.encode_PNG') as encode_PNG:
+            image_bytes, mask_bytes = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/small.png')
+        encode_PNG.assert_not_called()
+        self.assertIs(mask_bytes, imageprocessor.TRANSPARENT_MASKS[256])
+
+    def test_normalize_in_process_pool(self):
+        with mock.patch('textgpt.IMAGE_PROCESSES', 1):
+            tg = make_textgpt()
+        self.addCleanup(tg.close)
+        self.assertEqual(tg.image_executor._mp_context.get_start_method(), 'forkserver')
+        image_bytes, mask_bytes = imageprocessor.get_image_bytes_if_valid(f'{self.base_url}/wide.jpg', tg.image_executor)
+        self.assertEqual(Image.open(BytesIO(image_bytes)).size, (1024, 1024))
+        self.assertEqual(Image.open(BytesIO(mask_bytes)).getextrema()[3], (0, 0))
+
+    def test_processed_images_are_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory)
+            url = f'{self.base_url}/wide.jpg'
+            first = imageprocessor.get_image_bytes_if_valid(url, cache=cache)
+
+            with mock.patch('imageprocessor.download_image') as download_image:
+                self.assertEqual(imageprocessor.get_image_bytes_if_valid(url, cache=cache), first)
+            download_image.assert_not_called()
+
+            # Same bytes from another url are downloaded but not normalized again
+            with mock.patch('imageprocessor.normalize_image') as normalize_image:
+                self.assertEqual(imageprocessor.get_image_bytes_if_valid(f'{url}?again', cache=cache), first)
+            normalize_image.assert_not_called()
+            self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_target_sizes(self):
+        self.assertEqual(imageprocessor.get_target_size(100, 80), 256)
+        self.assertEqual(imageprocessor.get_target_size(700, 300), 512)
+        self.assertEqual(imageprocessor.get_target_size(4000, 3000), 1024)
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lru_eviction_by_size(self):
+        cache = DiskCache(self.directory, max_bytes=30)
+        cache.put('a', b'a' * 10)
+        cache.put('b', b'b' * 10)
+        cache.put('c', b'c' * 10)
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        cache.put('d', b'd' * 10)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        stats = cache.stats()
+        self.assertEqual((stats['bytes'], stats['entries'], stats['evictions']), (30, 3, 1))
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_entries_survive_restart_and_expire(self):
+        DiskCache(self.directory).put('key', b'value')
+        cache = DiskCache(self.directory)
+        self.assertEqual(cache.get('key', max_age=60), b'value')
+        with mock.patch('diskcache.time', return_value=time() + 120):
+            self.assertIsNone(cache.get('key', max_age=60))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class TestImageResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tg = make_textgpt(image_cache_dir=self.tmpdir.name, image_result_ttl=60)
+
+    def tearDown(self):
+        self.tg.close()
+        self.tmpdir.cleanup()
+
+    def test_same_prompt_and_size_is_cached(self):
+        response = mock.Mock(data=[mock.Mock(url='http://image/1')])
+        with mock.patch('openai.Image.create', return_value=response) as create:
+            self.assertEqual(self.tg.openai_get_image('A cat 512x512'), 'http://image/1')
+            self.assertEqual(self.tg.openai_get_image('a  CAT 512x512'), 'http://image/1')
+            self.tg.openai_get_image('a cat 256x256')
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(self.tg.image_cache.stats()['hits'], 1)
+
+    def test_errors_are_not_cached(self):
+        with mock.patch('openai.Image.create', side_effect=openai.error.OpenAIError('down')) as create:
+            self.assertEqual(self.tg.openai_get_image('a cat'), 'down')
+            self.tg.openai_get_image('a cat')
+        self.assertEqual(create.call_count, 2)
+
+
+def make_chat_response(content):
+    return mock.Mock(choices=[mock.Mock(message=mock.Mock(content=content))])
+
+
+class TestCompletionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt(completion_cache_ttl=60)
+        self.messages = [{'role': 'system', 'content': 'Answer FAQs'}, {'role': 'user', 'content': 'Hours?'}]
+
+    def tearDown(self):
+        self.tg.close()
+
+    def test_deterministic_requests_are_cached(self):
+        with mock.patch('openai.ChatCompletion.create', return_value=make_chat_response('9 to 5')) as create:
+            for _ in range(3):
+                self.assertEqual(self.tg.openai_get_chat(
+                    self.messages, model='gpt-3.5-turbo', temperature=0, top_p=1.0), '9 to 5')
+            # Parameter order does not matter but values do
+            self.tg.openai_get_chat(self.messages, top_p=1.0, temperature=0.0, model='gpt-3.5-turbo')
+            self.tg.openai_get_chat(self.messages, model='gpt-4', temperature=0, top_p=1.0)
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(self.tg.completion_cache.stats()['gpt-3.5-turbo'],
+                         {'hits': 3, 'misses': 1, 'hit_rate': 0.75})
+
+    def test_sampled_requests_and_errors_are_not_cached(self):
+        with mock.patch('openai.ChatCompletion.create', return_value=make_chat_response('hi')) as create:
+            self.tg.openai_get_chat(self.messages, model='gpt-3.5-turbo', temperature=1.0)
+            self.tg.openai_get_chat(self.messages, model='gpt-3.5-turbo', temperature=1.0)
+            # Left for OpenAI to reject rather than raising before the request
+            self.tg.openai_get_chat(self.messages, model='gpt-3.5-turbo', temperature='warm')
+        self.assertEqual(create.call_count, 3)
+
+        with mock.patch('openai.ChatCompletion.create', side_effect=openai.error.OpenAIError('down')):
+            self.assertEqual(self.tg.openai_get_chat(self.messages, model='gpt-4', temperature=0), 'down')
+        self.assertIsNone(self.tg.completion_cache.get(
+            self.tg.completion_cache.make_key(self.messages, model='gpt-4', temperature=0), 'gpt-4'))
+
+    def test_ttl_and_lru_eviction(self):
+        cache = self.tg.completion_cache
+        cache.max_entries = 2
+        for key in ('a', 'b'):
+            cache.put(key, 'gpt-4', key.upper())
+        self.assertEqual(cache.get('a', 'gpt-4'), 'A')
+        cache.put('c', 'gpt-4', 'C')
+        self.assertIsNone(cache.get('b', 'gpt-4'))
+        self.assertEqual(cache.get('a', 'gpt-4'), 'A')
+
+        with mock.patch('completioncache.time', return_value=time() + 120):
+            self.assertIsNone(cache.get('a', 'gpt-4'))
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Each request takes the next (delay seconds, status, content) from script, or answers 'ok' right away
+    script = []
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.lock:
+            FakeOpenAIHandler.requests += 1
+            delay, status, content = self.script.pop(0) if self.script else (0, 200, 'ok')
+        sleep(delay)
+        if status == 200:
+            body = {'id': 'chatcmpl-1', 'object': 'chat.completion',
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}]}
+        else:
+            body = {'error': {'message': content, 'type': 'server_error'}}
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(data)
+        except ConnectionError:
+            # The client gave up on this request
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOpenAIClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAIHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.api_base, cls.api_key = openai.api_base, openai.api_key
+        openai.api_base = f'http://127.0.0.1:{cls.server.server_port}/v1'
+        openai.api_key = 'test'
+
+    @classmethod
+    def tearDownClass(cls):
+        openai.api_base, openai.api_key = cls.api_base, cls.api_key
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeOpenAIHandler.script = []
+        FakeOpenAIHandler.requests = 0
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def make_client(self, **kwargs):
+        client = OpenAIClient(**{'backoff_base': 0.01, **kwargs})
+        self.clients.append(client)
+        return client
+
+    def chat(self, client):
+        response = client.call(openai.ChatCompletion.create, model='gpt-3.5-turbo',
+                               messages=[{'role': 'user', 'content': 'hi'}])
+        return response.choices[0].message.content
+
+    def test_retriable_errors_are_retried(self):
+        client = self.make_client()
+        FakeOpenAIHandler.script = [(0, 500, 'boom'), (0, 429, 'slow down'), (0, 200, 'hello')]
+        self.assertEqual(self.chat(client), 'hello')
+        self.assertEqual(FakeOpenAIHandler.requests, 3)
+        self.assertEqual(client.stats()['retries'], 2)
+
+    def test_bad_requests_are_not_retried(self):
+        client = self.make_client()
+        FakeOpenAIHandler.script = [(0, 400, 'bad request')]
+        with self.assertRaises(openai.error.InvalidRequestError):
+            self.chat(client)
+        self.assertEqual(FakeOpenAIHandler.requests, 1)
+        self.assertEqual(client.stats()['circuits']['gpt-3.5-turbo'], 'closed')
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        client = self.make_client(max_retries=0, failure_threshold=2, reset_seconds=0.2)
+        FakeOpenAIHandler.script = [(0, 503, 'down'), (0, 503, 'down')]
+        for _ in range(2):
+            with self.assertRaises(openai.error.ServiceUnavailableError):
+                self.chat(client)
+        with self.assertRaises(CircuitOpenError):
+            self.chat(client)
+        self.assertEqual(FakeOpenAIHandler.requests, 2)
+        self.assertEqual(client.stats()['rejected'], 1)
+
+        sleep(0.25)
+        self.assertEqual(self.chat(client), 'ok')
+        self.assertEqual(client.stats()['circuits']['gpt-3.5-turbo'], 'closed')
+
+    def test_slow_requests_hit_the_deadline(self):
+        client = self.make_client(timeout=0.2, deadline=0.5, max_retries=5)
+        FakeOpenAIHandler.script = [(1, 200, 'late')] * 5
+        started_at = monotonic()
+        with self.assertRaises(openai.error.Timeout):
+            self.chat(client)
+        self.assertLess(monotonic() - started_at, 0.9)
+
+    def test_openai_cannot_close_the_shared_session(self):
+        client = self.make_client()
+        self.chat(client)
+        pools = client.session.get_adapter(openai.api_base).poolmanager.pools
+        # What openai does with the session of a thread once it is a few minutes old
+        client.session.close()
+        self.assertEqual(len(pools), 1)
+        client.close()
+        self.assertEqual(len(pools), 0)
+
+    def test_timed_out_attempts_are_not_sent_later(self):
+        # Without a request_timeout the first attempt holds the only thread while the retries queue behind it
+        client = self.make_client(timeout=0.2, deadline=0.5, max_retries=5, workers=1)
+        attempts = []
+
+        def slow_getter(**kwargs):
+            attempts.append(kwargs)
+            sleep(1)
+
+        with self.assertRaises(openai.error.Timeout):
+            client.call(slow_getter, model='dall-e')
+        sleep(1.2)
+        self.assertEqual(len(attempts), 1)
+
+    def test_slow_requests_are_hedged(self):
+        client = self.make_client(hedge=True, hedge_min_samples=5)
+        for _ in range(5):
+            self.chat(client)
+        FakeOpenAIHandler.script = [(1, 200, 'slow'), (0, 200, 'fast')]
+        started_at = monotonic()
+        self.assertEqual(self.chat(client), 'fast')
+        self.assertLess(monotonic() - started_at, 0.9)
+        stats = client.stats()
+        self.assertEqual((stats['hedged'], stats['hedge_wins']), (1, 1))
+
+
+class TestBenchmarks(unittest.TestCase):
+    # Smoke tests so the benchmark scripts keep working as the code changes
+
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+        cls.api_base, cls.api_key = openai.api_base, openai.api_key
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.pop(0)
+        openai.api_base, openai.api_key = cls.api_base, cls.api_key
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_messagedb_benchmark_and_compare(self):
+        import bench_messagedb
+        import compare
+        output = os.path.join(self.tmpdir.name, 'messagedb.json')
+        with mock.patch('sys.stderr'):
+            results = bench_messagedb.main(['--sizes', '500', '--numbers', '10', '--iterations', '5',
+                                            '--output', output])
+        self.assertEqual(results['benchmark'], 'messagedb')
+        self.assertEqual(results['results']['500']['add_message']['count'], 5)
+
+        with open(output) as f:
+            baseline = json.load(f)
+        slower = json.loads(json.dumps(baseline))
+        slower['results']['500']['add_message']['p95_ms'] *= 2
+        regressions = compare.compare(baseline, slower, threshold=0.1)
+        self.assertEqual([metric for metric, *_ in regressions], ['500.add_message.p95_ms'])
+        self.assertEqual(compare.compare(baseline, baseline), [])
+
+    def test_end_to_end_benchmark(self):
+        import bench_e2e
+        with mock.patch('sys.stderr'), mock.patch('sys.stdout'):
+            results = bench_e2e.main(['--numbers', '3', '--messages', '12', '--history', '4',
+                                      '--openai-latency', '0.01', '--twilio-latency', '0'])['results']
+        self.assertEqual(results['timeouts'], 0)
+        self.assertEqual(results['latency']['end_to_end']['count'], 12)
+        self.assertEqual(set(results['stages']), {'db', 'llm', 'send'})
+        self.assertGreater(results['throughput_msgs_per_s'], 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def tearDown(self):
+        metrics.set_enabled(True)
+
+    def test_histogram_and_counter_exposition(self):
+        histogram = self.registry.histogram('test_seconds', 'Test latency', ('op',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'read')
+        histogram.observe(0.5, 'read')
+        histogram.observe(5, 'read')
+        self.registry.counter('test_total', 'Test count', ('op',)).inc('say "hi"', amount=2)
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{op="read",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{op="read",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{op="read",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{op="read"} 3', lines)
+        self.assertIn('test_total{op="say \\"hi\\""} 2', lines)
+
+    def test_spans_are_skipped_when_disabled(self):
+        @metrics.timed('test', 'disabled_op')
+        def fn():
+            return 1
+
+        metrics.set_enabled(False)
+        self.assertEqual(fn(), 1)
+        self.assertIs(metrics.span('test', 'disabled_op'), metrics.NULL_SPAN)
+        self.assertNotIn(('test', 'disabled_op'), metrics.stage_seconds.values)
+
+        metrics.set_enabled(True)
+        fn()
+        with self.assertRaises(ValueError), metrics.span('test', 'failing_op'):
+            raise ValueError
+        self.assertEqual(sum(metrics.stage_seconds.values[('test', 'disabled_op')][0]), 1)
+        self.assertEqual(metrics.stage_errors.values[('test', 'failing_op')], 1)
+
+    def test_json_log_lines(self):
+        record = logging.LogRecord('messagedb', logging.INFO, __file__, 1, 'Added %s', ('+1111111111',), None)
+        record.phone_id = 7
+        entry = json.loads(textgpt.JsonFormatter().format(record))
+        self.assertEqual((entry['logger'], entry['level'], entry['message'], entry['phone_id']),
+                         ('messagedb', 'INFO', 'Added +1111111111', 7))
+
+
+class TestMetricsRoute(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        self.tg.client.messages.create.side_effect = fake_create_message
+        textgpt.textgpt = self.tg
+        self.client = textgpt.app.test_client()
+
+    def tearDown(self):
+        self.tg.close()
+
+    def test_stages_are_exported(self):
+        with self.assertNoLogs('messagedb', logging.INFO):
+            self.tg.handle_incoming_message(
+                {'MessageSid': 'SID1', 'From': '+1111111111', 'To': self.tg.number, 'Body': 'Hi'})
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        for labels in ('stage="handler",operation="handle_incoming_message"', 'stage="db",operation="add_message"',
+                       'stage="twilio",operation="messages.create"'):
+            self.assertIn(f'textgpt_stage_seconds_count{{{labels}}}', body)
+        self.assertIn('textgpt_component_stat{component="quotas",stat="admitted"} 1', body)
+
+    def test_image_downloads_are_exported(self):
+        with mock.patch.dict(imageprocessor.download_stats, rejected_too_large=3, max_decoded_bytes=4096):
+            body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('textgpt_component_stat{component="image_download",stat="rejected_too_large"} 3', body)
+        self.assertIn('textgpt_component_stat{component="image_download",stat="max_decoded_bytes"} 4096', body)
+
+    def test_disabled(self):
+        metrics.set_enabled(False)
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        finally:
+            metrics.set_enabled(True)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_submit_and_stats(self):
+        handled = []
+        release = threading.Event()
+
+        def handler(payload):
+            release.wait()
+            handled.append(payload['MessageSid'])
+
+        pool = WorkerPool(handler, num_workers=2)
+        for i in range(5):
+            pool.submit({'MessageSid': f'SID{i}'})
+        self.assertGreater(pool.stats()['queue_depth'], 0)
+
+        release.set()
+        pool.join()
+        stats = pool.stats()
+        self.assertEqual(sorted(handled), [f'SID{i}' for i in range(5)])
+        self.assertEqual(stats['processed'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreater(stats['max_queue_seconds'], 0)
+        pool.stop()
+
+    def test_handler_errors_are_counted(self):
+        def handler(payload):
+            raise ValueError('boom')
+
+        pool = WorkerPool(handler, num_workers=1)
+        pool.submit({'MessageSid': 'SID1'})
+        pool.join()
+        self.assertEqual(pool.stats()['failed'], 1)
+        pool.stop()
+
+    def test_same_key_runs_in_order_and_keys_run_in_parallel(self):
+        handled = []
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+        both_started = threading.Barrier(2, timeout=5)
+
+        def handler(payload):
+            with lock:
+                if payload['From'] in running:
+                    overlaps.append(payload['From'])
+                running.add(payload['From'])
+            if payload['MessageSid'].endswith('0'):
+                # The first message of each number only finishes once both numbers are running
+                both_started.wait()
+            with lock:
+                handled.append(payload['MessageSid'])
+                running.discard(payload['From'])
+
+        pool = WorkerPool(handler, num_workers=4, key_fn=lambda payload: payload['From'])
+        for i in range(5):
+            for from_number in ('A', 'B'):
+                pool.submit({'MessageSid': f'{from_number}{i}', 'From': from_number})
+        pool.join()
+        pool.stop()
+
+        self.assertEqual(overlaps, [])
+        for from_number in ('A', 'B'):
+            self.assertEqual([sid for sid in handled if sid[0] == from_number],
+                             [f'{from_number}{i}' for i in range(5)])
+        self.assertEqual(pool.stats()['active_keys'], 0)
+
+    def test_waiting_payloads_are_coalesced(self):
+        handled = []
+        release = threading.Event()
+
+        def handler(payload):
+            release.wait()
+            handled.append(payload)
+
+        def coalesce(payloads):
+            return [{'MessageSid': payloads[-1]['MessageSid'], 'Merged': len(payloads)}]
+
+        pool = WorkerPool(handler, num_workers=2, key_fn=lambda payload: 'A', coalesce_fn=coalesce)
+        pool.submit({'MessageSid': 'SID0'})
+        # Wait for the first payload to be taken before the rest arrive
+        while pool.stats()['queue_depth']:
+            pass
+        for i in range(1, 4):
+            pool.submit({'MessageSid': f'SID{i}'})
+        release.set()
+        pool.join()
+        pool.stop()
+
+        self.assertEqual(handled, [{'MessageSid': 'SID0'}, {'MessageSid': 'SID3', 'Merged': 3}])
+        self.assertEqual(pool.stats()['coalesced'], 2)
+
+    def test_priority_keys_run_first_in_key_order(self):
+        handled = []
+        release = threading.Event()
+
+        def handler(payload):
+            if payload['MessageSid'] == 'A0':
+                release.wait(5)
+            handled.append(payload['MessageSid'])
+
+        pool = WorkerPool(handler, num_workers=1, key_fn=lambda payload: payload['MessageSid'][0],
+                          priority_fn=lambda payload: payload['MessageSid'].endswith('!'))
+        pool.submit({'MessageSid': 'A0'})
+        while pool.stats()['queue_depth']:
+            pass
+        for sid in ('B0', 'A1!', 'C0!'):
+            pool.submit({'MessageSid': sid})
+        self.assertEqual(pool.stats()['priority_queue_depth'], 2)
+        release.set()
+        pool.join()
+        pool.stop()
+
+        # C jumps ahead of B. A1! waits for A0 and then goes ahead of B too
+        self.assertEqual(handled, ['A0', 'C0!', 'A1!', 'B0'])
+
+
+class TestCoalescedMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        self.tg.client.messages.create.side_effect = fake_create_message
+
+    def tearDown(self):
+        self.tg.close()
+
+    def message(self, sid, body, **kwargs):
+        return {'MessageSid': sid, 'From': '+1111111111', 'To': self.tg.number, 'Body': body, **kwargs}
+
+    def test_only_runs_of_plain_texts_are_merged(self):
+        coalesced = self.tg.coalesce_messages([
+            self.message('SID1', 'Hi'), self.message('SID2', 'are you there'),
+            self.message('SID3', '#help'), self.message('SID4', 'look', MediaUrl0='http://x'),
+            self.message('SID5', 'one'), self.message('SID6', 'two'), self.message('SID7', 'three')])
+        self.assertEqual([values['MessageSid'] for values in coalesced], ['SID2', 'SID3', 'SID4', 'SID7'])
+        self.assertEqual([values['MessageSid'] for values in coalesced[-1]['Coalesced']], ['SID5', 'SID6'])
+
+    def test_coalesced_texts_are_stored_and_answered_once(self):
+        coalesced, = self.tg.coalesce_messages([self.message('SID1', 'Hi'), self.message('SID2', 'are you there')])
+        self.tg.handle_incoming_message(coalesced)
+
+        self.assertEqual(self.tg.openai_get_chat.call_count, 1)
+        openai_messages = self.tg.openai_get_chat.call_args.args[0]
+        self.assertEqual([message['content'] for message in openai_messages[1:]], ['Hi', 'are you there'])
+        stored = self.tg.mdb.get_messages_for_phone_number('+1111111111')
+        self.assertEqual([message.body for message in stored], ['Hi', 'are you there', 'Hello!'])
+
+    def test_webhook_cannot_set_coalesced(self):
+        self.assertIsNone(self.tg.enqueue_incoming_message(self.message('SID1', 'Hi', Coalesced='x')))
+        self.assertEqual(self.tg.client.messages.create.call_args.kwargs['body'], 'Hello!')
+
+
+class TestIdempotentIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt()
+        self.tg.openai_get_chat = mock.Mock(return_value='Hello!')
+        self.tg.client.messages.create.side_effect = fake_create_message
+
+    def tearDown(self):
+        self.tg.close()
+
+    def message(self, sid, body):
+        return {'MessageSid': sid, 'From': '+1111111111', 'To': self.tg.number, 'Body': body}
+
+    def test_duplicate_message_sid_is_ignored(self):
+        for mdb in (MessageDB(':memory:'), MessageDB(':memory:', write_behind=True)):
+            first = mdb.add_message('SID1', '+1111111111', '+2222222222', 'Hi', ignore_duplicate=True)
+            self.assertIsNone(mdb.add_message('SID1', '+1111111111', '+2222222222', 'Hi', ignore_duplicate=True))
+            mdb.flush()
+            self.assertIsNone(mdb.add_message('SID1', '+1111111111', '+2222222222', 'Hi', ignore_duplicate=True))
+
+            self.assertEqual(mdb.duplicate_messages, 2)
+            self.assertEqual([message.message_id for message in mdb.get_messages_for_phone_number('+1111111111')],
+                             [first.message_id])
+            mdb.close()
+
+    def test_redelivered_webhook_gets_no_reply(self):
+        self.tg.handle_incoming_message(self.message('SID1', 'Hi'))
+        self.assertIsNone(self.tg.handle_incoming_message(self.message('SID1', 'Hi')))
+
+        self.assertEqual(self.tg.openai_get_chat.call_count, 1)
+        self.assertEqual(self.tg.client.messages.create.call_count, 1)
+        stored = self.tg.mdb.get_messages_for_phone_number('+1111111111')
+        self.assertEqual([message.body for message in stored], ['Hi', 'Hello!'])
+        self.tg.update_metrics()
+        self.assertIn('textgpt_component_stat{component="ingest",stat="duplicate_messages"} 1',
+                      metrics.registry.render())
+
+    def test_redelivery_coalesced_with_new_text_answers_new_text(self):
+        self.tg.handle_incoming_message(self.message('SID1', 'Hi'))
+        coalesced, = self.tg.coalesce_messages([self.message('SID2', 'are you there'), self.message('SID1', 'Hi')])
+        self.tg.handle_incoming_message(coalesced)
+
+        self.assertEqual(self.tg.openai_get_chat.call_count, 2)
+        stored = self.tg.mdb.get_messages_for_phone_number('+1111111111')
+        self.assertEqual([message.body for message in stored], ['Hi', 'Hello!', 'are you there', 'Hello!'])
+
+
+class TestLoadShedding(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.tg = make_textgpt(num_workers=1, queue_high_water=2)
+        self.tg.client.messages.create.side_effect = fake_create_message
+        self.started = threading.Event()
+
+        handle_incoming_message = self.tg.handle_incoming_message
+
+        def blocked_handler(message_values):
+            # OpenAI messages hang until released, local commands are handled
+            if not self.tg.uses_openai(message_values['Body']):
+                return handle_incoming_message(message_values)
+            self.started.set()
+            self.release.wait(5)
+        self.tg.worker_pool.handler = blocked_handler
+        textgpt.textgpt = self.tg
+        self.client = textgpt.app.test_client()
+
+    def tearDown(self):
+        self.release.set()
+        self.tg.close()
+
+    def message(self, sid, body, from_number='+1111111111'):
+        return {'MessageSid': sid, 'From': from_number, 'To': self.tg.number, 'Body': body}
+
+    def wait_for_sends(self, tg, n):
+        for _ in range(500):
+            if tg.client.messages.create.call_count >= n:
+                break
+            sleep(0.01)
+
+    def test_chats_over_high_water_get_busy_reply(self):
+        self.assertIsNone(self.tg.enqueue_incoming_message(self.message('SID1', 'Hi')))
+        self.started.wait(5)
+        for i in (2, 3):
+            self.assertIsNone(self.tg.enqueue_incoming_message(self.message(f'SID{i}', 'Hi')))
+
+        response = self.client.post('/sms', data=self.message('SID4', 'Hi'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(textgpt.BUSY_REPLY.encode(), response.data)
+        self.assertEqual(self.tg.shed, 1)
+        self.assertEqual(self.tg.worker_pool.stats()['rejected'], 1)
+        self.tg.update_metrics()
+        self.assertIn('textgpt_component_stat{component="admission",stat="shed"} 1', metrics.registry.render())
+
+    def test_local_commands_skip_the_backlog(self):
+        self.tg.enqueue_incoming_message(self.message('SID1', 'Hi'))
+        self.started.wait(5)
+        # The only ordinary worker is busy so a priority worker answers the other number
+        self.tg.enqueue_incoming_message(self.message('SID2', '#get model', '+2222222222'))
+        self.wait_for_sends(self.tg, 1)
+
+        self.tg.client.messages.create.assert_called_once()
+        self.assertIn('model', self.tg.client.messages.create.call_args.kwargs['body'])
+        self.assertEqual(self.tg.worker_pool.stats()['processed'], 1)
+
+    def test_command_waits_for_chat_of_same_number(self):
+        tg = make_textgpt(num_workers=2, priority_workers=1)
+        self.addCleanup(tg.close)
+        tg.client.messages.create.side_effect = fake_create_message
+        chat_started = threading.Event()
+
+        def openai_get_chat(*args, **kwargs):
+            chat_started.set()
+            self.release.wait(5)
+            return 'reply'
+        tg.openai_get_chat = openai_get_chat
+
+        tg.enqueue_incoming_message(self.message('SID1', 'hello'))
+        chat_started.wait(5)
+        tg.enqueue_incoming_message(self.message('SID2', '#reset messages'))
+        tg.enqueue_incoming_message(self.message('SID3', '#help', '+2222222222'))
+        self.wait_for_sends(tg, 1)
+        # Other numbers still skip the chat but the reset waits behind it
+        self.assertEqual(tg.client.messages.create.call_args.kwargs['to'], '+2222222222')
+        self.assertEqual([message.body for message in tg.mdb.get_messages_for_phone_number('+1111111111')], ['hello'])
+
+        self.release.set()
+        tg.worker_pool.join()
+        bodies = [call.kwargs['body'] for call in tg.client.messages.create.call_args_list
+                  if call.kwargs['to'] == '+1111111111']
+        self.assertEqual(bodies, ['reply', 'Your conversation has been reset.'])
+        self.assertEqual([message.body for message in tg.mdb.get_messages_for_phone_number('+1111111111')],
+                         ['Your conversation has been reset.'])
+
+    def test_without_workers_inflight_chats_are_bounded(self):
+        tg = make_textgpt(queue_high_water=1)
+        self.addCleanup(tg.close)
+        tg.client.messages.create.side_effect = fake_create_message
+        tg.inflight = 1
+
+        self.assertEqual(tg.enqueue_incoming_message(self.message('SID1', 'Hi')), textgpt.BUSY_REPLY)
+        self.assertIsNone(tg.enqueue_incoming_message(self.message('SID2', '#get model')))
+        tg.client.messages.create.assert_called_once()
+        self.assertEqual((tg.shed, tg.inflight), (1, 1))
+
+    def test_without_workers_conversation_locks_are_released(self):
+        tg = make_textgpt()
+        self.addCleanup(tg.close)
+        order = []
+
+        def handle(name):
+            with tg.conversation_lock('+1111111111'):
+                order.append(name)
+                self.release.wait(5)
+
+        threads = [threading.Thread(target=handle, args=(name,)) for name in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+            sleep(0.05)
+        # One thread holds the lock and the other waits on the same entry
+        self.assertEqual(order, ['first'])
+        self.assertEqual(tg.conversation_locks['+1111111111'][1], 2)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(tg.conversation_locks, {})
+
+    def test_worker_pool_is_bounded(self):
+        pool = WorkerPool(lambda payload: self.release.wait(5), num_workers=1, max_pending=1)
+        self.addCleanup(pool.stop, False)
+        self.assertEqual(pool.submit({'MessageSid': 'SID1'}), 1)
+        for _ in range(100):
+            if not pool.stats()['queue_depth']:
+                break
+            sleep(0.01)
+        self.assertEqual(pool.submit({'MessageSid': 'SID2'}), 1)
+        self.assertIsNone(pool.submit({'MessageSid': 'SID3'}))
+        self.assertEqual(pool.stats()['rejected'], 1)
+        self.release.set()
+
+
+class TestIncomingSMSRoute(unittest.TestCase):
+
+    def setUp(self):
+        self.tg = make_textgpt(num_workers=1)
+        self.handled = []
+        self.tg.worker_pool.handler = self.handled.append
+        textgpt.textgpt = self.tg
+        self.client = textgpt.app.test_client()
+
+    def tearDown(self):
+        self.tg.close()
+
+    def test_webhook_is_acknowledged_and_queued(self):
+        response = self.client.post('/sms', data={
+            'MessageSid': 'SID1', 'From': '+1111111111', 'To': '+15550000000', 'Body': 'hi'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<Response />', response.data)
+
+        self.tg.worker_pool.join()
+        self.assertEqual(self.handled[0]['Body'], 'hi')
+
+    def test_invalid_webhook_is_rejected(self):
+        response = self.client.post('/sms', data={'Body': 'hi'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.tg.worker_pool.stats()['submitted'], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
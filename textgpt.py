@@ -1,5 +1,11 @@
 
 from os import environ
+import json
+import logging
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flask import Flask, request, redirect
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
@@ -8,14 +14,118 @@ from openai import OpenAIError
 
 from messagedb import MessageDB, Message
 from datetime import datetime
-from imageprocessor import get_image_bytes_if_valid
+from time import monotonic, time
+from imageprocessor import get_download_stats, get_image_bytes_if_valid
+from workerpool import WorkerPool
+from diskcache import DiskCache
+from historycache import HistoryCache
+from completioncache import CompletionCache
+from openaiclient import OpenAIClient
+from quotas import QuotaEngine
+from smssegments import MAX_SEGMENT_SIZE, split_segments, stream_segments
+from tokencounter import count_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, DEFAULT_COMPLETION_TOKENS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Startup time is measured from when this module is first imported
+PROCESS_STARTED_AT = monotonic()
 
 TWILIO_PHONE_NUMBER = environ.get('TWILIO_PHONE_NUMBER')
 TWILIO_AUTH_TOKEN = environ.get('TWILIO_AUTH_TOKEN')
 TWILIO_ACCOUNT_SID = environ.get('TWILIO_ACCOUNT_SID')
 OPENAI_API_KEY = environ.get('OPENAI_API_KEY')
 
-DEFAULT_SETTINGS = {'model_id': 18,  # gpt3.5-turbo
+# Number of background workers handling webhooks. 0 handles them synchronously in the Flask thread
+TEXTGPT_WORKERS = int(environ.get('TEXTGPT_WORKERS', 0))
+REQUIRED_MESSAGE_KEYS = ('MessageSid', 'From', 'To')
+
+# Admission control. Messages that need OpenAI get BUSY_REPLY once this many are waiting for a worker, or being
+# handled without workers. 0 never sheds them. Numbers whose next message is a command answered locally run
+# before numbers waiting on OpenAI, also on TEXTGPT_PRIORITY_WORKERS threads of their own
+QUEUE_HIGH_WATER = int(environ.get('TEXTGPT_QUEUE_HIGH_WATER', 100))
+PRIORITY_WORKERS = int(environ.get('TEXTGPT_PRIORITY_WORKERS', 2))
+PRIORITY_QUEUE_MAX = int(environ.get('TEXTGPT_PRIORITY_QUEUE_MAX', 1000))
+BUSY_REPLY = 'textGPT is busy right now. Please try again in a minute.'
+
+# Merge texts that arrive from a number while its last one is being answered into a single OpenAI call
+COALESCE_MESSAGES = environ.get('TEXTGPT_COALESCE', '').lower() in ('1', 'true', 'yes')
+
+# Fold older turns into a stored summary once the unsummarized conversation is over this many tokens. 0 disables it
+SUMMARIZE_AFTER_TOKENS = int(environ.get('TEXTGPT_SUMMARIZE_AFTER_TOKENS', 0))
+
+# Queue db writes in memory and commit them in batches every TEXTGPT_FLUSH_INTERVAL_MS or TEXTGPT_FLUSH_MAX_ROWS
+WRITE_BEHIND = environ.get('TEXTGPT_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+FLUSH_INTERVAL_MS = int(environ.get('TEXTGPT_FLUSH_INTERVAL_MS', 50))
+FLUSH_MAX_ROWS = int(environ.get('TEXTGPT_FLUSH_MAX_ROWS', 100))
+
+# Entries per MessageDB lookup cache. 0 disables the caches
+DB_CACHE_SIZE = int(environ.get('TEXTGPT_DB_CACHE_SIZE', 1024))
+# Memory for the ready to send history of recently active conversations. 0 reads every prompt from the db
+HISTORY_CACHE_MB = int(environ.get('TEXTGPT_HISTORY_CACHE_MB', 64))
+
+# Long-term memory. When a directory is set the prompt is the newest turns plus the older messages most
+# similar to the new text instead of all the history that fits. TEXTGPT_MEMORY_EMBEDDER is hashing or openai
+MEMORY_DIR = environ.get('TEXTGPT_MEMORY_DIR', '')
+MEMORY_EMBEDDER = environ.get('TEXTGPT_MEMORY_EMBEDDER', 'hashing')
+MEMORY_RECENT_MESSAGES = int(environ.get('TEXTGPT_MEMORY_RECENT_MESSAGES', 10))
+MEMORY_TOP_K = int(environ.get('TEXTGPT_MEMORY_TOP_K', 5))
+
+# Refresh the model catalog in the background once it is older than this. Failed refreshes are retried sooner
+MODELS_TTL_SECONDS = int(environ.get('TEXTGPT_MODELS_TTL_SECONDS', 24 * 60 * 60))
+MODELS_RETRY_SECONDS = 60
+
+# Per phone number limits. 0 means unlimited. Usage is checkpointed to the db every TEXTGPT_QUOTA_CHECKPOINT_SECONDS
+MESSAGES_PER_MINUTE = int(environ.get('TEXTGPT_MESSAGES_PER_MINUTE', 10))
+DAILY_PROMPT_TOKENS = int(environ.get('TEXTGPT_DAILY_PROMPT_TOKENS', 200000))
+DAILY_COMPLETION_TOKENS = int(environ.get('TEXTGPT_DAILY_COMPLETION_TOKENS', 50000))
+QUOTA_CHECKPOINT_SECONDS = int(environ.get('TEXTGPT_QUOTA_CHECKPOINT_SECONDS', 60))
+
+# Max segments of one reply sent to Twilio at the same time. Each worker gets this many send threads
+SEND_WORKERS = int(environ.get('TEXTGPT_SEND_WORKERS', 4))
+
+# Processes that decode and resize images for #image edit/variation. 0 does it in the handling thread
+IMAGE_PROCESSES = int(environ.get('TEXTGPT_IMAGE_PROCESSES', 0))
+
+# Cache downloaded and normalized images on disk, up to TEXTGPT_IMAGE_CACHE_MB. Empty disables it
+IMAGE_CACHE_DIR = environ.get('TEXTGPT_IMAGE_CACHE_DIR', '')
+IMAGE_CACHE_MB = int(environ.get('TEXTGPT_IMAGE_CACHE_MB', 256))
+# Reuse #image create results for the same prompt and size for this long. 0 disables it. OpenAI image urls expire after an hour
+IMAGE_RESULT_TTL_SECONDS = int(environ.get('TEXTGPT_IMAGE_RESULT_TTL_SECONDS', 0))
+
+# Reuse completions of temperature 0 requests with the same model, messages and settings. 0 disables it
+COMPLETION_CACHE_TTL_SECONDS = int(environ.get('TEXTGPT_COMPLETION_CACHE_TTL_SECONDS', 0))
+COMPLETION_CACHE_MAX_ENTRIES = int(environ.get('TEXTGPT_COMPLETION_CACHE_MAX_ENTRIES', 10000))
+
+# Seconds per OpenAI attempt and for all attempts of one call. Rate limits, timeouts and 5xx errors are retried
+OPENAI_TIMEOUT_SECONDS = float(environ.get('TEXTGPT_OPENAI_TIMEOUT_SECONDS', 30))
+OPENAI_DEADLINE_SECONDS = float(environ.get('TEXTGPT_OPENAI_DEADLINE_SECONDS', 60))
+OPENAI_MAX_RETRIES = int(environ.get('TEXTGPT_OPENAI_MAX_RETRIES', 3))
+# Stop calling a model for TEXTGPT_OPENAI_CIRCUIT_RESET_SECONDS after this many failures in a row
+OPENAI_CIRCUIT_FAILURES = int(environ.get('TEXTGPT_OPENAI_CIRCUIT_FAILURES', 5))
+OPENAI_CIRCUIT_RESET_SECONDS = float(environ.get('TEXTGPT_OPENAI_CIRCUIT_RESET_SECONDS', 30))
+# Send a duplicate of requests that are slower than the p95 of the model and use whichever answers first
+OPENAI_HEDGE = environ.get('TEXTGPT_OPENAI_HEDGE', '').lower() in ('1', 'true', 'yes')
+OPENAI_POOL_SIZE = int(environ.get('TEXTGPT_OPENAI_POOL_SIZE', 16))
+
+# Logging level name and 'text' or 'json' lines. Per message logs are DEBUG
+LOG_LEVEL = environ.get('TEXTGPT_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = environ.get('TEXTGPT_LOG_FORMAT', 'text')
+# Time each stage of handling a message and serve the results from /metrics
+METRICS_ENABLED = environ.get('TEXTGPT_METRICS', '1').lower() in ('1', 'true', 'yes')
+metrics.set_enabled(METRICS_ENABLED)
+
+# Stream chat completions and text each segment as soon as it is complete
+STREAM_RESPONSES = environ.get('TEXTGPT_STREAM', '').lower() in ('1', 'true', 'yes')
+
+MEMORY_PREFIX = 'Earlier messages that may be relevant:\n'
+
+SUMMARY_PROMPT = """You maintain a running summary of an SMS conversation between a user and an assistant.
+Update the current summary with the new messages. Keep facts, names, preferences and open questions the
+assistant will need later. Reply with only the updated summary."""
+
+# The model is named rather than given by id so it resolves before the catalog has loaded
+DEFAULT_SETTINGS = {'model': 'gpt-3.5-turbo',
                     'system_prompt_id': 1,
                     'stop_sequence': None,
                     'max_tokens': None,
@@ -25,6 +135,14 @@ DEFAULT_SETTINGS = {'model_id': 18,  # gpt3.5-turbo
                     'presence_penalty': 0.0
                     }
 
+# Settings stored as numbers and how #set converts them. A value that does not convert is never stored
+NUMERIC_SETTINGS = {'max_tokens': int,
+                    'temperature': float,
+                    'top_p': float,
+                    'frequency_penalty': float,
+                    'presence_penalty': float
+                    }
+
 HELP_STR = """TextGPT Commands:
 #help
 - prints this help message
@@ -63,37 +181,250 @@ Keys for #get and #set:
 """
 
 
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line with any extra= fields included
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(name)s]: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
 class textGPT(object):
 
-    def __init__(self, db_name='test.db', number=TWILIO_PHONE_NUMBER) -> None:
+    def __init__(self, db_name='test.db', number=TWILIO_PHONE_NUMBER, num_workers=TEXTGPT_WORKERS,
+                 summarize_after_tokens=SUMMARIZE_AFTER_TOKENS, stream=STREAM_RESPONSES, models_ttl=MODELS_TTL_SECONDS,
+                 coalesce=COALESCE_MESSAGES, image_cache_dir=IMAGE_CACHE_DIR, image_result_ttl=IMAGE_RESULT_TTL_SECONDS,
+                 completion_cache_ttl=COMPLETION_CACHE_TTL_SECONDS, history_cache_mb=HISTORY_CACHE_MB,
+                 memory_dir=MEMORY_DIR, embedder=None, memory_recent_messages=MEMORY_RECENT_MESSAGES,
+                 memory_top_k=MEMORY_TOP_K, queue_high_water=QUEUE_HIGH_WATER,
+                 priority_workers=PRIORITY_WORKERS) -> None:
+        init_started_at = monotonic()
         self.db_name = db_name
         self.client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
         self.number = number
-        self.mdb = MessageDB(self.db_name)
+        self.stream = stream
+        self.mdb = MessageDB(self.db_name, write_behind=WRITE_BEHIND,
+                             flush_interval=FLUSH_INTERVAL_MS / 1000, flush_max_rows=FLUSH_MAX_ROWS,
+                             cache_size=DB_CACHE_SIZE, cache_enabled=DB_CACHE_SIZE > 0,
+                             history_cache=HistoryCache(
+                                 history_cache_mb * 1024 * 1024, self.get_role) if history_cache_mb else None)
         self.mdb.add_phone_number(TWILIO_PHONE_NUMBER)
-        self.update_models()
 
+        # Serve #models from the catalog saved by the last run and refresh it in the background
+        self.all_models, self.models_fetched_at = self.mdb.get_model_catalog()
+        self.models_ttl = models_ttl
+        self.models_refreshed = threading.Event()
+        self.models_stopped = threading.Event()
+        self.models_thread = threading.Thread(
+            target=self.refresh_models_periodically, name='textgpt-models', daemon=True)
+        self.models_thread.start()
+
+        self.quotas = QuotaEngine(self.mdb, MESSAGES_PER_MINUTE, DAILY_PROMPT_TOKENS, DAILY_COMPLETION_TOKENS,
+                                  checkpoint_interval=QUOTA_CHECKPOINT_SECONDS)
+        # Messages from one number are handled in arrival order, different numbers in parallel.
+        # Local commands never wait behind OpenAI calls of other numbers
+        self.worker_pool = WorkerPool(
+            self.handle_incoming_message, num_workers, key_fn=lambda message_values: message_values['From'],
+            coalesce_fn=self.coalesce_messages if coalesce else None, max_pending=queue_high_water,
+            priority_fn=lambda message_values: not self.uses_openai(message_values['Body']),
+            priority_workers=priority_workers, max_priority_pending=PRIORITY_QUEUE_MAX) if num_workers else None
+        self.queue_high_water = queue_high_water
+        # Messages being handled without workers, and messages answered with BUSY_REPLY
+        self.inflight = 0
+        self.shed = 0
+        self.admission_lock = threading.Lock()
+        # Without workers each Flask thread handles its own message so serialize them per number instead.
+        # phone_number -> [lock, threads holding or waiting on it], removed when no thread is
+        self.conversation_locks = {}
+        self.conversation_locks_lock = threading.Lock()
+
+        self.summarize_after_tokens = summarize_after_tokens
+        self.summary_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='textgpt-summary')
+        self.summaries_in_progress = set()
+        self.summaries_lock = threading.Lock()
+        # Shared by the workers so one busy conversation does not hold up the sends of the others
+        self.send_executor = ThreadPoolExecutor(
+            max_workers=SEND_WORKERS * (num_workers + priority_workers if num_workers else 1),
+            thread_name_prefix='textgpt-send')
+        # Not forked since another thread may hold a lock at that moment, which the child would inherit held
+        self.image_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_PROCESSES, mp_context=multiprocessing.get_context('forkserver')) if IMAGE_PROCESSES else None
+        self.image_cache = DiskCache(
+            image_cache_dir, IMAGE_CACHE_MB * 1024 * 1024) if image_cache_dir else None
+        self.image_result_ttl = image_result_ttl
+        # A thread per worker that may call OpenAI. Commands are handled by the priority workers without it and the
+        # extra thread is the summarizer's. Without workers the Flask threads call it so fall back to the pool size
+        self.openai_client = OpenAIClient(
+            OPENAI_TIMEOUT_SECONDS, OPENAI_DEADLINE_SECONDS, OPENAI_MAX_RETRIES, failure_threshold=OPENAI_CIRCUIT_FAILURES,
+            reset_seconds=OPENAI_CIRCUIT_RESET_SECONDS, hedge=OPENAI_HEDGE, pool_size=OPENAI_POOL_SIZE,
+            workers=num_workers + 1 if num_workers else None)
+        self.completion_cache = CompletionCache(
+            self.mdb, completion_cache_ttl, COMPLETION_CACHE_MAX_ENTRIES) if completion_cache_ttl else None
+        self.memory = None
+        if memory_dir:
+            # Imported here so numpy is only loaded when long-term memory is on
+            from memorystore import HashingEmbedder, MemoryStore, OpenAIEmbedder
+            if embedder is None:
+                embedder = OpenAIEmbedder(self.openai_client) if MEMORY_EMBEDDER == 'openai' else HashingEmbedder()
+            self.memory = MemoryStore(memory_dir, embedder)
+        self.memory_recent_messages = memory_recent_messages
+        self.memory_top_k = memory_top_k
+
+        self.init_seconds = monotonic() - init_started_at
+        self.startup_seconds = monotonic() - PROCESS_STARTED_AT
+        logger.info('Ready after %.3fs (%.3fs in __init__)',
+                    self.startup_seconds, self.init_seconds)
+
+    def close(self):
+        # Finish queued work before the db goes away
+        if self.worker_pool is not None:
+            self.worker_pool.join()
+            self.worker_pool.stop()
+        self.models_stopped.set()
+        self.summary_executor.shutdown()
+        self.send_executor.shutdown()
+        if self.image_executor is not None:
+            self.image_executor.shutdown()
+        self.openai_client.close()
+        self.quotas.close()
+        self.mdb.close()
+
+    @staticmethod
+    def is_valid_message(message_values):
+        return all(message_values.get(key) for key in REQUIRED_MESSAGE_KEYS)
+
+    @staticmethod
+    def uses_openai(body):
+        # Everything but commands goes to OpenAI. Of the commands only #image does
+        return not body.startswith('#') or body[1:].lower().startswith('image')
+
+    def enqueue_incoming_message(self, message_values):
+        # Returns a reply for the webhook response when the message was shed instead of queued, otherwise None
+        # Copy the values since the request object is gone by the time a worker runs
+        message_values = dict(message_values)
+        message_values.setdefault('Body', '')
+        # Coalesced is set by coalesce_messages only, never by a webhook
+        message_values.pop('Coalesced', None)
+
+        if self.worker_pool is None:
+            return self.handle_now(message_values, not self.uses_openai(message_values['Body']))
+        if self.worker_pool.submit(message_values) is not None:
+            return None
+        return self.shed_message(message_values)
+
+    def handle_now(self, message_values, is_local=False):
+        # Handles the message in the calling thread unless too many OpenAI messages already are
+        with self.admission_lock:
+            shed = not is_local and 0 < self.queue_high_water <= self.inflight
+            if not shed:
+                self.inflight += 1
+        if shed:
+            return self.shed_message(message_values)
+        try:
+            with self.conversation_lock(message_values['From']):
+                self.handle_incoming_message(message_values)
+        finally:
+            with self.admission_lock:
+                self.inflight -= 1
+        return None
+
+    def shed_message(self, message_values):
+        with self.admission_lock:
+            self.shed += 1
+        logger.warning('Shedding %s from %s, too many messages waiting.',
+                       message_values.get('MessageSid'), message_values.get('From'))
+        return BUSY_REPLY
+
+    @contextmanager
+    def conversation_lock(self, phone_number):
+        with self.conversation_locks_lock:
+            if (entry := self.conversation_locks.get(phone_number)) is None:
+                entry = self.conversation_locks[phone_number] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.conversation_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.conversation_locks[phone_number]
+
+    @staticmethod
+    def coalesce_messages(messages_values):
+        # Runs of plain texts are answered once, by their last message. Commands and media are never merged
+        def is_plain(message_values):
+            return not message_values.get('Body', '').startswith('#') and not message_values.get('MediaUrl0')
+
+        coalesced = []
+        for message_values in messages_values:
+            if is_plain(message_values) and coalesced and is_plain(coalesced[-1]):
+                previous = dict(coalesced.pop())
+                earlier = previous.pop('Coalesced', [])
+                message_values = {**message_values,
+                                  'Coalesced': [*earlier, previous]}
+            coalesced.append(message_values)
+        return coalesced
+
+    @metrics.timed('handler')
     def handle_incoming_message(self, message_values):
         incoming_message_sid = message_values.get('MessageSid', None)
         from_phone_number = message_values.get('From', None)
         to_phone_number = message_values.get('To', None)
         incoming_message_body = message_values.get('Body', None)
         media_url = media_url = message_values.get('MediaUrl0', None)
-
-        self.mdb = MessageDB(self.db_name)
-        incoming_message_obj = self.mdb.add_message(
-            incoming_message_sid, from_phone_number, to_phone_number, incoming_message_body)
-
-        # If settings is None, add default settings
-        if (settings := self.mdb.get_settings_for_phone_number(from_phone_number)) is None:
-            self.mdb.add_settings(from_phone_number, **DEFAULT_SETTINGS)
-            settings = self.mdb.get_settings_for_phone_number(
-                from_phone_number)
+        settings = self.get_settings(from_phone_number)
+
+        # Only messages that call OpenAI count against the limits. Texts over them get the limit reply without it or
+        # them being stored, so neither reaches later prompts. A redelivered text is left for add_message to ignore
+        if (self.uses_openai(incoming_message_body) and not self.mdb.has_message_sid(incoming_message_sid)
+                and (limit_reply := self.quotas.admit(from_phone_number, settings.get('model')))):
+            self.send_message(to_phone_number=from_phone_number, body=limit_reply, record=False)
+            return None
+
+        # Texts merged into this one are stored first so the context has all of them in order
+        stored_message_objs = []
+        for earlier_values in message_values.get('Coalesced', ()):
+            stored_message_objs.append(self.mdb.add_message(
+                earlier_values['MessageSid'], earlier_values['From'], earlier_values['To'],
+                earlier_values.get('Body', ''), ignore_duplicate=True))
+
+        # A redelivered MessageSid was already answered or is being answered now so it gets no reply
+        stored_message_objs.append(self.mdb.add_message(
+            incoming_message_sid, from_phone_number, to_phone_number, incoming_message_body, ignore_duplicate=True))
+        if not (new_message_objs := [obj for obj in stored_message_objs if obj is not None]):
+            return None
+        self.remember_messages(from_phone_number, new_message_objs)
+        # Coalesced texts are plain so the last new one answers for the run
+        incoming_message_obj = new_message_objs[-1]
+        incoming_message_body = incoming_message_obj.body
 
         # Handle Commands ie #get settings #set settings #get system prompt #set system prompt
         if incoming_message_body.startswith('#'):
             outgoing_message_body = self.handle_command(
                 incoming_message_obj, settings, media_url)
+        elif self.stream:
+            text_chunks = self.get_message_response(
+                incoming_message_obj, settings, stream=True)
+            outgoing_message_objs = self.send_message_stream(
+                to_phone_number=from_phone_number, text_chunks=text_chunks)
+            return incoming_message_obj and outgoing_message_objs
         else:
             outgoing_message_body = self.get_message_response(
                 incoming_message_obj, settings)
@@ -103,58 +434,305 @@ class textGPT(object):
 
         return incoming_message_obj and outgoing_message_objs
 
-    def send_message(self, to_phone_number, body, chunk_size=1600):
-        if len(body) > chunk_size:
-            chunks = [body[i:i+chunk_size]
-                      for i in range(0, len(body), chunk_size)]
+    def get_settings(self, phone_number):
+        # New numbers get the default settings
+        if (settings := self.mdb.get_settings_for_phone_number(phone_number)) is None:
+            self.mdb.add_phone_number(phone_number)
+            self.mdb.add_settings(phone_number, **DEFAULT_SETTINGS)
+            settings = self.mdb.get_settings_for_phone_number(phone_number)
+        return settings
+
+    def send_segment(self, to_phone_number, segment):
+        if segment.startswith('http'):
+            media_url = segment
+            segment = None
         else:
-            chunks = [body,]
-
-        self.mdb = MessageDB(self.db_name)
-        outgoing_message_objs = []
-        for chunk in chunks:
-            if chunk.startswith('http'):
-                media_url = chunk
-                chunk = None
-            else:
-                media_url = None
+            media_url = None
 
-            message = self.client.messages.create(
+        with metrics.span('twilio', 'messages.create'):
+            return self.client.messages.create(
                 from_=self.number,
                 to=to_phone_number,
-                body=chunk,
+                body=segment,
                 media_url=media_url)
 
-            message_sid = message.sid
-            outgoing_message_obj = self.mdb.add_message(
-                message_sid, self.number, to_phone_number, body)
-            outgoing_message_objs.append(outgoing_message_obj)
-
-        return outgoing_message_objs
-
-    def get_message_response(self, incoming_message_obj, settings=None):
+    def record_sent_message(self, to_phone_number, body, sent_segments):
+        # One logical message linked to the SIDs of its segments, written in one transaction
+        segments = [(message.sid, segment) for message, segment in sent_segments]
+        outgoing_message_obj = self.mdb.add_message(
+            segments[0][0], self.number, to_phone_number, body, segments=segments)
+        self.remember_messages(to_phone_number, [outgoing_message_obj])
+        return [outgoing_message_obj,]
+
+    def send_message(self, to_phone_number, body, chunk_size=MAX_SEGMENT_SIZE, record=True):
+        # Without record the message is only texted, not stored as a turn of the conversation
+        chunks = split_segments(body, chunk_size)
+        if len(chunks) == 1:
+            # Most replies are one segment, which is sent without a hop to the executor
+            messages = [self.send_segment(to_phone_number, chunks[0])]
+        else:
+            # map keeps the segments in order while they are sent concurrently
+            messages = self.send_executor.map(
+                lambda chunk: self.send_segment(to_phone_number, chunk), chunks)
+        if not record:
+            list(messages)
+            return []
+        return self.record_sent_message(to_phone_number, body, list(zip(messages, chunks)))
+
+    def send_message_stream(self, to_phone_number, text_chunks, chunk_size=MAX_SEGMENT_SIZE):
+        # Each segment is texted as soon as it is complete instead of waiting for the whole reply
+        completion_chunks = []
+
+        def collect_chunks():
+            for text_chunk in text_chunks:
+                completion_chunks.append(text_chunk)
+                yield text_chunk
+
+        sent_segments = []
+        for chunk in stream_segments(collect_chunks(), chunk_size):
+            message = self.send_segment(to_phone_number, chunk)
+            sent_segments.append((message, chunk))
+
+        if not sent_segments:
+            return []
+        # The text as generated since joining the segments would lose the line breaks between them
+        body = ''.join(completion_chunks).strip()
+        return self.record_sent_message(to_phone_number, body, sent_segments)
+
+    def get_message_response(self, incoming_message_obj, settings=None, stream=False):
         settings = {} if settings is None else settings
         user_phone_number = incoming_message_obj.from_phone_number
-        text_messages = self.mdb.get_messages_for_phone_number(
-            user_phone_number)
+        summary = self.mdb.get_summary_for_phone_number(
+            user_phone_number) if self.summarize_after_tokens else None
+        openai_messages, prompt_tokens, (conversation_tokens, complete) = self.build_prompt(
+            user_phone_number, settings.pop('system_prompt', None), settings.get('model'), settings.get('max_tokens'), summary)
+        self.maybe_summarize_conversation(
+            user_phone_number, settings.get('model'), summary, conversation_tokens, complete)
 
-        openai_messages = [
-            {'role': 'system', 'content': settings.pop('system_prompt', None)},]
-        for message_obj in text_messages:
-            if message_obj.body.startswith('#'):
+        settings['stop'] = settings.pop('stop_sequence', None)
+        if stream:
+            return self.record_streamed_usage(
+                self.openai_stream_chat(openai_messages, **settings), user_phone_number, settings.get('model'), prompt_tokens)
+
+        reply = self.openai_get_chat(openai_messages, **settings)
+        self.quotas.record(user_phone_number, settings.get('model'),
+                           prompt_tokens, count_tokens(reply))
+        return reply
+
+    def record_streamed_usage(self, text_chunks, user_phone_number, model, prompt_tokens):
+        completion_chunks = []
+        for text_chunk in text_chunks:
+            completion_chunks.append(text_chunk)
+            yield text_chunk
+        self.quotas.record(user_phone_number, model, prompt_tokens,
+                           count_tokens(''.join(completion_chunks)))
+
+    def get_role(self, message_obj, user_phone_number):
+        # None for messages that are never sent to the model
+        if message_obj.body.startswith('#'):
+            return None
+        elif message_obj.from_phone_number == user_phone_number:
+            return 'user'
+        elif message_obj.from_phone_number == self.number:
+            return 'assistant'
+        else:
+            logger.warning(
+                'message_obj.from_phone_number not in [user_phone_number, self.number]')
+            return None
+
+    def get_token_budget(self, system_prompt, model=None, max_tokens=None):
+        # Tokens left for the conversation after the system prompt and room for the completion
+        context_window = self.mdb.get_model_context_window(model)
+        try:
+            completion_tokens = int(max_tokens) if max_tokens else DEFAULT_COMPLETION_TOKENS
+        except ValueError:
+            # Stored by #set before it validated numbers
+            completion_tokens = DEFAULT_COMPLETION_TOKENS
+        return context_window - completion_tokens - TOKENS_PER_REPLY - TOKENS_PER_MESSAGE - count_tokens(system_prompt)
+
+    def get_context_messages(self, user_phone_number, system_prompt, model=None, max_tokens=None, summary=None):
+        return self.build_context(user_phone_number, system_prompt, model, max_tokens, summary)[0]
+
+    def build_context(self, user_phone_number, system_prompt, model=None, max_tokens=None, summary=None):
+        # Returns the messages to send and how many prompt tokens they are
+        return self.build_prompt(user_phone_number, system_prompt, model, max_tokens, summary)[:2]
+
+    def build_prompt(self, user_phone_number, system_prompt, model=None, max_tokens=None, summary=None):
+        # build_context plus (tokens, complete) of the conversation since the summary. When only its newest
+        # messages were read complete is False and tokens counts just those
+        budget = self.get_token_budget(system_prompt, model, max_tokens)
+        prompt_tokens = count_tokens(system_prompt) + TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+        preamble = [{'role': 'system', 'content': system_prompt},]
+        after_message_id = 0
+        if summary:
+            # Only the turns since the summary are sent verbatim
+            after_message_id = summary['last_message_id']
+            summary_content = f"Summary of the earlier conversation:\n{summary['summary']}"
+            summary_tokens = count_tokens(summary_content) + TOKENS_PER_MESSAGE
+            budget -= summary_tokens
+            prompt_tokens += summary_tokens
+            preamble.append({'role': 'system', 'content': summary_content})
+
+        if self.memory is None and self.mdb.history_cache is not None:
+            # Only messages added since the conversation was cached are new work
+            history = self.mdb.get_history_for_phone_number(user_phone_number, after_message_id)
+            context_messages, context_tokens = history.fit(budget)
+            return [*preamble, *context_messages], prompt_tokens + context_tokens, (history.content_tokens(), True)
+
+        recent, context_tokens, complete = self.fit_recent_messages(
+            user_phone_number, budget, after_message_id, self.memory_recent_messages if self.memory is not None else None)
+        conversation = (sum(message_obj.token_count for message_obj, _ in recent), complete)
+        if self.memory is not None:
+            context_messages, context_tokens = self.build_memory_context(
+                user_phone_number, budget, after_message_id, recent, context_tokens)
+        else:
+            context_messages = [{'role': role, 'content': message_obj.body} for message_obj, role in reversed(recent)]
+        return [*preamble, *context_messages], prompt_tokens + context_tokens, conversation
+
+    def fit_recent_messages(self, user_phone_number, budget, after_message_id=0, limit=None):
+        # Newest-first (message_obj, role) of the turns that fit in budget, their prompt tokens and whether
+        # they are every turn after after_message_id. Older rows are never read
+        recent = []
+        context_tokens = 0
+        new_token_counts = []
+        rows = 0
+        complete = True
+        for message_obj in self.mdb.iter_messages_for_phone_number(
+                user_phone_number, after_message_id, newest_first=True, limit=limit):
+            rows += 1
+            if (role := self.get_role(message_obj, user_phone_number)) is None:
                 continue
-            elif message_obj.from_phone_number == user_phone_number:
-                role = 'user'
-            elif message_obj.from_phone_number == self.number:
-                role = 'assistant'
-            else:
-                print(
-                    'Error: message_obj.from_phone_number not in [user_phone_number, self.number]')
 
-            openai_messages.append({'role': role, 'content': message_obj.body})
+            if message_obj.token_count is None:
+                message_obj.token_count = count_tokens(message_obj.body)
+                new_token_counts.append(
+                    (message_obj.message_id, message_obj.token_count))
+
+            message_tokens = message_obj.token_count + TOKENS_PER_MESSAGE
+            # Always send the newest message even if it alone is over budget
+            if message_tokens > budget and recent:
+                complete = False
+                break
+            budget -= message_tokens
+            context_tokens += message_tokens
+            recent.append((message_obj, role))
+
+        if new_token_counts:
+            self.mdb.update_message_token_counts(new_token_counts)
+        return recent, context_tokens, complete and (limit is None or rows < limit)
+
+    def build_memory_context(self, user_phone_number, budget, after_message_id, recent, context_tokens):
+        # The newest turns, as fit_recent_messages returns them, plus one system message quoting the older messages
+        # most similar to the newest text. Both are bounded so the prompt stays the same size however long the
+        # conversation gets
+        context_messages = [{'role': role, 'content': message_obj.body} for message_obj, role in reversed(recent)]
+        if not (query_obj := next((message_obj for message_obj, role in recent if role == 'user'), None)):
+            return context_messages, context_tokens
 
-        settings['stop'] = settings.pop('stop_sequence', None)
-        return self.openai_get_chat(openai_messages, **settings)
+        try:
+            matches = self.memory.search(user_phone_number, query_obj.body, self.memory_top_k, after_message_id,
+                                         before_message_id=recent[-1][0].message_id, message_id=query_obj.message_id)
+        except OpenAIError as e:
+            logger.warning('Error searching memory for %s: %s', user_phone_number, e)
+            return context_messages, context_tokens
+
+        # Best matches first until the budget runs out, then quoted in the order they were sent
+        remaining = budget - context_tokens - count_tokens(MEMORY_PREFIX) - TOKENS_PER_MESSAGE
+        message_objs = {message_obj.message_id: message_obj
+                        for message_obj in self.mdb.get_messages_by_id([message_id for message_id, _ in matches])}
+        recalled = []
+        for message_id, _ in matches:
+            if (message_obj := message_objs.get(message_id)) is None:
+                continue
+            line = f'{self.get_role(message_obj, user_phone_number)}: {message_obj.body}'
+            if (line_tokens := count_tokens(line) + 1) > remaining:
+                continue
+            remaining -= line_tokens
+            recalled.append((message_id, line))
+        if not recalled:
+            return context_messages, context_tokens
+
+        memory_content = MEMORY_PREFIX + '\n'.join(line for _, line in sorted(recalled))
+        memory_message = {'role': 'system', 'content': memory_content}
+        return [memory_message, *context_messages], context_tokens + count_tokens(memory_content) + TOKENS_PER_MESSAGE
+
+    def delete_messages(self, user_phone_number):
+        self.mdb.delete_messages_for_phone_number(user_phone_number)
+        if self.memory is not None:
+            self.memory.delete(user_phone_number)
+
+    def remember_messages(self, user_phone_number, message_objs):
+        # Embeds the messages the model would see so later turns can recall them
+        if self.memory is None:
+            return
+        message_objs = [message_obj for message_obj in message_objs
+                        if message_obj is not None and self.get_role(message_obj, user_phone_number)]
+        if not message_objs:
+            return
+        try:
+            self.memory.add(user_phone_number, [message_obj.message_id for message_obj in message_objs],
+                            [message_obj.body for message_obj in message_objs])
+        except OpenAIError as e:
+            logger.warning('Error embedding messages for %s: %s', user_phone_number, e)
+
+    def maybe_summarize_conversation(self, user_phone_number, model=None, summary=None, conversation_tokens=None,
+                                     complete=False):
+        # conversation_tokens are the tokens since the summary as build_prompt counted them. Only a partial count
+        # under the threshold is checked against the db, which would also flush the journal
+        if not self.summarize_after_tokens:
+            return None
+
+        if conversation_tokens is None or (not complete and conversation_tokens <= self.summarize_after_tokens):
+            after_message_id = summary['last_message_id'] if summary else 0
+            conversation_tokens = self.mdb.get_token_count_for_phone_number(user_phone_number, after_message_id)
+        if conversation_tokens <= self.summarize_after_tokens:
+            return None
+
+        with self.summaries_lock:
+            if user_phone_number in self.summaries_in_progress:
+                return None
+            self.summaries_in_progress.add(user_phone_number)
+
+        # Summarize off the request path, the next message picks up the new summary
+        return self.summary_executor.submit(self.summarize_conversation, user_phone_number, model)
+
+    def summarize_conversation(self, user_phone_number, model=None):
+        try:
+            summary = self.mdb.get_summary_for_phone_number(user_phone_number)
+            after_message_id = summary['last_message_id'] if summary else 0
+            text_messages = self.mdb.get_messages_for_phone_number(
+                user_phone_number, after_message_id)
+
+            # Keep the newest half of the threshold verbatim and fold everything older into the summary
+            kept_tokens = 0
+            fold_until = 0
+            for i in range(len(text_messages) - 1, -1, -1):
+                kept_tokens += text_messages[i].token_count or count_tokens(text_messages[i].body)
+                if kept_tokens > self.summarize_after_tokens // 2:
+                    fold_until = i + 1
+                    break
+
+            messages_to_fold = text_messages[:fold_until]
+            transcript = '\n'.join(f'{role}: {message_obj.body}' for message_obj in messages_to_fold
+                                   if (role := self.get_role(message_obj, user_phone_number)))
+            if not transcript:
+                return None
+
+            current_summary = summary['summary'] if summary else 'None'
+            new_summary = self.openai_get_chat([
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': f'Current summary:\n{current_summary}\n\nNew messages:\n{transcript}'},
+            ], model=model, raise_errors=True)
+
+            self.mdb.update_summary_for_phone_number(
+                user_phone_number, new_summary, messages_to_fold[-1].message_id)
+            return new_summary
+        except OpenAIError as e:
+            logger.error('Error summarizing conversation for %s: %s', user_phone_number, e)
+            return None
+        finally:
+            with self.summaries_lock:
+                self.summaries_in_progress.discard(user_phone_number)
 
     def handle_command(self, incoming_message_obj, settings=None, media_url=None):
         settings = {} if settings is None else settings
@@ -186,6 +764,10 @@ class textGPT(object):
         elif verb == 'set' and len(args) == 2:
             param, value = args
             if param in settings_params:
+                try:
+                    value = NUMERIC_SETTINGS.get(param, str)(value)
+                except ValueError:
+                    return f'Error: {param} must be a number, not {value}.'
                 self.mdb.update_settings_for_phone_number(
                     user_phone_number, **{param: value})
                 reply = f'Your {param} has been set to:\n{value}'
@@ -199,19 +781,20 @@ class textGPT(object):
                     user_phone_number, **DEFAULT_SETTINGS)
                 reply = 'Your settings have been reset to defaults'
             elif param == 'messages':
-                self.mdb.delete_messages_for_phone_number(user_phone_number)
+                self.delete_messages(user_phone_number)
                 reply = 'Your conversation has been reset.'
             elif param == 'all':
                 self.mdb.update_settings_for_phone_number(
                     user_phone_number, **DEFAULT_SETTINGS)
-                self.mdb.delete_messages_for_phone_number(user_phone_number)
+                self.delete_messages(user_phone_number)
                 reply = 'Your settings and conversation have been reset.'
 
         elif verb == 'models' and len(args) == 0:
-            reply = 'Available Models:\n' + '\n'.join(self.all_models)
+            reply = 'Available Models:\n' + '\n'.join(self.all_models) if self.all_models else 'Models are still loading, try again soon.'
 
         elif verb == 'limits' and len(args) == 0:
-            reply = self.get_user_limits(user_phone_number)
+            reply = self.get_user_limits(
+                user_phone_number, settings.get('model'))
 
         elif verb == 'image':
             param = args[0]
@@ -228,32 +811,85 @@ class textGPT(object):
         return reply
 
     def update_models(self):
-        self.all_models = sorted([model['id']
-                                 for model in openai.Model.list()['data']])
-        for model in self.all_models:
-            self.mdb.add_model(model)
+        fetched_at = time()
+        try:
+            all_models = sorted([model['id']
+                                for model in openai.Model.list()['data']])
+            self.mdb.upsert_models(all_models, fetched_at)
+            self.all_models, self.models_fetched_at = all_models, fetched_at
+        except OpenAIError as e:
+            # Keep serving the saved catalog when the API is unreachable
+            logger.warning('Error updating models: %s', e)
+
+        self.models_refreshed.set()
         return self.all_models
 
-    def try_openai(self, getter_fn, parser_fn, **kwargs):
+    def get_models_age(self):
+        if self.models_fetched_at is None:
+            return float('inf')
+        return time() - self.models_fetched_at
+
+    def refresh_models_periodically(self):
+        while not self.models_stopped.is_set():
+            if self.get_models_age() >= self.models_ttl:
+                self.update_models()
+            else:
+                self.models_refreshed.set()
+
+            wait_seconds = self.models_ttl - self.get_models_age()
+            self.models_stopped.wait(
+                wait_seconds if wait_seconds > 0 else MODELS_RETRY_SECONDS)
+
+    def try_openai(self, getter_fn, parser_fn, raise_errors=False, **kwargs):
         try:
-            response = getter_fn(**kwargs)
+            response = self.openai_client.call(getter_fn, **kwargs)
             return parser_fn(response)
         except OpenAIError as e:
-            print(e)
+            logger.warning('OpenAI error: %s', e)
+            if raise_errors:
+                raise
             return str(e)
 
-    def openai_get_chat(self, messages=None, n=1, **kwargs):
+    @metrics.timed('openai')
+    def openai_get_chat(self, messages=None, n=1, raise_errors=False, **kwargs):
         messages = [] if messages is None else messages
 
-        result = self.try_openai(
-            getter_fn=openai.ChatCompletion.create,
-            parser_fn=lambda response: response.choices[0].message.content.strip(
-            ),
-            messages=messages,
-            n=n, **kwargs)
+        # Deterministic requests are answered from the cache without calling OpenAI
+        cache_key = None
+        if self.completion_cache is not None and self.completion_cache.is_deterministic(n, **kwargs):
+            cache_key = self.completion_cache.make_key(messages, **kwargs)
+            if (result := self.completion_cache.get(cache_key, kwargs.get('model'))) is not None:
+                return result
+
+        try:
+            result = self.try_openai(
+                getter_fn=openai.ChatCompletion.create,
+                parser_fn=lambda response: response.choices[0].message.content.strip(
+                ),
+                raise_errors=True,
+                messages=messages,
+                n=n, **kwargs)
+        except OpenAIError as e:
+            if raise_errors:
+                raise
+            return str(e)
 
+        if cache_key is not None:
+            self.completion_cache.put(cache_key, kwargs.get('model'), result)
         return result
 
+    def openai_stream_chat(self, messages=None, n=1, **kwargs):
+        # Yields the completion text as it is generated
+        messages = [] if messages is None else messages
+        try:
+            # Retries and deadlines cover getting the stream. Chunks are read as they arrive
+            for chunk in self.openai_client.call(openai.ChatCompletion.create, messages=messages, n=n, stream=True, **kwargs):
+                if content := chunk['choices'][0]['delta'].get('content'):
+                    yield content
+        except OpenAIError as e:
+            logger.warning('OpenAI error while streaming: %s', e)
+            yield str(e)
+
     def parse_size_from_prompt(self, prompt, default_size='256x256'):
         for size in ['256x256', '512x512', '1024x1024']:
             if size in prompt:
@@ -263,19 +899,33 @@ class textGPT(object):
 
     def openai_get_image(self, prompt, n=1, **kwargs):
         size, prompt = self.parse_size_from_prompt(prompt)
-        result = self.try_openai(
-            getter_fn=openai.Image.create,
-            parser_fn=lambda response: response.data[0].url,
-            size=size,
-            prompt=prompt,
-            n=n, **kwargs)
+        # Only plain single image requests are cached, keyed on the prompt ignoring case and spacing
+        cache_key = None
+        if self.image_cache is not None and self.image_result_ttl and n == 1 and not kwargs:
+            cache_key = f"image:{size}:{' '.join(prompt.lower().split())}"
+            if (url := self.image_cache.get(cache_key, max_age=self.image_result_ttl)) is not None:
+                return url.decode()
 
+        try:
+            result = self.try_openai(
+                getter_fn=openai.Image.create,
+                parser_fn=lambda response: response.data[0].url,
+                raise_errors=True,
+                size=size,
+                prompt=prompt,
+                n=n, **kwargs)
+        except OpenAIError as e:
+            return str(e)
+
+        if cache_key is not None and result:
+            self.image_cache.put(cache_key, result.encode())
         return result
 
     def openai_get_image_edit(self, prompt, media_url, n=1, **kwargs):
         size, prompt = self.parse_size_from_prompt(prompt)
 
-        image_bytes, mask_bytes = get_image_bytes_if_valid(media_url)
+        image_bytes, mask_bytes = get_image_bytes_if_valid(
+            media_url, self.image_executor, self.image_cache)
         if not isinstance(image_bytes, bytes):
             error_message = image_bytes
             return error_message
@@ -294,7 +944,8 @@ class textGPT(object):
     def openai_get_image_variation(self, prompt, media_url, n=1, **kwargs):
         size, prompt = self.parse_size_from_prompt(prompt)
         # n = int(prompt.strip()) if prompt else 1
-        image_bytes, mask_bytes = get_image_bytes_if_valid(media_url)
+        image_bytes, mask_bytes = get_image_bytes_if_valid(
+            media_url, self.image_executor, self.image_cache)
         if not isinstance(image_bytes, bytes):
             error_message = image_bytes
             return error_message
@@ -308,9 +959,39 @@ class textGPT(object):
 
         return result
 
-    def get_user_limits(self, user_phone_number):
-        # TODO: implement token limiting and message limiting
-        raise NotImplementedError
+    def get_user_limits(self, user_phone_number, model=None):
+        return self.quotas.get_limits_report(user_phone_number, model)
+
+    def update_metrics(self):
+        # Copies the stats the components keep themselves into gauges right before a scrape
+        gauge = metrics.registry.gauge(
+            'textgpt_component_stat', 'Stats reported by textGPT components', ('component', 'stat'))
+        components = {'quotas': self.quotas.stats(), 'openai_client': self.openai_client.stats(),
+                      'ingest': {'duplicate_messages': self.mdb.duplicate_messages},
+                      'image_download': get_download_stats()}
+        if self.mdb.history_cache is not None:
+            components['history_cache'] = self.mdb.history_cache.stats()
+        with self.admission_lock:
+            components['admission'] = {'inflight': self.inflight, 'shed': self.shed,
+                                        'high_water': self.queue_high_water}
+        if self.worker_pool is not None:
+            components['worker_pool'] = self.worker_pool.stats()
+        if self.mdb.journal is not None:
+            components['journal'] = self.mdb.journal.stats()
+        if self.image_cache is not None:
+            components['image_cache'] = self.image_cache.stats()
+        if self.memory is not None:
+            components['memory'] = self.memory.stats()
+        for name, stats in self.mdb.cache_stats().items():
+            components[f'db_cache_{name}'] = stats
+        if self.completion_cache is not None:
+            for model, stats in self.completion_cache.stats().items():
+                components[f'completion_cache_{model}'] = stats
+
+        for component, stats in components.items():
+            for stat, value in stats.items():
+                if isinstance(value, (int, float)):
+                    gauge.set(value, component, stat)
 
 
 # Flask app webhook handler for Twilio SMS
@@ -319,11 +1000,27 @@ app = Flask(__name__)
 
 @app.route("/sms", methods=['POST'])
 def incoming_sms():
-    textgpt.handle_incoming_message(request.values)
-    return ''
+    message_values = request.values.to_dict()
+    if not textGPT.is_valid_message(message_values):
+        return 'Invalid message', 400
+
+    # Empty TwiML since all replies are sent with the REST client, except the busy reply to a shed message
+    response = MessagingResponse()
+    if busy_reply := textgpt.enqueue_incoming_message(message_values):
+        response.message(busy_reply)
+    return str(response), 200, {'Content-Type': 'application/xml'}
+
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    if not metrics.enabled:
+        return 'Metrics are disabled', 404
+    textgpt.update_metrics()
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 if __name__ == "__main__":
+    configure_logging()
     textgpt = textGPT(TWILIO_PHONE_NUMBER)
     textgpt.mdb.add_system_prompt(
         "Your role is to respond to texts like Eric Cartman from South Park.")
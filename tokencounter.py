@@ -0,0 +1,66 @@
+import logging
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Every chat model so far uses this encoding
+DEFAULT_ENCODING = 'cl100k_base'
+
+# Tokens the chat format adds around each message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Tokens kept free for the completion when max_tokens is not set
+DEFAULT_COMPLETION_TOKENS = 512
+
+# Context window by model name prefix. The longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-3.5-turbo-1106': 16385,
+    'gpt-3.5-turbo-0125': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Roughly one token per short word, per 4 characters of a long word and per punctuation mark
+APPROXIMATE_TOKEN_RE = re.compile(r'\w{1,4}|[^\w\s]')
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # tiktoken downloads the encoding the first time so fall back to approximating when offline
+        logger.warning("Could not load %s, approximating token counts. %r", encoding_name, e)
+        return None
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if (encoding := get_encoding()) is not None:
+        return len(encoding.encode(text))
+    return len(APPROXIMATE_TOKEN_RE.findall(text))
+
+
+def get_context_window(model_name):
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS
+               if model_name and model_name.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
@@ -0,0 +1,204 @@
+import logging
+import threading
+from collections import deque
+from itertools import count
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    # Payloads with the same key run one at a time in arrival order while different keys run in parallel.
+    # Without a key_fn every payload gets its own key. coalesce_fn gets every payload waiting for a key
+    # and returns the (fewer) payloads to actually handle. max_pending bounds the payloads waiting, 0 is unbounded.
+    # priority_fn marks payloads that jump the line: a key whose next payload is one runs before keys whose next
+    # payload is not, and priority_workers more threads run only those keys. They are bounded by
+    # max_priority_pending instead. A priority payload queued behind an ordinary one of its key still waits for it
+    def __init__(self, handler, num_workers=4, name='textgpt-worker', key_fn=None, coalesce_fn=None, max_pending=0,
+                 priority_fn=None, priority_workers=0, max_priority_pending=0):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.name = name
+        self.key_fn = key_fn
+        self.coalesce_fn = coalesce_fn
+        self.max_pending = max_pending
+        self.priority_fn = priority_fn
+        self.priority_workers = priority_workers
+        self.max_priority_pending = max_priority_pending
+        self.next_key = count()
+        # Keys with waiting payloads by the priority of their next one. A key is only ever ready or being run by one worker
+        self.ready = deque()
+        self.priority_ready = deque()
+        # key -> deque of (enqueued_at, payload, is_priority). A key stays until its last payload is handled
+        self.pending = {}
+        # Payloads waiting, and how many of them are priority payloads
+        self.pending_count = 0
+        self.priority_pending_count = 0
+        self.threads = []
+        self.lock = threading.Lock()
+        # Notified when a key becomes ready or is done
+        self.changed = threading.Condition(self.lock)
+        self.stopping = False
+
+        # Stats
+        self.submitted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.total_queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.last_queue_seconds = 0.0
+
+        self.start()
+
+    def start(self):
+        with self.lock:
+            self.stopping = False
+        threads = [(f'{self.name}-{i}', False) for i in range(self.num_workers)]
+        threads += [(f'{self.name}-priority-{i}', True) for i in range(self.priority_workers)]
+        for thread_name, priority_only in threads:
+            thread = threading.Thread(
+                target=self._work, args=(priority_only,), name=thread_name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, payload):
+        # Returns the number of payloads waiting, or None when the pool is full and payload was not queued
+        key = self.key_fn(payload) if self.key_fn else next(self.next_key)
+        is_priority = bool(self.priority_fn and self.priority_fn(payload))
+        with self.lock:
+            if is_priority:
+                full = self.max_priority_pending and self.priority_pending_count >= self.max_priority_pending
+            else:
+                full = self.max_pending and self.pending_count - self.priority_pending_count >= self.max_pending
+            if full:
+                self.rejected += 1
+                return None
+            self.submitted += 1
+            self.pending_count += 1
+            self.priority_pending_count += is_priority
+            if (items := self.pending.get(key)) is None:
+                # Nothing queued or running for this key so schedule it
+                items = self.pending[key] = deque([(monotonic(), payload, is_priority)])
+                self._schedule(key)
+            else:
+                items.append((monotonic(), payload, is_priority))
+            return self.pending_count
+
+    def _schedule(self, key):
+        # Caller holds self.lock
+        _, _, is_priority = self.pending[key][0]
+        (self.priority_ready if is_priority else self.ready).append(key)
+        # Every thread is woken since priority workers cannot take an ordinary key
+        self.changed.notify_all()
+
+    def _next_key(self, priority_only):
+        # Blocks until there is a key this thread may run, or returns None once the pool is stopping
+        with self.lock:
+            while not self.stopping:
+                if self.priority_ready:
+                    return self.priority_ready.popleft()
+                if self.ready and not priority_only:
+                    return self.ready.popleft()
+                self.changed.wait()
+        return None
+
+    def _take(self, key):
+        # Next payloads to run for key. All of them when coalescing
+        with self.lock:
+            items = self.pending[key]
+            taken = list(items) if self.coalesce_fn else [items[0]]
+            for _ in taken:
+                items.popleft()
+            self.pending_count -= len(taken)
+            self.priority_pending_count -= sum(is_priority for _, _, is_priority in taken)
+        return taken
+
+    def _release(self, key):
+        # Reschedule key behind the other waiting keys if more payloads arrived while it ran
+        with self.lock:
+            if self.pending[key]:
+                self._schedule(key)
+            else:
+                del self.pending[key]
+                self.changed.notify_all()
+
+    def _work(self, priority_only=False):
+        while (key := self._next_key(priority_only)) is not None:
+            taken = self._take(key)
+            now = monotonic()
+            queue_seconds = max(now - enqueued_at for enqueued_at, _, _ in taken)
+            payloads = [payload for _, payload, _ in taken]
+            try:
+                if self.coalesce_fn and len(payloads) > 1:
+                    payloads = self._coalesce(payloads)
+                for payload in payloads:
+                    self._handle(payload, queue_seconds)
+            finally:
+                self._release(key)
+
+    def _coalesce(self, payloads):
+        try:
+            coalesced_payloads = self.coalesce_fn(payloads)
+        except Exception as e:
+            logger.exception("Error coalescing %d payloads, handling them one by one: %r", len(payloads), e)
+            return payloads
+        with self.lock:
+            self.coalesced += len(payloads) - len(coalesced_payloads)
+        return coalesced_payloads
+
+    def _handle(self, payload, queue_seconds):
+        try:
+            self.handler(payload)
+            failed = False
+        except Exception as e:
+            logger.exception("Error handling %s: %r", payload.get('MessageSid'), e)
+            failed = True
+        self._record(queue_seconds, failed)
+        logger.debug("Handled %s after %.3fs in queue. Queue depth: %d",
+                     payload.get('MessageSid'), queue_seconds, self.pending_count)
+
+    def _record(self, queue_seconds, failed):
+        with self.lock:
+            self.processed += 1
+            self.failed += failed
+            self.total_queue_seconds += queue_seconds
+            self.last_queue_seconds = queue_seconds
+            self.max_queue_seconds = max(self.max_queue_seconds, queue_seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': len(self.threads),
+                'priority_workers': self.priority_workers,
+                'queue_depth': self.pending_count,
+                'priority_queue_depth': self.priority_pending_count,
+                'max_pending': self.max_pending,
+                'max_priority_pending': self.max_priority_pending,
+                'active_keys': len(self.pending),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+                'avg_queue_seconds': self.total_queue_seconds / self.processed if self.processed else 0.0,
+                'max_queue_seconds': self.max_queue_seconds,
+                'last_queue_seconds': self.last_queue_seconds,
+            }
+
+    def join(self):
+        # Block until every submitted payload has been handled
+        with self.lock:
+            while self.pending:
+                self.changed.wait()
+
+    def stop(self, wait=True):
+        # Threads finish the payload they are handling. Call join first to handle everything submitted
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []